@@ -4,6 +4,9 @@ import shutil
 import subprocess
 from concurrent.futures import ThreadPoolExecutor
 from collections import Counter
+import numpy as np
+import pcap_decoder
+from trace_store import TraceStoreWriter, parse_trace_name
 
 ################################################################################
 # Constants
@@ -14,6 +17,13 @@ FEATURES_RESULT_PATH = "./../data/features"
 CLIENT_IP = None
 DROP_ZERO_PAYLOAD = True
 MAX_WORKERS = 4
+DECODER = "native"  # "native" (in-process, see pcap_decoder.py) or "tshark"
+
+# Output: "wang14" (one text file per visit), "store" (packed trace store, see
+# trace_store.py) or "both"
+OUTPUT_FORMAT = "both"
+TRACE_STORE_PATH = "./../data/traces.store"
+STORE_COMPRESSION = "none"  # "none" or "varint"
 ################################################################################
 
 TSHARK_FIELDS = [
@@ -95,19 +105,12 @@ def detect_client_ip(records):
         if dst: counter[dst] += 1
     return counter.most_common(1)[0][0] if counter else None
 
-def convert_pcap_to_wang14(pcap_path, out_dir, client_ip=None, drop_zero_payload=True):
+def decode_tshark(pcap_path, client_ip=None, drop_zero_payload=True):
     """
-    Convert x_y.pcap -> x-y (Wang14-style trace: rel_time \t signed_len)
+    tshark decoding path: one tshark process per capture, TSV parsed line by line.
+    Returns (rel_times, signed_lens, client_ip), or None if tshark failed.
     """
     base = os.path.basename(pcap_path)
-    stem, ext = os.path.splitext(base)
-    if "_" not in stem:
-        print(f"[WARN] Skip {base}: expected name like x_y.pcap")
-        return
-    x, y = stem.split("_", 1)
-    out_name = f"{x}-{y}"
-    out_path = os.path.join(out_dir, out_name)
-    os.makedirs(out_dir, exist_ok=True)
 
     # Run tshark once to get structured TSV
     cmd = ["tshark", "-r", pcap_path, "-Y", DISPLAY_FILTER] + TSHARK_FIELDS
@@ -115,12 +118,12 @@ def convert_pcap_to_wang14(pcap_path, out_dir, client_ip=None, drop_zero_payload
         result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
     except FileNotFoundError:
         print("[ERROR] tshark not found. Install with: brew install wireshark")
-        return
+        return None
 
     if result.returncode != 0:
         err = result.stderr.strip()
         print(f"[ERROR] tshark failed on {base}: {err}")
-        return
+        return None
 
     # Parse all lines first to (t, src, dst, payload_len)
     records = []
@@ -134,42 +137,113 @@ def convert_pcap_to_wang14(pcap_path, out_dir, client_ip=None, drop_zero_payload
         records.append(rec)
 
     if not records:
-        # still write a minimal file with just terminator
-        with open(out_path, "w") as f:
-            f.write("0\t0\n")
-        print(f"[OK] {base} -> {out_name} (no payload records)")
-        return
+        return np.zeros(0, dtype=np.float64), np.zeros(0, dtype=np.int64), None
 
     # Determine client IP
     local_ip = client_ip or detect_client_ip(records)
 
-    # Build output lines: relative time, signed length ( +payload if src==local_ip else -payload )
+    # Relative time, signed length ( +payload if src==local_ip else -payload )
     t0 = records[0][0]
-    lines = []
+    rel_times = []
+    signed_lens = []
     for (t, src, _dst, payload) in records:
-        rel = t - t0
         direction = 1 if (local_ip and src == local_ip) else -1
-        signed_len = direction * payload
-        lines.append(f"{rel:.6f}\t{signed_len}")
+        rel_times.append(t - t0)
+        signed_lens.append(direction * payload)
+
+    return np.array(rel_times, dtype=np.float64), np.array(signed_lens, dtype=np.int64), local_ip
+
+def decode_native(pcap_path, client_ip=None, drop_zero_payload=True):
+    """
+    Native decoding path: the capture is read in-process into arrays and the
+    payload filter, client detection and signing are done with NumPy. Returns
+    the same values as decode_tshark.
+    """
+    rel_times, signed_lens, local_ip = pcap_decoder.decode_trace(pcap_path, client_ip, drop_zero_payload)
+    return rel_times, signed_lens, pcap_decoder.int_to_ip(local_ip) if local_ip is not None else None
+
+def write_wang14(out_path, rel_times, signed_lens):
+    """Write one Wang14 text trace: rel_time \t signed_len, closed by the 0\t0 sentinel"""
+    if rel_times.size == 0:
+        # still write a minimal file with just terminator
+        with open(out_path, "w") as f:
+            f.write("0\t0\n")
+        return
 
     # Append sentinel row for Wang14 reader compatibility
+    lines = list(map("{:.6f}\t{}".format, rel_times.tolist(), signed_lens.tolist()))
     lines.append("0\t0")
     with open(out_path, "w") as f:
         f.write("\n".join(lines))
 
-    print(f"[OK] {base} -> {out_name} (client IP assumed: {local_ip}, kept {len(records)} packets)")
+def convert_pcap_to_wang14(pcap_path, out_dir, client_ip=None, drop_zero_payload=True, decoder=None, write_text=True):
+    """
+    Convert x_y.pcap -> x-y (Wang14-style trace: rel_time \t signed_len)
+    Returns (x, y, rel_times, signed_lens) for the trace store, or None if the capture was skipped.
+    """
+    base = os.path.basename(pcap_path)
+    stem, ext = os.path.splitext(base)
+    if "_" not in stem:
+        print(f"[WARN] Skip {base}: expected name like x_y.pcap")
+        return None
+    x, y = stem.split("_", 1)
+    out_name = f"{x}-{y}"
+    out_path = os.path.join(out_dir, out_name)
+    os.makedirs(out_dir, exist_ok=True)
+
+    decoded = None
+    if (decoder or DECODER) == "native":
+        try:
+            decoded = decode_native(pcap_path, client_ip, drop_zero_payload)
+        except pcap_decoder.UnsupportedCapture as e:
+            print(f"[WARN] {base}: {e}, falling back to tshark")
+    if decoded is None:
+        decoded = decode_tshark(pcap_path, client_ip, drop_zero_payload)
+    if decoded is None:
+        return None
+
+    rel_times, signed_lens, local_ip = decoded
+    if write_text:
+        write_wang14(out_path, rel_times, signed_lens)
+
+    if rel_times.size == 0:
+        print(f"[OK] {base} -> {out_name} (no payload records)")
+    else:
+        print(f"[OK] {base} -> {out_name} (client IP assumed: {local_ip}, kept {rel_times.size} packets)")
+    return x, y, rel_times, signed_lens
 
-def batch_convert(dataset_dir, out_dir, client_ip=None, drop_zero_payload=True):
+def batch_convert(dataset_dir, out_dir, client_ip=None, drop_zero_payload=True, output_format=None, store_path=None):
+    output_format = output_format or OUTPUT_FORMAT
     pcaps = [os.path.join(dataset_dir, f) for f in os.listdir(dataset_dir) if f.endswith(".pcap")]
     if not pcaps:
         print(f"[WARN] No .pcap files found in {dataset_dir}")
         return
+
+    write_text = output_format in ("wang14", "both")
+    writer = None
+    if output_format in ("store", "both"):
+        # Traces are appended from this thread only, in the order of `pcaps`
+        writer = TraceStoreWriter(store_path or TRACE_STORE_PATH, mode="w", compression=STORE_COMPRESSION)
+
+    convert = lambda p: convert_pcap_to_wang14(p, out_dir, client_ip, drop_zero_payload, write_text=write_text)
     with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
-        for _ in ex.map(lambda p: convert_pcap_to_wang14(p, out_dir, client_ip, drop_zero_payload), pcaps):
-            pass
+        for result in ex.map(convert, pcaps):
+            if writer is None or result is None:
+                continue
+            x, y, rel_times, signed_lens = result
+            label = parse_trace_name(f"{x}-{y}")
+            if label is None:
+                print(f"[WARN] {x}_{y}.pcap: not stored, expected integer x and y")
+                continue
+            writer.add(*label, rel_times, signed_lens)
+
+    if writer is not None:
+        writer.close()
+        print(f"[OK] Trace store written to {writer.path}")
 
 if __name__ == "__main__":
-    ensure_tshark()
+    if DECODER == "tshark":
+        ensure_tshark()
 
     if not os.path.isdir(DATASET_FOLDER):
         print(f"[ERROR] Input folder not found: {DATASET_FOLDER}")
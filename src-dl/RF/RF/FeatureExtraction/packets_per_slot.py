@@ -1,19 +1,82 @@
+import numpy as np
 from RF.const_rf import *
 
-def fun(times, sizes):
-    feature = [[0 for _ in range(max_matrix_len)], [0 for _ in range(max_matrix_len)]]
-    for i in range(0, len(sizes)):
-        if sizes[i] > 0:
-            if times[i] >= maximum_load_time:
-                feature[0][-1] += 1
-            else:
-                idx = int(times[i] * (max_matrix_len - 1) / maximum_load_time)
-                feature[0][idx] += 1
-        if sizes[i] < 0:
-            if times[i] >= maximum_load_time:
-                feature[1][-1] += 1
-            else:
-                idx = int(times[i] * (max_matrix_len - 1) / maximum_load_time)
-                feature[1][idx] += 1
-
-    return feature
+# Traffic aggregation matrix (TAM): packets per time slot, outgoing in row 0 and
+# incoming in row 1. The first maximum_load_time seconds are cut into
+# max_matrix_len - 1 slots; packets from maximum_load_time on all go to the
+# last slot (and negative times to the first one). Counts are stored as uint16
+# (traces are read up to max_trace_length packets). matrix_len and load_time
+# default to the const_rf parameters.
+MAX_COUNT = np.iinfo(np.uint16).max
+
+
+def _cells(times, sizes, matrix_len, load_time):
+    """Row * matrix_len + slot of every packet, and the mask of the non-zero-size ones"""
+    times, sizes = np.asarray(times), np.asarray(sizes)
+    slot = (np.clip(times, 0, load_time) * (matrix_len - 1) / load_time).astype(np.int64)
+    # load_time * (matrix_len - 1) / load_time can round below matrix_len - 1 (e.g. 33.3 s, 64 slots)
+    slot[times >= load_time] = matrix_len - 1
+    slot += (sizes < 0) * matrix_len
+    return slot, sizes != 0
+
+
+def fun(times, sizes, matrix_len=max_matrix_len, load_time=maximum_load_time):
+    cells, kept = _cells(times, sizes, matrix_len, load_time)
+    counts = np.bincount(cells if kept.all() else cells[kept], minlength=2 * matrix_len)
+    return np.minimum(counts, MAX_COUNT).astype(np.uint16).reshape(2, matrix_len)
+
+
+def _counts(times, sizes, offsets, matrix_len, load_time):
+    """int64[N, 2, matrix_len] packet counts of traces given as concatenated arrays"""
+    n = len(offsets) - 1
+    cells, kept = _cells(times, sizes, matrix_len, load_time)
+    cells += np.repeat(np.arange(n) * (2 * matrix_len), np.diff(offsets))
+    counts = np.bincount(cells if kept.all() else cells[kept], minlength=n * 2 * matrix_len)
+    return counts.reshape(n, 2, matrix_len)
+
+
+def fun_batch(times, sizes, offsets, out=None, matrix_len=max_matrix_len, load_time=maximum_load_time):
+    """
+    TAMs of many traces given as concatenated arrays (offsets int64[N + 1],
+    as read by wang14.read_traces or TraceStore.traces), written into out
+    (uint16[N, 2, matrix_len], allocated if None).
+    """
+    n = len(offsets) - 1
+    if out is None:
+        out = np.empty((n, 2, matrix_len), dtype=np.uint16)
+    out[...] = np.minimum(_counts(times, sizes, offsets, matrix_len, load_time), MAX_COUNT)
+    return out
+
+
+def fun_batch_multi(times, sizes, offsets, resolutions):
+    """
+    TAMs of many traces (as fun_batch) at several (matrix_len, load_time)
+    resolutions, as a list of uint16[N, 2, matrix_len]. What does not depend
+    on the grid (packets kept, row and trace of each packet, times clipped
+    to each load_time) is only computed once.
+    """
+    n = len(offsets) - 1
+    sizes = np.asarray(sizes)
+    kept = sizes != 0
+    # Row + 2 * trace: times matrix_len, the first cell of the packet's row
+    base = np.repeat(np.arange(n) * 2, np.diff(offsets)) + (sizes < 0)
+    times = np.asarray(times)
+    if not kept.all():
+        times, base = times[kept], base[kept]
+    clipped = {}
+    out = []
+    for matrix_len, load_time in resolutions:
+        if load_time not in clipped:
+            clipped[load_time] = np.clip(times, 0, load_time), times >= load_time
+        # Same operations as _cells
+        cells = (clipped[load_time][0] * (matrix_len - 1) / load_time).astype(np.int64)
+        cells[clipped[load_time][1]] = matrix_len - 1
+        cells += base * matrix_len
+        counts = np.bincount(cells, minlength=n * 2 * matrix_len)
+        out.append(np.minimum(counts, MAX_COUNT).astype(np.uint16).reshape(n, 2, matrix_len))
+    return out
+
+
+def fun_multi(times, sizes, resolutions):
+    """TAMs of one trace at several (matrix_len, load_time) resolutions (see fun_batch_multi)"""
+    return [tam[0] for tam in fun_batch_multi(times, sizes, np.array([0, len(times)]), resolutions)]
@@ -7,6 +7,7 @@ BASE_DIR = abspath(join(dirname(__file__), pardir))
 output_dir = join(BASE_DIR, 'RF/dataset/')
 
 # Separator in your trace files (matches your trace formatting)
+# NOTE: traces are now read by src-dl/wang14.py, which splits on any whitespace
 split_mark = '\t' 
 
 # Closed-world setting
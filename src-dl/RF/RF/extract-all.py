@@ -1,86 +1,75 @@
-import random
 import numpy as np
 import os
-from os.path import join
+import sys
 import const_rf
 import multiprocessing as mp
-import pandas as pd
-from importlib import import_module
-import tqdm
 
-def parallel(para_list, n_jobs=1):
-    pool = mp.Pool(n_jobs)
-    data_dict = tqdm.tqdm(pool.imap(extract_feature, para_list), total=len(para_list))
-    pool.close()
-    return data_dict
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+from trace_store import TraceStore, is_trace_store, UNMONITORED_SAMPLE
+from trace_catalog import TraceCatalog, index_mask, label_mask
+from rf_dataset import load_dataset
+from rf_extract import (init_worker, extracted_traces, dataset_outputs, write_datasets, extract_feature,
+                        extract_feature_from_store, extract_feature_from_pcap)
 
 
-def extract_feature(para):
-    import sys
-    import os
-    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # project root
-    from FeatureExtraction import packets_per_slot
-    
-    f, feature_func = para
-    file_name = f.split('/')[-1]
-
-    with open(f, 'r') as f:
-        tcp_dump = f.readlines()
-
-    seq = pd.Series(tcp_dump[:const_rf.max_trace_length]) \
-        .str.split(const_rf.split_mark, expand=True) \
-        .apply(pd.to_numeric, errors='coerce')
-    seq = seq.dropna()
-    
-    times = np.array(seq.iloc[:, 0])
-    length_seq = np.array(seq.iloc[:, 1]).astype("int")
-    fun = import_module('FeatureExtraction.' + feature_func)
-    feature = fun.fun(times, length_seq)
-    if '-' in file_name:
-        label = file_name.split('-')
-        label = int(label[0])
-    else:
-        label = const_rf.MONITORED_SITE_NUM
-
-    return feature, label
-
-
-def process_dataset():
+def process_dataset(pool):
     output_dir = const_rf.output_dir + defence + '-' + feature_func
-
-    para_list = []
-
-    for i in range(const_rf.MONITORED_SITE_NUM):
-        for j in range(const_rf.MONITORED_INST_NUM):
-            if os.path.exists(traces_path + str(i) + '-' + str(j)):
-                para_list.append((traces_path + str(i) + '-' + str(j), feature_func))
-
+    outputs = dataset_outputs(output_dir, resolutions)
+    # Traces already extracted, when appending
+    done = extracted_traces([path for path, _, _ in outputs]) if append else np.zeros((0, 2), dtype=np.int32)
+
+    # Traces present, from the store's label table or the catalog of the folder (or of the captures)
+    store = None
+    if pcap_path:
+        source = TraceCatalog.open(pcap_path, separator='_', suffix='.pcap')
+    elif is_trace_store(traces_path):
+        source = store = TraceStore(traces_path)
+    else:
+        source = TraceCatalog.open(traces_path)
+    sites, samples = source.sites, source.samples
+    selected = (sites < const_rf.MONITORED_SITE_NUM) & (samples >= 0) & (samples < const_rf.MONITORED_INST_NUM)
     if const_rf.OPEN_WORLD:
-        for i in range(const_rf.UNMONITORED_SITE_NUM):
-            para_list.append((join(traces_path, str(i)), feature_func))
-
-    random.shuffle(para_list)
-
-    data_dict = {'dataset': [], 'label': []}
-    raw_data_dict = parallel(para_list, n_jobs=15)
-    features, label = zip(*raw_data_dict)
-
-    features = np.array(features)
-    if len(features.shape) < 3:
-        features = features[:, np.newaxis, :]
-    labels = np.array(label)
+        selected |= (samples == UNMONITORED_SAMPLE) & (sites < const_rf.UNMONITORED_SITE_NUM)
+    if index_path:
+        # e.g. the traces left by trace_dedup.py
+        selected &= index_mask(sites, samples, index_path)
+    selected &= ~label_mask(sites, samples, done)
+
+    # In the order of the source: the loaders shuffle at training time
+    traces = np.stack((sites, samples), axis=1)[selected]
+    if pcap_path:
+        para_list = [source.path(i) for i in np.flatnonzero(selected)]
+        worker = extract_feature_from_pcap
+    elif store is not None:
+        para_list = [(traces_path, i) for i in np.flatnonzero(selected)]
+        worker = extract_feature_from_store
+    else:
+        para_list = [source.path(i) for i in np.flatnonzero(selected)]
+        worker = extract_feature
 
-    print("dataset shape:{}, label shape:{}".format(features.shape, labels.shape))
-    data_dict['dataset'], data_dict['label'] = features, labels
-    np.save(output_dir, data_dict)
+    write_datasets(para_list, traces, pool, worker, outputs, defence, feature_func, resolutions, layout, append)
 
-    print('save to %s' % (output_dir + ".npy"))
+    for path, _, _ in outputs:
+        features, labels = load_dataset(path)
+        print("dataset shape:{}, label shape:{}".format(features.shape, labels.shape))
+        print('save to %s' % path)
 
 
 if __name__ == '__main__':
 
     defence = 'Undefence'
-    traces_path = './../../../data/features/'
+    traces_path = './../../../data/features/'  # or a trace store, e.g. './../../../data/traces.store'
+    pcap_path = None  # or the x_y.pcap captures, e.g. './../../../data/output/', to read them instead of traces_path
+    index_path = None  # or a trace index (one x-y per line) to extract only the traces it lists
     feature_func = 'packets_per_slot'
-
-    process_dataset()
+    layout = 'dense'  # or 'sparse': only the non-zero TAM cells are stored (rf_dataset.py)
+    append = False  # or True: only extract the traces the dataset does not hold yet, and append them
+    resolutions = None  # or e.g. [(1800, 80), (900, 40)]: one dataset per (max_matrix_len, maximum_load_time), each trace read once
+    n_jobs = None  # worker processes, all CPUs by default
+
+    pool = mp.Pool(n_jobs, initializer=init_worker, initargs=(feature_func, resolutions))
+    try:
+        process_dataset(pool)
+    finally:
+        pool.close()
+        pool.join()
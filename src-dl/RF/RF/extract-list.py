@@ -1,83 +1,86 @@
 import numpy as np
-
+import os
+import sys
 import const_rf
 import multiprocessing as mp
-import pandas as pd
-from importlib import import_module
-import tqdm
-
-
-def parallel(para_list, n_jobs=1):
-    pool = mp.Pool(n_jobs)
-    data_dict = tqdm.tqdm(pool.imap(extract_feature, para_list), total=len(para_list))
-    pool.close()
-    return data_dict
-
-
-def extract_feature(para):
-    import sys
-    import os
-    sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # project root
-    from FeatureExtraction import packets_per_slot
-    
-    f, feature_func = para
-    file_name = f.split('/')[-1]
-
-    with open(f, 'r') as f:
-        tcp_dump = f.readlines()
-
-    seq = pd.Series(tcp_dump[:const_rf.max_trace_length]) \
-        .str.split(const_rf.split_mark, expand=True) \
-        .apply(pd.to_numeric, errors='coerce')
-    seq = seq.dropna()
-    
-    times = np.array(seq.iloc[:, 0])
-    length_seq = np.array(seq.iloc[:, 1]).astype("int")
-    fun = import_module('FeatureExtraction.' + feature_func)
-    feature = fun.fun(times, length_seq)
-    if '-' in file_name:
-        label = file_name.split('-')
-        label = int(label[0])
-    else:
-        label = const_rf.MONITORED_SITE_NUM
 
-    return feature, label
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+from trace_store import TraceStore, is_trace_store, parse_trace_name
+from trace_catalog import TraceCatalog, read_index
+from rf_dataset import load_dataset
+from rf_extract import (init_worker, extracted_traces, dataset_outputs, write_datasets, extract_feature,
+                        extract_feature_from_store, extract_feature_from_pcap)
 
 
-def process_dataset(file_name, suffix):
+def process_dataset(file_name, suffix, pool):
     output_dir = const_rf.output_dir + defence + '-' + suffix + '-' + feature_func
-
-    para_list = []
+    outputs = dataset_outputs(output_dir, resolutions)
+    # Traces already extracted, when appending
+    done = extracted_traces([path for path, _, _ in outputs]) if append else np.zeros((0, 2), dtype=np.int32)
+    done = set(map(tuple, done.tolist()))
+
+    para_list, traces = [], []
+    # Traces present, from the store's label table or the catalog of the folder (or of the captures)
+    store = None
+    if pcap_path:
+        source = TraceCatalog.open(pcap_path, separator='_', suffix='.pcap')
+        worker = extract_feature_from_pcap
+    elif is_trace_store(traces_path):
+        source = store = TraceStore(traces_path)
+        worker = extract_feature_from_store
+    else:
+        source = TraceCatalog.open(traces_path)
+        worker = extract_feature
+    # e.g. the traces left by trace_dedup.py
+    allowed = set(map(tuple, read_index(index_path).tolist())) if index_path else None
     file = open(file_name, 'r')
     lines = file.readlines()
     for line in lines:
         l = line.strip()
-        para_list.append((traces_path + l, feature_func))
-
-    data_dict = {'dataset': [], 'label': []}
-    raw_data_dict = parallel(para_list, n_jobs=15)
-    features, label = zip(*raw_data_dict)
-
-    features = np.array(features)
-    if len(features.shape) < 3:
-        features = features[:, np.newaxis, :]
-    labels = np.array(label)
-
-    print(suffix + " dataset shape:{}, label shape:{}".format(features.shape, labels.shape))
-    data_dict['dataset'], data_dict['label'] = features, labels
-    np.save(output_dir, data_dict)
-
-    print('save to %s' % (output_dir + ".npy"))
+        label = parse_trace_name(l)
+        if (allowed is not None and label not in allowed) or label in done:
+            continue
+        index = source.index(*label) if label is not None else None
+        if index is None:
+            print('%s not found in %s, skipping' % (l, pcap_path or traces_path))
+            continue
+        if store is None:
+            # Wang14 file or capture
+            para_list.append(source.path(index))
+        else:
+            para_list.append((traces_path, index))
+        traces.append(label)
+    traces = np.array(traces, dtype=np.int32).reshape(-1, 2)
+
+    write_datasets(para_list, traces, pool, worker, outputs, defence, feature_func, resolutions, layout, append)
+
+    for path, _, _ in outputs:
+        features, labels = load_dataset(path)
+        print(suffix + " dataset shape:{}, label shape:{}".format(features.shape, labels.shape))
+        print('save to %s' % path)
 
 
 if __name__ == '__main__':
 
     defence = 'Undefence'
-    traces_path = './../../../data/features/'
+    traces_path = './../../../data/features/'  # or a trace store, e.g. './../../../data/traces.store'
+    pcap_path = None  # or the x_y.pcap captures, e.g. './../../../data/output/', to read them instead of traces_path
+    index_path = None  # or a trace index (one x-y per line): list entries it does not contain are skipped
     feature_func = 'packets_per_slot'
+    layout = 'dense'  # or 'sparse': only the non-zero TAM cells are stored (rf_dataset.py)
+    append = False  # or True: only extract the list entries the datasets do not hold yet, and append them
+    resolutions = None  # or e.g. [(1800, 80), (900, 40)]: one dataset per (max_matrix_len, maximum_load_time), each trace read once
 
     train_name = 'list/Index_train.txt'
     test_name = 'list/Index_test.txt'
 
-    process_dataset(train_name, 'train')
-    process_dataset(test_name, 'test')
+    n_jobs = None  # worker processes, all CPUs by default
+
+    # One pool for both lists
+    pool = mp.Pool(n_jobs, initializer=init_worker, initargs=(feature_func, resolutions))
+    try:
+        process_dataset(train_name, 'train', pool)
+        process_dataset(test_name, 'test', pool)
+    finally:
+        pool.close()
+        pool.join()
@@ -18,10 +18,10 @@ class RF(nn.Module):
 
     def forward(self, x):
         x = self.first_layer(x)
-        x = x.view(x.size(0), self.first_layer_out_channel, -1)
+        x = x.reshape(x.size(0), self.first_layer_out_channel, -1)
         x = self.features(x)
         x = self.classifier(x)
-        x = x.view(x.size(0), -1)
+        x = x.reshape(x.size(0), -1)
         return x
 
     def _initialize_weights(self):
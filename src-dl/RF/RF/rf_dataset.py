@@ -0,0 +1,270 @@
+import os
+import json
+import argparse
+import numpy as np
+
+################################################################################
+# RF dataset format.
+#
+# A dataset is a directory (e.g. dataset/Undefence-packets_per_slot/) of flat
+# arrays, laid out like the trace store (src-dl/trace_store.py):
+#
+#   header.json   format version, layout, number of traces, feature shape and
+#                 dtype, and the extraction parameters
+#   dataset.bin   <dtype>[N, *shape]   features, uint16[N, 2, max_matrix_len] TAMs
+#   label.bin     int32[N]             class of each trace
+#   traces.bin    int32[N, 2]          (site, sample) of each trace, as in the
+#                                      trace store; (-1, -1) if not known
+#
+# The traces are in extraction order: shuffle at training time (the loaders
+# do). Knowing which traces a dataset holds lets the extract scripts append
+# only the new ones (see load_traces).
+#
+# Most TAM cells are zero (page loads rarely fill maximum_load_time), so with
+# layout "sparse" only the non-zero cells are kept, CSR-style:
+#
+#   offsets.bin   int64[N + 1]         cell offsets of each trace
+#   cells.bin     uint16[C] (int32 if a feature has more than 65536 cells)
+#                                      position of each cell in the flattened feature
+#   dataset.bin   <dtype>[C]           value of each cell
+#
+# load_dataset then returns a SparseFeatures, which densifies only the rows
+# it is indexed with, so the loaders still get (B, 2, max_matrix_len) batches.
+#
+# Both arrays are memory-mapped read-only by load_dataset: nothing is read
+# until a batch is used, and batches are only turned into float32 by the
+# loaders (rf_loader.py). Datasets can be appended to; the header is only
+# rewritten when a writer is closed, so readers never see a partial append.
+#
+# Datasets saved by older versions of the extract scripts (a pickled
+# {'dataset', 'label'} dict in one .npy file) are still read.
+################################################################################
+
+DATASET_VERSION = 1
+LAYOUTS = ("dense", "sparse")
+
+HEADER_FILE = "header.json"
+FEATURES_FILE = "dataset.bin"
+LABELS_FILE = "label.bin"
+TRACES_FILE = "traces.bin"
+OFFSETS_FILE = "offsets.bin"
+CELLS_FILE = "cells.bin"
+
+
+def _cell_dtype(shape):
+    return np.dtype(np.uint16) if int(np.prod(shape)) <= 1 << 16 else np.dtype(np.int32)
+
+
+def is_dataset(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def read_header(path):
+    with open(os.path.join(path, HEADER_FILE)) as f:
+        return json.load(f)
+
+
+def _write_header(path, header):
+    tmp = os.path.join(path, HEADER_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(header, f, indent=2)
+    os.replace(tmp, os.path.join(path, HEADER_FILE))
+
+
+def _map(path, name, dtype, shape):
+    """Read-only memmap of a dataset file; empty arrays cannot be mapped"""
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(os.path.join(path, name), dtype=dtype, mode="r", shape=shape)
+
+
+class SparseFeatures:
+    """Read-only view of the features of a sparse dataset; indexing it returns dense rows"""
+
+    def __init__(self, offsets, cells, values, shape):
+        self.offsets = offsets
+        self.cells = cells
+        self.values = values
+        self.shape = (len(offsets) - 1,) + tuple(shape)
+        self.dtype = values.dtype
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, rows):
+        single = np.ndim(rows) == 0 and not isinstance(rows, slice)
+        rows = np.arange(len(self))[rows].reshape(-1)
+        starts, ends = self.offsets[rows], self.offsets[rows + 1]
+        lengths = ends - starts
+        # Position in cells.bin of every cell of the rows, in row order
+        first = np.cumsum(lengths) - lengths
+        cells = np.repeat(starts - first, lengths) + np.arange(int(lengths.sum()))
+        out = np.zeros((len(rows), int(np.prod(self.shape[1:]))), dtype=self.dtype)
+        out[np.repeat(np.arange(len(rows)), lengths), self.cells[cells]] = self.values[cells]
+        out = out.reshape((len(rows),) + self.shape[1:])
+        return out[0] if single else out
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:] if dtype is None else self[:].astype(dtype)
+
+
+def load_dataset(path):
+    """
+    (features, labels) of a dataset, memory-mapped read-only. The features of
+    a sparse dataset are a SparseFeatures.
+    """
+    if not is_dataset(path):
+        if path.endswith(".npy") and is_dataset(path[:-len(".npy")]):
+            path = path[:-len(".npy")]
+        else:
+            # Pickled dict of the older format
+            legacy = path if path.endswith(".npy") else path + ".npy"
+            data = np.load(legacy, allow_pickle=True).item()
+            return data['dataset'], data['label']
+    header = read_header(path)
+    if header["version"] != DATASET_VERSION:
+        raise ValueError(f"Unsupported RF dataset version {header['version']} in {path}")
+    n = header["traces"]
+    if header["shape"] is None:
+        # Nothing was ever added
+        return np.zeros((0,), dtype=np.uint16), np.zeros(0, dtype=np.int32)
+    labels = _map(path, LABELS_FILE, np.int32, (n,))
+    if header["layout"] == "sparse":
+        offsets = _map(path, OFFSETS_FILE, np.int64, (n + 1,))
+        cells = _map(path, CELLS_FILE, _cell_dtype(header["shape"]), (header["cells"],))
+        values = _map(path, FEATURES_FILE, np.dtype(header["dtype"]), (header["cells"],))
+        return SparseFeatures(offsets, cells, values, header["shape"]), labels
+    features = _map(path, FEATURES_FILE, np.dtype(header["dtype"]), (n,) + tuple(header["shape"]))
+    return features, labels
+
+
+def load_traces(path):
+    """(site, sample) int32[N, 2] of the traces of a dataset, memory-mapped read-only"""
+    return _map(path, TRACES_FILE, np.int32, (read_header(path)["traces"], 2))
+
+
+def rollback_dataset(path, n_traces):
+    """Drop the traces appended after the first n_traces (the next writer truncates the files)"""
+    header = read_header(path)
+    if n_traces < header["traces"]:
+        if header["layout"] == "sparse":
+            offsets = _map(path, OFFSETS_FILE, np.int64, (header["traces"] + 1,))
+            header["cells"] = int(offsets[n_traces])
+            del offsets
+        header["traces"] = n_traces
+        _write_header(path, header)
+
+
+class DatasetWriter:
+    """
+    Appends features and labels to a dataset. mode "w" starts a new dataset,
+    mode "a" appends to an existing one (or creates it, keeping its layout).
+    Keyword arguments are recorded in the header of a new dataset, and must
+    match the header of an existing one.
+    """
+
+    def __init__(self, path, mode="w", layout="dense", **info):
+        if layout not in LAYOUTS:
+            raise ValueError(f"Unknown layout '{layout}', expected one of {LAYOUTS}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        if mode == "a" and is_dataset(path):
+            self.header = read_header(path)
+            changed = {k: v for k, v in info.items() if k in self.header and self.header[k] != v}
+            if changed:
+                raise ValueError(f"Cannot append to {path}: {changed} differ from its header")
+        else:
+            self.header = {"version": DATASET_VERSION, "layout": layout, "traces": 0, "cells": 0,
+                           "shape": None, "dtype": None}
+            self.header.update(info)
+            for name in (FEATURES_FILE, LABELS_FILE, TRACES_FILE, OFFSETS_FILE, CELLS_FILE):
+                open(os.path.join(path, name), "wb").close()
+            if layout == "sparse":
+                np.zeros(1, dtype=np.int64).tofile(os.path.join(path, OFFSETS_FILE))
+            _write_header(path, self.header)
+        self.layout = self.header["layout"]
+
+        # Drop whatever an interrupted writer appended after the last header
+        header, n = self.header, self.header["traces"]
+        self._truncate(LABELS_FILE, n * 4)
+        self._truncate(TRACES_FILE, n * 8)
+        if header["shape"] is None:
+            pass
+        elif self.layout == "sparse":
+            self._truncate(OFFSETS_FILE, (n + 1) * 8)
+            self._truncate(CELLS_FILE, header["cells"] * _cell_dtype(header["shape"]).itemsize)
+            self._truncate(FEATURES_FILE, header["cells"] * np.dtype(header["dtype"]).itemsize)
+        else:
+            self._truncate(FEATURES_FILE, n * int(np.prod(header["shape"])) * np.dtype(header["dtype"]).itemsize)
+        self._files = {name: open(os.path.join(path, name), "ab")
+                       for name in (FEATURES_FILE, LABELS_FILE, TRACES_FILE, OFFSETS_FILE, CELLS_FILE)}
+
+    def _truncate(self, name, size):
+        with open(os.path.join(self.path, name), "ab") as f:
+            f.truncate(size)
+
+    def add(self, features, labels, traces=None):
+        """Append features with their labels and (site, sample) traces int32[n, 2], if known"""
+        features = np.asarray(features)
+        labels = np.asarray(labels, dtype=np.int32).reshape(-1)
+        traces = np.full((labels.shape[0], 2), -1, dtype=np.int32) if traces is None \
+            else np.asarray(traces, dtype=np.int32).reshape(-1, 2)
+        if not features.shape[0] == labels.shape[0] == traces.shape[0]:
+            raise ValueError("features, labels and traces must have the same length")
+        header = self.header
+        if header["shape"] is None:
+            header["shape"], header["dtype"] = list(features.shape[1:]), features.dtype.str
+        elif list(features.shape[1:]) != header["shape"]:
+            raise ValueError(f"Feature shape {features.shape[1:]} does not match the dataset's {header['shape']}")
+
+        if self.layout == "sparse":
+            flat = features.reshape(features.shape[0], -1)
+            owner, cells = np.nonzero(flat)
+            ends = header["cells"] + np.cumsum(np.bincount(owner, minlength=flat.shape[0]))
+            self._files[OFFSETS_FILE].write(ends.astype(np.int64).tobytes())
+            self._files[CELLS_FILE].write(cells.astype(_cell_dtype(header["shape"])).tobytes())
+            self._files[FEATURES_FILE].write(flat[owner, cells].astype(header["dtype"]).tobytes())
+            header["cells"] += cells.size
+        else:
+            self._files[FEATURES_FILE].write(np.ascontiguousarray(features, dtype=header["dtype"]).tobytes())
+        self._files[LABELS_FILE].write(labels.tobytes())
+        self._files[TRACES_FILE].write(traces.tobytes())
+        header["traces"] += labels.shape[0]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        _write_header(self.path, self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+################################################################################
+def convert_dataset(src, dst, layout="sparse", chunk=4096):
+    """Copy a dataset (or an older .npy one) into a new dataset with the given layout"""
+    features, labels = load_dataset(src)
+    info = {k: v for k, v in read_header(src).items() if k not in ("version", "layout", "traces", "cells", "shape", "dtype")} \
+        if is_dataset(src) else {}
+    traces = load_traces(src) if is_dataset(src) else None
+    with DatasetWriter(dst, layout=layout, **info) as writer:
+        for start in range(0, len(labels), chunk):
+            writer.add(features[start:start + chunk], labels[start:start + chunk],
+                       None if traces is None else traces[start:start + chunk])
+    return writer.header
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert an RF dataset between the dense and sparse layouts.")
+    parser.add_argument("src", help="Dataset folder, or .npy dataset of an older version.")
+    parser.add_argument("dst", help="New dataset folder.")
+    parser.add_argument("-l", "--layout", choices=LAYOUTS, default="sparse", help="Layout of the new dataset.")
+    args = parser.parse_args()
+
+    header = convert_dataset(args.src, args.dst, args.layout)
+    size = lambda path: sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    src_size = size(args.src) if os.path.isdir(args.src) else os.path.getsize(args.src)
+    print(f"{header['traces']} traces, {args.layout}: {src_size / 2 ** 20:.1f} MB -> {size(args.dst) / 2 ** 20:.1f} MB")
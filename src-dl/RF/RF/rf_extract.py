@@ -0,0 +1,174 @@
+import os
+import sys
+import numpy as np
+import const_rf
+from importlib import import_module
+from functools import partial
+import tqdm
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # RF.const_rf, for FeatureExtraction
+from trace_store import TraceStore, parse_trace_name, UNMONITORED_SAMPLE
+from wang14 import read_trace, drop_empty
+from pcap_decoder import decode_trace, UnsupportedCapture
+from rf_dataset import DatasetWriter, is_dataset, load_traces
+
+################################################################################
+# Feature extraction shared by extract-all.py and extract-list.py.
+#
+# The scripts only pick the traces to extract; this module turns them into
+# datasets: a multiprocessing pool (initializer init_worker) runs one of the
+# extract_feature* workers per trace, from a Wang14 file, a trace store or a
+# capture, and parallel() appends the results to one DatasetWriter per
+# resolution (see rf_dataset.py).
+################################################################################
+
+WRITE_ROWS = 4096  # rows copied from the worker output to the dataset at once
+
+
+def single(fun, times, sizes):
+    return [fun(times, sizes)]
+
+
+def init_worker(feature_func, resolutions=None):
+    # Resolved once per worker process, not once per trace. feature_fun returns
+    # the feature at every resolution (the const_rf one without resolutions)
+    global feature_fun
+    module = import_module('FeatureExtraction.' + feature_func)
+    if resolutions is None:
+        feature_fun = partial(single, module.fun)
+    else:
+        feature_fun = partial(module.fun_multi, resolutions=resolutions)
+
+
+rows_paths, rows = None, None
+
+
+def open_rows(paths):
+    # Outputs of the current dataset, opened once per worker process
+    global rows_paths, rows
+    if paths != rows_paths:
+        rows_paths, rows = paths, [np.load(path, mmap_mode='r+') for path in paths]
+    return rows
+
+
+def write_row(para):
+    worker, paths, row, item = para
+    result = worker(item)
+    if result is None:
+        return None
+    features, label = result
+    for out, feature in zip(open_rows(paths), features):
+        out[row] = feature
+    return label
+
+
+def extracted_traces(paths):
+    """(site, sample) of the traces the datasets at paths already hold (none if they do not exist yet)"""
+    existing = [load_traces(path) for path in paths if is_dataset(path)]
+    if not existing:
+        return np.zeros((0, 2), dtype=np.int32)
+    if len(existing) != len(paths) or any(len(traces) != len(existing[0]) for traces in existing):
+        raise ValueError('%s were not extracted together, extract them again without append' % ', '.join(paths))
+    return np.asarray(existing[0])
+
+
+def parallel(para_list, traces, pool, worker, writers, feature_func, resolutions=None):
+    """
+    Run worker over para_list on the pool (initialized with init_worker) and
+    append the features of the items that were not skipped, with their
+    (site, sample) traces, to writers (rf_dataset.DatasetWriter, one per
+    resolution). Each feature is written in place into an .npy memmap of all
+    the rows instead of being sent back to the parent.
+    """
+    init_worker(feature_func, resolutions)
+    templates = [np.asarray(t) for t in feature_fun(np.zeros(0), np.zeros(0, dtype=np.int32))]
+    paths = tuple(writer.path + '.rows.npy' for writer in writers)
+    outs = [np.lib.format.open_memmap(path, mode='w+', dtype=template.dtype, shape=(len(para_list),) + template.shape)
+            for path, template in zip(paths, templates)]
+
+    items = [(worker, paths, row, item) for row, item in enumerate(para_list)]
+    labels = list(tqdm.tqdm(pool.imap(write_row, items, chunksize=16), total=len(items)))
+
+    kept = np.flatnonzero([l is not None for l in labels])
+    for out, template, writer in zip(outs, templates, writers):
+        if template.ndim < 2:
+            out = out[:, np.newaxis]
+        for start in range(0, len(kept), WRITE_ROWS):
+            rows = kept[start:start + WRITE_ROWS]
+            writer.add(out[rows], [labels[row] for row in rows], traces[rows])
+    del outs, out
+    for path in paths:
+        os.remove(path)
+
+
+def extract_feature(f):
+    file_name = os.path.basename(f)
+
+    # Only the first max_trace_length lines are read and parsed
+    times, length_seq = read_trace(f, const_rf.max_trace_length)
+    features = feature_fun(times, length_seq)
+    if '-' in file_name:
+        label = file_name.split('-')
+        label = int(label[0])
+    else:
+        label = const_rf.MONITORED_SITE_NUM
+
+    return features, label
+
+
+def extract_feature_from_store(para):
+    store_path, index = para
+    store = TraceStore.open(store_path)
+    times, length_seq = drop_empty(*store.trace(index, const_rf.max_trace_length))
+    features = feature_fun(times, length_seq)
+    site, sample = store.labels[index]
+    if sample != UNMONITORED_SAMPLE:
+        label = int(site)
+    else:
+        label = const_rf.MONITORED_SITE_NUM
+
+    return features, label
+
+
+def extract_feature_from_pcap(f):
+    site, sample = parse_trace_name(os.path.basename(f)[:-len('.pcap')], '_')
+    try:
+        # Same decoding as 2_extract_features.py (detected client IP, zero payloads dropped)
+        times, length_seq, _ = decode_trace(f)
+    except UnsupportedCapture as e:
+        print('%s: %s, skipping' % (f, e))
+        return None
+    # Same packets and microsecond precision as the Wang14 file of the capture
+    times = np.rint(times[:const_rf.max_trace_length] * 1e6) / 1e6
+    times, length_seq = drop_empty(times, length_seq[:const_rf.max_trace_length])
+    features = feature_fun(times, length_seq)
+    if sample != UNMONITORED_SAMPLE:
+        label = site
+    else:
+        label = const_rf.MONITORED_SITE_NUM
+
+    return features, label
+
+
+def dataset_outputs(output_dir, resolutions=None):
+    """(path, max_matrix_len, maximum_load_time) of the datasets extracted to output_dir"""
+    if resolutions is None:
+        return [(output_dir, const_rf.max_matrix_len, const_rf.maximum_load_time)]
+    # One dataset per resolution, e.g. Undefence-packets_per_slot-1800-80
+    return [(output_dir + '-%d-%g' % (matrix_len, load_time), matrix_len, load_time)
+            for matrix_len, load_time in resolutions]
+
+
+def write_datasets(para_list, traces, pool, worker, outputs, defence, feature_func, resolutions=None,
+                   layout='dense', append=False):
+    """Extract para_list with worker into the datasets of dataset_outputs, new or appended to"""
+    writers = [DatasetWriter(path, 'a' if append else 'w', layout=layout, defence=defence, feature=feature_func,
+                             max_matrix_len=matrix_len, maximum_load_time=load_time,
+                             max_trace_length=const_rf.max_trace_length)
+               for path, matrix_len, load_time in outputs]
+    try:
+        parallel(para_list, traces, pool, worker, writers, feature_func, resolutions)
+    finally:
+        for writer in writers:
+            writer.close()
@@ -0,0 +1,141 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+import torch
+from torch.nn import functional as F
+import const_rf as const
+from models.RF import getRF
+from rf_dataset import load_dataset
+from rf_loader import batch_loader
+from rf_quantize import load_quantized
+
+################################################################################
+# Batched RF inference.
+#
+# predict() runs a trained model over a dataset a batch at a time (in
+# inference mode, on the given number of threads) and streams one row per
+# trace to a writer as it goes:
+#
+#   [label, predicted class]            by default
+#   [label, softmax of every class]     with softmax=True (open world)
+#
+# so nothing but the current batch is held in memory. Rows go to a CSV file
+# (the format of result/, read by pre_recall.py) or to a .npy file of
+# float32[N, 2] or float32[N, 1 + classes], filled in place.
+################################################################################
+
+BATCH_SIZE = 512
+NUM_WORKERS = 0             # DataLoader processes reading the batches
+LOG_BATCHES = 100           # batches between two throughput reports
+
+
+def load_model(class_num, path, device, quantized=False):
+    """Trained model (path without .pth); quantized for an int8 model saved by rf_quantize.py, run on the CPU"""
+    if quantized:
+        return load_quantized(class_num, path)
+    model = getRF(class_num)
+    state_dict = torch.load(path + '.pth', map_location=device, weights_only=True)
+    model.load_state_dict(state_dict)
+    return model.to(device).eval()
+
+
+class PredictionWriter:
+    """Streams prediction rows to a .csv file, or to a .npy file of n_rows rows (sized by the first write)"""
+
+    def __init__(self, path, n_rows):
+        self.path = path
+        self.n_rows = n_rows
+        self._row = 0
+        self._array = None
+        if path.endswith('.npy'):
+            self._file = None
+        else:
+            self._file = open(path, 'w', encoding='utf-8', newline='')
+            self._csv = csv.writer(self._file)
+
+    def write(self, labels, values):
+        """labels int[B], values int[B] (predictions) or float[B, C] (softmax vectors)"""
+        if self._file is None:
+            if self._array is None:
+                n_cols = 1 + (values.shape[1] if values.ndim > 1 else 1)
+                self._array = np.lib.format.open_memmap(self.path, mode='w+', dtype=np.float32,
+                                                        shape=(self.n_rows, n_cols))
+            rows = self._array[self._row:self._row + len(labels)]
+            rows[:, 0] = labels
+            rows[:, 1:] = values.reshape(len(labels), -1)
+        elif values.ndim == 1:
+            self._csv.writerows(zip(labels.tolist(), values.tolist()))
+        else:
+            self._csv.writerows([label] + row for label, row in zip(labels.tolist(), values.tolist()))
+        self._row += len(labels)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+        elif self._array is not None:
+            self._array.flush()
+            self._array = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_predictions(path):
+    """Rows written by a PredictionWriter, as a float array (memory-mapped for .npy)"""
+    if path.endswith('.npy'):
+        return np.load(path, mmap_mode='r')
+    return np.loadtxt(path, delimiter=',', ndmin=2, dtype=np.float32)
+
+
+def predict(model, features, labels, out_path, batch_size=BATCH_SIZE, threads=None, softmax=False,
+            num_workers=NUM_WORKERS, device=torch.device('cpu')):
+    """
+    Writes the prediction (or softmax) row of every trace to out_path, and
+    returns the throughput report: traces, seconds, traces/s and accuracy.
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    loader = batch_loader(features, labels, batch_size, num_workers=num_workers)
+
+    correct, done = 0, 0
+    start = time.perf_counter()
+    with torch.inference_mode(), PredictionWriter(out_path, len(labels)) as writer:
+        for step, (x, y) in enumerate(loader):
+            output = model(x.to(device))
+            pred = output.argmax(1).cpu()
+            values = F.softmax(output, dim=1).cpu().numpy() if softmax else pred.numpy()
+            writer.write(y.numpy(), values)
+            correct += (pred == y).sum().item()
+            done += len(y)
+            if (step + 1) % LOG_BATCHES == 0:
+                print('%d/%d traces, %.0f traces/s' % (done, len(labels), done / (time.perf_counter() - start)))
+
+    seconds = time.perf_counter() - start
+    report = {'traces': done, 'seconds': seconds, 'traces/s': done / seconds if seconds else 0.0,
+              'accuracy': correct / done if done else 0.0}
+    print('%d traces in %.1f s: %.0f traces/s, accuracy %.4f' % (done, seconds, report['traces/s'], report['accuracy']))
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run a trained RF model over a dataset, a batch at a time.')
+    parser.add_argument('model', help='Trained model, without .pth (e.g. pretrained/Undefence).')
+    parser.add_argument('dataset', help='Dataset folder (e.g. dataset/Undefence-packets_per_slot).')
+    parser.add_argument('out', help='Output .csv or .npy file.')
+    parser.add_argument('--classes', type=int, default=const.num_classes, help='Classes of the model.')
+    parser.add_argument('--int8', action='store_true', help='The model is an int8 one saved by rf_quantize.py.')
+    parser.add_argument('--softmax', action='store_true', help='Write softmax vectors instead of predictions.')
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help='Traces per forward pass.')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count(), help='Torch threads.')
+    parser.add_argument('-w', '--num-workers', type=int, default=NUM_WORKERS, help='DataLoader processes.')
+    args = parser.parse_args()
+
+    device = torch.device('cuda:0' if torch.cuda.is_available() and not args.int8 else 'cpu')
+    model = load_model(args.classes, args.model, device, args.int8)
+    features, labels = load_dataset(args.dataset)
+    predict(model, features, labels, args.out, args.batch_size, args.threads, args.softmax, args.num_workers, device)
@@ -0,0 +1,199 @@
+import os
+import sys
+import json
+import hashlib
+from collections import OrderedDict
+import numpy as np
+import torch
+import torch.utils.data as Data
+import const_rf
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # RF.const_rf, for FeatureExtraction
+from trace_store import TraceStore
+from trace_catalog import class_selection
+from FeatureExtraction import packets_per_slot
+
+################################################################################
+# Batch loaders over (memory-mapped) RF datasets.
+#
+# The features stay in their stored dtype (uint16 TAMs, see rf_dataset.py)
+# until a batch is fetched: only that batch is read and turned into a float32
+# (B, 1, 2, max_matrix_len) tensor, so training never holds a float copy of
+# the whole dataset.
+#
+# StoreTams skips the extraction step altogether: it computes the TAMs of
+# each batch from a trace store in the DataLoader workers, while the model
+# trains on the previous batches.
+################################################################################
+
+CACHE_TAMS = 10000          # TAMs kept in memory by each loader process (7 KB each at 1800 slots)
+CACHE_STORE_FILE = 'store.json'
+
+
+def store_fingerprint(store, n_traces=None):
+    """Hash of the labels and packet offsets of the first n_traces traces (all by default) of a trace store"""
+    n_traces = len(store) if n_traces is None else n_traces
+    digest = hashlib.sha1(np.ascontiguousarray(store.labels[:n_traces]).tobytes())
+    digest.update(np.ascontiguousarray(store.offsets[:n_traces + 1]).tobytes())
+    return digest.hexdigest()
+
+
+class TamBatches(Data.Dataset):
+    """Dataset whose items are whole batches: dataset[positions] -> (x float32, y int64)"""
+
+    def __init__(self, features, labels, indices=None):
+        self.features = features
+        self.labels = labels
+        self.indices = np.arange(len(labels)) if indices is None else np.asarray(indices)
+
+    def __len__(self):
+        return len(self.indices)
+
+    def __getitem__(self, batch):
+        rows = self.indices[batch]
+        x = torch.from_numpy(np.asarray(self.features[rows], dtype=np.float32)).unsqueeze(1)
+        y = torch.from_numpy(np.asarray(self.labels[rows], dtype=np.int64))
+        return x, y
+
+
+class StoreTams(Data.Dataset):
+    """
+    Like TamBatches, but the TAMs of each batch are computed from the traces of
+    a trace store (the ones extract-all.py would extract by default). Every
+    process keeps the last cache_size TAMs it computed, keyed by trace and TAM
+    parameters. With cache_dir, computed TAMs are also kept on disk, in one
+    file per parameter set that the workers and later runs share. The cache
+    records the store it was built from (store_fingerprint): it is kept when
+    the store only grew, and dropped when the store was rebuilt or is another
+    one, since trace i would then be another trace.
+    """
+
+    def __init__(self, store_path, indices=None, matrix_len=const_rf.max_matrix_len,
+                 load_time=const_rf.maximum_load_time, trace_length=const_rf.max_trace_length,
+                 cache_size=CACHE_TAMS, cache_dir=None):
+        store = TraceStore(store_path)
+        self.store_path = store_path
+        self.indices, self.labels = class_selection(
+            store.sites, store.samples, const_rf.MONITORED_SITE_NUM, const_rf.MONITORED_INST_NUM,
+            const_rf.UNMONITORED_SITE_NUM if const_rf.OPEN_WORLD else 0, indices=indices)
+        self.params = (matrix_len, load_time, trace_length)
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+
+        self._disk_path = None
+        if cache_dir:
+            self._disk_path = os.path.join(cache_dir, '%d-%g-%d' % self.params)
+            os.makedirs(self._disk_path, exist_ok=True)
+            self._check_disk_cache(store)
+            # Sized to the store, so traces appended since the last run start as not computed
+            for name, row_bytes in (('tams.bin', 4 * matrix_len), ('done.bin', 1)):
+                with open(os.path.join(self._disk_path, name), 'ab') as f:
+                    f.truncate(max(os.path.getsize(f.name), len(store) * row_bytes))
+            self._write_disk_record(store)
+            self._n_traces = len(store)
+        self._disk = None
+
+    def __len__(self):
+        return len(self.indices)
+
+    def _check_disk_cache(self, store):
+        """Empties the disk cache if it was not built from (the first traces of) this store"""
+        record_path = os.path.join(self._disk_path, CACHE_STORE_FILE)
+        record = None
+        if os.path.isfile(record_path):
+            with open(record_path) as f:
+                record = json.load(f)
+        if record is not None and record['traces'] <= len(store) \
+                and record['fingerprint'] == store_fingerprint(store, record['traces']):
+            return
+        if record is not None or os.path.isfile(os.path.join(self._disk_path, 'done.bin')):
+            print('[INFO] TAM cache %s was built from another store, starting it over' % self._disk_path)
+        for name in ('done.bin', 'tams.bin'):
+            open(os.path.join(self._disk_path, name), 'wb').close()
+
+    def _write_disk_record(self, store):
+        tmp = os.path.join(self._disk_path, CACHE_STORE_FILE + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'store': os.path.abspath(self.store_path), 'traces': len(store),
+                       'fingerprint': store_fingerprint(store)}, f)
+        os.replace(tmp, os.path.join(self._disk_path, CACHE_STORE_FILE))
+
+    def __getstate__(self):
+        # Memmaps are opened again in every worker
+        state = self.__dict__.copy()
+        state['_disk'], state['_cache'] = None, OrderedDict()
+        return state
+
+    def _open_disk(self):
+        if self._disk is None:
+            tams = np.memmap(os.path.join(self._disk_path, 'tams.bin'), dtype=np.uint16, mode='r+',
+                             shape=(self._n_traces, 2, self.params[0]))
+            done = np.memmap(os.path.join(self._disk_path, 'done.bin'), dtype=np.uint8, mode='r+',
+                             shape=(self._n_traces,))
+            self._disk = tams, done
+        return self._disk
+
+    def _remember(self, key, tam):
+        self._cache[key] = tam
+        if len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def tams(self, traces):
+        """uint16 TAMs of store traces, from the caches or computed"""
+        matrix_len, load_time, trace_length = self.params
+        out = np.empty((len(traces), 2, matrix_len), dtype=np.uint16)
+        disk = self._open_disk() if self._disk_path else None
+        missing = []
+        for k, i in enumerate(traces.tolist()):
+            key = (i,) + self.params
+            tam = self._cache.get(key)
+            if tam is not None:
+                self._cache.move_to_end(key)
+                out[k] = tam
+            elif disk is not None and disk[1][i]:
+                out[k] = disk[0][i]
+                self._remember(key, out[k].copy())
+            else:
+                missing.append(k)
+        if not missing:
+            return out
+
+        store = TraceStore.open(self.store_path)
+        read = [store.trace(i, trace_length) for i in traces[missing].tolist()]
+        offsets = np.concatenate(([0], np.cumsum([len(times) for times, _ in read])))
+        computed = packets_per_slot.fun_batch(np.concatenate([times for times, _ in read]),
+                                              np.concatenate([sizes for _, sizes in read]), offsets,
+                                              matrix_len=matrix_len, load_time=load_time)
+        out[missing] = computed
+        for i, tam in zip(traces[missing].tolist(), computed):
+            self._remember((i,) + self.params, tam)
+            if disk is not None:
+                disk[0][i] = tam
+                disk[1][i] = 1
+        return out
+
+    def __getitem__(self, batch):
+        x = torch.from_numpy(self.tams(self.indices[batch]).astype(np.float32)).unsqueeze(1)
+        y = torch.from_numpy(self.labels[batch])
+        return x, y
+
+
+def _loader(dataset, batch_size, shuffle, num_workers, pin_memory):
+    sampler = Data.RandomSampler(dataset) if shuffle else Data.SequentialSampler(dataset)
+    # Persistent workers keep their caches from one epoch to the next
+    return Data.DataLoader(dataset, sampler=Data.BatchSampler(sampler, batch_size, drop_last=False),
+                           batch_size=None, num_workers=num_workers, persistent_workers=num_workers > 0,
+                           pin_memory=pin_memory)
+
+
+def batch_loader(features, labels, batch_size, shuffle=False, indices=None, num_workers=0, pin_memory=False):
+    """DataLoader of (x, y) batches of the given rows (all by default), read and converted per batch"""
+    return _loader(TamBatches(features, labels, indices), batch_size, shuffle, num_workers, pin_memory)
+
+
+def store_loader(store_path, batch_size, shuffle=False, indices=None, num_workers=0, pin_memory=False,
+                 cache_dir=None, **params):
+    """DataLoader of (x, y) batches of TAMs computed from a trace store (StoreTams)"""
+    return _loader(StoreTams(store_path, indices, cache_dir=cache_dir, **params), batch_size, shuffle,
+                   num_workers, pin_memory)
@@ -0,0 +1,261 @@
+import os
+import sys
+import csv
+import argparse
+import numpy as np
+import const_rf
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))  # RF.const_rf, for FeatureExtraction
+from trace_store import TraceStore
+from trace_catalog import class_selection
+from FeatureExtraction import packets_per_slot
+
+################################################################################
+# Anytime RF inference during a page load.
+#
+# A TAM only counts packets per time slot, so it can be built while the page
+# loads: OnlineTam adds packets as they arrive, and is at any time the TAM
+# packets_per_slot.fun would compute from the packets seen so far. A Visit
+# scores its TAM every INTERVAL seconds (checkpoints INTERVAL, 2 * INTERVAL,
+# ... up to maximum_load_time, each one scoring the packets before it) and
+# stops at the first checkpoint whose top softmax probability reaches
+# THRESHOLD; a visit that never gets there is decided on its whole trace.
+#
+# evaluate() replays the traces of a trace store through the same
+# checkpoints, a batch of traces at a time, and reports per checkpoint the
+# accuracy of the model and the share of decided visits, then the
+# time-to-decision and accuracy of the early decisions:
+#
+#   python rf_online.py pretrained/Undefence.onnx ./../../../data/traces.store -i list/Index_test.txt
+#
+# Models are given as a scores function: TAMs uint16[B, 2, matrix_len] ->
+# float32[B, classes], e.g. rf_ort.OrtRF(path).scores (no PyTorch needed).
+################################################################################
+
+INTERVAL = 2.0              # seconds between two checkpoints
+THRESHOLD = 0.9             # softmax probability deciding a visit
+BATCH_SIZE = 256            # traces replayed at once by evaluate
+
+
+def softmax(scores):
+    e = np.exp(scores - scores.max(1, keepdims=True))
+    return e / e.sum(1, keepdims=True)
+
+
+def checkpoints(interval=INTERVAL, load_time=const_rf.maximum_load_time):
+    """Times a visit is scored at before its end"""
+    return interval * np.arange(1, int(load_time / interval) + 1)
+
+
+class OnlineTam:
+    """TAM of one page load, built as its packets (in time order) arrive"""
+
+    def __init__(self, matrix_len=const_rf.max_matrix_len, load_time=const_rf.maximum_load_time,
+                 trace_length=const_rf.max_trace_length):
+        self.params = (matrix_len, load_time)
+        self.trace_length = trace_length
+        self.counts = np.zeros(2 * matrix_len, dtype=np.int64)
+        self.packets = 0
+
+    def add(self, times, sizes):
+        # Packets after the first trace_length are not in a TAM
+        room = self.trace_length - self.packets
+        times, sizes = np.asarray(times)[:room], np.asarray(sizes)[:room]
+        self.packets += len(times)
+        cells, kept = packets_per_slot._cells(times, sizes, *self.params)
+        self.counts += np.bincount(cells[kept], minlength=len(self.counts))
+
+    @property
+    def tam(self):
+        """uint16[2, matrix_len], as packets_per_slot.fun"""
+        return np.minimum(self.counts, packets_per_slot.MAX_COUNT).astype(np.uint16).reshape(2, -1)
+
+
+class Visit:
+    """
+    One page load scored as it goes. Feed it its packets with add() (times in
+    seconds since the start of the load) and the current time with advance()
+    when no packet comes; decision is (time, class, probability) once made.
+    """
+
+    def __init__(self, scores, interval=INTERVAL, threshold=THRESHOLD, **tam_params):
+        self.scores = scores
+        self.tam = OnlineTam(**tam_params)
+        self.threshold = threshold
+        self.checks = checkpoints(interval, self.tam.params[1])
+        self.history = []       # (time, class, probability) at every checkpoint
+        self.decision = None
+
+    def _score(self, time, final=False):
+        probs = softmax(self.scores(self.tam.tam[np.newaxis]))[0]
+        result = (float(time), int(probs.argmax()), float(probs.max()))
+        self.history.append(result)
+        if final or result[2] >= self.threshold:
+            self.decision = result
+
+    def advance(self, now):
+        """Scores the checkpoints up to now"""
+        while self.decision is None and len(self.history) < len(self.checks) and self.checks[len(self.history)] <= now:
+            self._score(self.checks[len(self.history)])
+        return self.decision
+
+    def add(self, times, sizes):
+        """Adds packets, scoring every checkpoint they go past; returns the decision once made"""
+        times, sizes = np.asarray(times), np.asarray(sizes)
+        while self.decision is None and len(times) and len(self.history) < len(self.checks):
+            # Packets before the next checkpoint
+            k = np.searchsorted(times, self.checks[len(self.history)])
+            if k == len(times):
+                break
+            self.tam.add(times[:k], sizes[:k])
+            times, sizes = times[k:], sizes[k:]
+            self.advance(times[0])
+        if self.decision is None:
+            self.tam.add(times, sizes)
+        return self.decision
+
+    def finish(self, now):
+        """End of the page load at time now: scores the whole trace if nothing was decided"""
+        self.advance(now)
+        if self.decision is None:
+            self._score(now, final=True)
+        return self.decision
+
+
+################################################################################
+def replay(scores, store, indices, interval=INTERVAL, batch_size=BATCH_SIZE):
+    """
+    (probs float32[N, K + 1, classes], ends float64[N]): softmax of every trace
+    at each of the K checkpoints and on its whole trace, and the time of its
+    last packet. Same TAMs as a Visit, computed a batch of traces at a time.
+    """
+    matrix_len, load_time, trace_length = const_rf.max_matrix_len, const_rf.maximum_load_time, const_rf.max_trace_length
+    cuts = list(checkpoints(interval, load_time)) + [np.inf]
+    probs, ends = [], []
+    for first in range(0, len(indices), batch_size):
+        read = [store.trace(i, trace_length) for i in indices[first:first + batch_size].tolist()]
+        offsets = np.concatenate(([0], np.cumsum([len(t) for t, _ in read])))
+        times = np.concatenate([t for t, _ in read])
+        sizes = np.concatenate([s for _, s in read])
+        # Zero-size packets are not counted: blank those after the checkpoint
+        batch = [softmax(scores(packets_per_slot.fun_batch(times, np.where(times < cut, sizes, 0), offsets,
+                                                           matrix_len=matrix_len, load_time=load_time)))
+                 for cut in cuts]
+        probs.append(np.stack(batch, axis=1))
+        ends.append([t.max() if len(t) else 0.0 for t, _ in read])
+    return np.concatenate(probs), np.concatenate(ends)
+
+
+def decide(probs, ends, interval=INTERVAL, threshold=THRESHOLD):
+    """
+    (step int[N], decided_at float64[N]) of the replayed traces, as a Visit
+    decides: at the first checkpoint reaching the threshold before the end of
+    the load (step K for none), else on the whole trace when the load ends.
+    """
+    cuts = checkpoints(interval)
+    # Checkpoints after the last packet are never scored: the load is over
+    confident = (probs[:, :-1].max(2) >= threshold) & (cuts[np.newaxis, :] <= ends[:, np.newaxis])
+    step = np.where(confident.any(1), confident.argmax(1), len(cuts))
+    decided_at = np.where(step < len(cuts), cuts[np.minimum(step, len(cuts) - 1)], ends)
+    return step, decided_at
+
+
+def check(scores, store, indices, step, decided_at, probs, interval=INTERVAL, threshold=THRESHOLD):
+    """Replays traces packet by packet through a Visit; True if it decides as decide() did"""
+    trace_length = const_rf.max_trace_length
+    mismatches = 0
+    for n, i in enumerate(np.asarray(indices).tolist()):
+        times, sizes = store.trace(i, trace_length)
+        visit = Visit(scores, interval, threshold)
+        visit.add(times, sizes)
+        time, label, _ = visit.finish(times.max() if len(times) else 0.0)
+        if not (np.isclose(time, decided_at[n]) and label == probs[n, step[n]].argmax()):
+            mismatches += 1
+            print('trace %d: Visit decides %d at %g s, the replay %d at %g s'
+                  % (i, label, time, probs[n, step[n]].argmax(), decided_at[n]))
+    print('%d traces replayed packet by packet: %s' % (len(indices), 'MISMATCH' if mismatches else 'OK'))
+    return not mismatches
+
+
+def evaluate(scores, store_path, index_path=None, interval=INTERVAL, threshold=THRESHOLD,
+             batch_size=BATCH_SIZE, report_path=None, check_traces=0):
+    """
+    Time-to-decision and accuracy per checkpoint of the traces of a store (all
+    of them, or an index); the first check_traces of them are also replayed
+    through a Visit, which must decide the same.
+    """
+    store = TraceStore(store_path)
+    indices, labels = class_selection(store.sites, store.samples, const_rf.MONITORED_SITE_NUM,
+                                      const_rf.MONITORED_INST_NUM,
+                                      const_rf.UNMONITORED_SITE_NUM if const_rf.OPEN_WORLD else 0,
+                                      index_path=index_path)
+    probs, ends = replay(scores, store, indices, interval, batch_size)
+    cuts = checkpoints(interval)
+    pred, conf = probs.argmax(2), probs.max(2)
+    correct = pred == labels[:, np.newaxis]
+
+    step, decided_at = decide(probs, ends, interval, threshold)
+    rows = np.arange(len(labels))
+    decided_right = correct[rows, step]
+    if check_traces and not check(scores, store, indices[:check_traces], step, decided_at, probs, interval, threshold):
+        raise SystemExit('the replay does not decide as Visit does')
+
+    table = []
+    for k, cut in enumerate(cuts):
+        done = step <= k
+        table.append([cut, correct[:, k].mean(), conf[:, k].mean(), done.mean(),
+                      decided_right[done].mean() if done.any() else float('nan')])
+    table.append(['end', correct[:, -1].mean(), conf[:, -1].mean(), 1.0, decided_right.mean()])
+    header = ['checkpoint', 'accuracy', 'mean_probability', 'decided', 'decision_accuracy']
+
+    print('%d traces, checkpoints every %g s, threshold %g' % (len(labels), interval, threshold))
+    print('%10s %9s %9s %8s %9s' % ('time', 'accuracy', 'mean_prob', 'decided', 'dec_acc'))
+    for row in table:
+        print('%10s %9.4f %9.4f %8.4f %9.4f' % (row[0] if row[0] == 'end' else '%g s' % row[0], *row[1:]))
+    early = step < len(cuts)
+    print('decided early: %.2f%%, time to decision: mean %.2f s, median %.2f s (full loads: mean %.2f s)'
+          % (100 * early.mean(), decided_at.mean(), np.median(decided_at), ends.mean()))
+    print('decision accuracy %.4f, whole-trace accuracy %.4f' % (decided_right.mean(), correct[:, -1].mean()))
+
+    if report_path:
+        with open(report_path, 'w', newline='') as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(table)
+    return {'traces': len(labels), 'decided_early': float(early.mean()), 'time_to_decision': float(decided_at.mean()),
+            'decision_accuracy': float(decided_right.mean()), 'accuracy': float(correct[:, -1].mean()),
+            'checkpoints': [dict(zip(header, row)) for row in table]}
+
+
+def load_scores(path, class_num=const_rf.num_classes):
+    """Scores function of an exported .onnx model (onnxruntime) or of a trained model, without .pth (PyTorch)"""
+    if path.endswith('.onnx'):
+        from rf_ort import OrtRF
+        return OrtRF(path).scores
+    import torch
+    from rf_inference import load_model
+    model = load_model(class_num, path, torch.device('cpu'))
+
+    def scores(tams):
+        with torch.inference_mode():
+            return model(torch.from_numpy(np.asarray(tams, dtype=np.float32)).unsqueeze(1)).numpy()
+    return scores
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay page loads through an RF model scoring them as they go.')
+    parser.add_argument('model', help='Exported .onnx model, or trained model without .pth.')
+    parser.add_argument('store', help='Trace store of the page loads.')
+    parser.add_argument('-i', '--index', help='Index file of the traces to replay (e.g. list/Index_test.txt).')
+    parser.add_argument('--classes', type=int, default=const_rf.num_classes, help='Classes of a PyTorch model.')
+    parser.add_argument('--interval', type=float, default=INTERVAL, help='Seconds between two checkpoints.')
+    parser.add_argument('--threshold', type=float, default=THRESHOLD, help='Probability deciding a visit.')
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help='Traces replayed at once.')
+    parser.add_argument('--report', help='CSV file of the per-checkpoint report.')
+    parser.add_argument('--check', type=int, default=0, metavar='N',
+                        help='Also replay the first N traces packet by packet through Visit, which must decide the same.')
+    args = parser.parse_args()
+
+    evaluate(load_scores(args.model, args.classes), args.store, args.index, args.interval, args.threshold,
+             args.batch_size, args.report, args.check)
@@ -0,0 +1,95 @@
+import os
+import glob
+import inspect
+import argparse
+import numpy as np
+import torch
+import const_rf as const
+from models.RF import getRF
+from rf_dataset import load_dataset
+
+################################################################################
+# ONNX export of trained RF models.
+#
+#   python rf_onnx.py [pretrained/Undefence ...] [--check dataset/test-folder]
+#
+# exports each getRF state dict (all of pretrained/ by default) next to it as
+# <model>.onnx, with a dynamic batch size: input "tam" float32[B, 1, 2,
+# max_matrix_len], output "scores" float32[B, classes]. The number of classes
+# is read from the state dict. rf_ort.py runs the exported models without
+# PyTorch.
+#
+# With --check, the ONNX model is run with onnxruntime on a held-out dataset
+# and its scores compared with the PyTorch model's.
+################################################################################
+
+OPSET = 13
+CHECK_TRACES = 2048         # held-out traces compared by --check
+RTOL, ATOL = 1e-3, 1e-4     # largest difference allowed between the scores
+
+
+def num_classes(state_dict):
+    """Output channels of the last Conv1d of a getRF state dict"""
+    convs = [k for k, v in state_dict.items() if k.startswith('features.') and k.endswith('.weight') and v.dim() == 3]
+    return state_dict[convs[-1]].shape[0]
+
+
+def load_model(path):
+    state_dict = torch.load(path + '.pth', map_location='cpu', weights_only=True)
+    model = getRF(num_classes(state_dict))
+    model.load_state_dict(state_dict)
+    return model.eval()
+
+
+def export(model, out_path, matrix_len=const.max_matrix_len, opset=OPSET):
+    kwargs = {}
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        kwargs['dynamo'] = False  # the TorchScript exporter, as in PyTorch 1.x
+    torch.onnx.export(model, torch.zeros(1, 1, 2, matrix_len), out_path, input_names=['tam'],
+                      output_names=['scores'], dynamic_axes={'tam': {0: 'batch'}, 'scores': {0: 'batch'}},
+                      opset_version=opset, **kwargs)
+
+
+def check(model, onnx_path, features, labels, n_traces=CHECK_TRACES, batch_size=256, seed=0):
+    """Compares the PyTorch and onnxruntime scores on a sample of a dataset; True if they match"""
+    from rf_ort import OrtRF  # onnxruntime is only needed for the check
+    session = OrtRF(onnx_path)
+    rng = np.random.default_rng(seed)
+    indices = np.sort(rng.choice(len(labels), min(n_traces, len(labels)), replace=False))
+    max_diff, agree, ok = 0.0, 0, True
+    with torch.inference_mode():
+        for first in range(0, len(indices), batch_size):
+            tams = np.asarray(features[indices[first:first + batch_size]], dtype=np.float32)
+            expected = model(torch.from_numpy(tams).unsqueeze(1)).numpy()
+            scores = session.scores(tams)
+            max_diff = max(max_diff, float(np.abs(scores - expected).max()))
+            agree += int((scores.argmax(1) == expected.argmax(1)).sum())
+            ok &= bool(np.allclose(scores, expected, rtol=RTOL, atol=ATOL))
+    print('%s: %d traces, max score difference %.2e, same prediction for %.2f%% of the traces: %s'
+          % (onnx_path, len(indices), max_diff, 100 * agree / len(indices), 'OK' if ok else 'MISMATCH'))
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export trained RF models to ONNX, with a dynamic batch size.')
+    parser.add_argument('models', nargs='*', help='Trained models, without .pth (default: all of model_path).')
+    parser.add_argument('--check', help='Held-out dataset folder the exported models are checked on.')
+    parser.add_argument('--opset', type=int, default=OPSET, help='ONNX opset version.')
+    args = parser.parse_args()
+
+    models = args.models or sorted(p[:-len('.pth')] for p in glob.glob(os.path.join(const.model_path, '*.pth')))
+    held_out = load_dataset(args.check) if args.check else None
+    failed = []
+    for path in models:
+        try:
+            model = load_model(path)
+        except (RuntimeError, KeyError, IndexError) as e:
+            # e.g. int8 models of rf_quantize.py
+            print('[SKIP] %s: not a float getRF state dict (%s)' % (path, str(e).splitlines()[0]))
+            continue
+        export(model, path + '.onnx', opset=args.opset)
+        print('exported', path + '.onnx')
+        if held_out is not None and not check(model, path + '.onnx', *held_out):
+            failed.append(path)
+    if failed:
+        raise SystemExit('ONNX scores differ from PyTorch for: ' + ', '.join(failed))
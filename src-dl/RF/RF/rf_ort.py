@@ -0,0 +1,89 @@
+import os
+import csv
+import time
+import argparse
+import numpy as np
+import onnxruntime as ort
+from rf_dataset import load_dataset
+
+################################################################################
+# RF inference with onnxruntime, without PyTorch.
+#
+# Scores TAMs with a model exported by rf_onnx.py. Only numpy, onnxruntime
+# and rf_dataset.py are imported, so a scoring process starts in a fraction
+# of the time (and memory) that importing torch takes.
+#
+#   python rf_ort.py pretrained/Undefence.onnx dataset/Undefence-packets_per_slot result/Undefence.csv
+#
+# writes [label, predicted class] rows (or [label, softmax...] with
+# --softmax) as test.py does, a batch at a time, and reports the throughput.
+################################################################################
+
+BATCH_SIZE = 512
+LOG_BATCHES = 100           # batches between two throughput reports
+
+
+class OrtRF:
+    """onnxruntime session of an exported RF, on the CPU"""
+
+    def __init__(self, path, threads=None):
+        options = ort.SessionOptions()
+        if threads:
+            options.intra_op_num_threads = threads
+        self.session = ort.InferenceSession(path, options, providers=['CPUExecutionProvider'])
+        self.input_name = self.session.get_inputs()[0].name
+
+    def scores(self, tams):
+        """float32[B, classes] scores of TAMs [B, 2, matrix_len] (any dtype, e.g. uint16 as stored)"""
+        x = np.asarray(tams, dtype=np.float32)[:, np.newaxis]
+        return self.session.run(None, {self.input_name: x})[0]
+
+    def predict(self, tams):
+        return self.scores(tams).argmax(1)
+
+
+def softmax(scores):
+    e = np.exp(scores - scores.max(1, keepdims=True))
+    return e / e.sum(1, keepdims=True)
+
+
+def predict_dataset(model, features, labels, out_path=None, batch_size=BATCH_SIZE, with_softmax=False):
+    """Streams the result row of every trace to a CSV file (if out_path) and returns the accuracy"""
+    out = open(out_path, 'w', encoding='utf-8', newline='') if out_path else None
+    writer = csv.writer(out) if out else None
+    correct = 0
+    start = time.perf_counter()
+    for step, first in enumerate(range(0, len(labels), batch_size)):
+        y = np.asarray(labels[first:first + batch_size])
+        scores = model.scores(features[first:first + batch_size])
+        pred = scores.argmax(1)
+        correct += int((pred == y).sum())
+        if writer:
+            if with_softmax:
+                writer.writerows([label] + row for label, row in zip(y.tolist(), softmax(scores).tolist()))
+            else:
+                writer.writerows(zip(y.tolist(), pred.tolist()))
+        if (step + 1) % LOG_BATCHES == 0:
+            done = first + len(y)
+            print('%d/%d traces, %.0f traces/s' % (done, len(labels), done / (time.perf_counter() - start)))
+    if out:
+        out.close()
+    seconds = time.perf_counter() - start
+    accuracy = correct / len(labels) if len(labels) else 0.0
+    print('%d traces in %.1f s: %.0f traces/s, accuracy %.4f'
+          % (len(labels), seconds, len(labels) / seconds if seconds else 0.0, accuracy))
+    return accuracy
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Score an RF dataset with an ONNX model exported by rf_onnx.py.')
+    parser.add_argument('model', help='Exported model (.onnx).')
+    parser.add_argument('dataset', help='Dataset folder (e.g. dataset/Undefence-packets_per_slot).')
+    parser.add_argument('out', nargs='?', help='Output .csv file (none: only the accuracy and throughput).')
+    parser.add_argument('--softmax', action='store_true', help='Write softmax vectors instead of predictions.')
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help='Traces per run.')
+    parser.add_argument('-t', '--threads', type=int, default=os.cpu_count(), help='onnxruntime threads.')
+    args = parser.parse_args()
+
+    features, labels = load_dataset(args.dataset)
+    predict_dataset(OrtRF(args.model, args.threads), features, labels, args.out, args.batch_size, args.softmax)
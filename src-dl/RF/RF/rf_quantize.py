@@ -0,0 +1,144 @@
+import copy
+import time
+import warnings
+import argparse
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.ao.quantization as tq
+import const_rf as const
+from models.RF import getRF
+from rf_dataset import load_dataset
+from rf_loader import batch_loader
+
+################################################################################
+# int8 RF models for CPU inference.
+#
+# Dynamic quantization only covers Linear and recurrent layers, and RF is all
+# convolutions, so the model is quantized statically (eager mode): every
+# Conv + BatchNorm + ReLU is fused into one int8 QuantizedConvReLU, and the
+# activation scales come from a calibration pass over a sample of TAMs.
+#
+#   python rf_quantize.py pretrained/Undefence dataset/Undefence-packets_per_slot pretrained/Undefence-int8
+#
+# saves the int8 state dict to pretrained/Undefence-int8.pth and reports the
+# accuracy and per-batch latency of both models on the dataset (--test for
+# another one). load_quantized (or rf_inference.load_model with
+# quantized=True) loads it back; int8 models run on the CPU only, with the
+# quantized engine they were calibrated with.
+################################################################################
+
+CALIBRATION_TRACES = 1024   # TAMs sampled for the activation ranges
+BATCH_SIZE = 256
+QENGINE = torch.backends.quantized.engine   # x86/fbgemm on servers, qnnpack on ARM sensors
+
+
+class QuantRF(nn.Module):
+    """RF between the float -> int8 input and int8 -> float output conversions"""
+
+    def __init__(self, model):
+        super(QuantRF, self).__init__()
+        self.quant = tq.QuantStub()
+        self.model = model
+        self.dequant = tq.DeQuantStub()
+
+    def forward(self, x):
+        return self.dequant(self.model(self.quant(x)))
+
+
+def _fusable(layers, prefix):
+    """Names of the Conv, BatchNorm, ReLU triples of a Sequential"""
+    layers = list(layers)
+    return [[prefix + str(i), prefix + str(i + 1), prefix + str(i + 2)] for i in range(len(layers) - 2)
+            if isinstance(layers[i], (nn.Conv1d, nn.Conv2d))
+            and isinstance(layers[i + 1], (nn.BatchNorm1d, nn.BatchNorm2d))
+            and isinstance(layers[i + 2], nn.ReLU)]
+
+
+def _prepare(model, engine):
+    torch.backends.quantized.engine = engine
+    qmodel = QuantRF(copy.deepcopy(model).cpu()).eval()
+    tq.fuse_modules(qmodel, _fusable(qmodel.model.first_layer, 'model.first_layer.')
+                    + _fusable(qmodel.model.features, 'model.features.'), inplace=True)
+    qmodel.qconfig = tq.get_default_qconfig(engine)
+    return tq.prepare(qmodel, inplace=True)
+
+
+def quantize(model, calibration_loader, engine=QENGINE):
+    """int8 copy of a float RF, calibrated on the batches of calibration_loader"""
+    qmodel = _prepare(model, engine)
+    with torch.inference_mode():
+        for x, _ in calibration_loader:
+            qmodel(x)
+    return tq.convert(qmodel, inplace=True)
+
+
+def calibration_loader(features, labels, n_traces=CALIBRATION_TRACES, batch_size=BATCH_SIZE, seed=0):
+    """Batches of a random sample of the traces"""
+    rng = np.random.default_rng(seed)
+    indices = np.sort(rng.choice(len(labels), min(n_traces, len(labels)), replace=False))
+    return batch_loader(features, labels, batch_size, indices=indices)
+
+
+def load_quantized(class_num, path, engine=QENGINE):
+    """int8 RF saved by this script (path without .pth)"""
+    # Same modules as the saved model; the state dict brings the weights and scales
+    with warnings.catch_warnings():
+        warnings.simplefilter('ignore')  # observers that never ran
+        qmodel = tq.convert(_prepare(getRF(class_num), engine), inplace=True)
+    qmodel.load_state_dict(torch.load(path + '.pth', map_location='cpu', weights_only=True))
+    return qmodel
+
+
+def report(model, qmodel, features, labels, batch_size=BATCH_SIZE):
+    """Accuracy and per-batch latency of the float and int8 models on a dataset, on the CPU"""
+    model = model.cpu().eval()
+    stats = {'fp32': [0, []], 'int8': [0, []]}
+    agree = 0
+    with torch.inference_mode():
+        for x, y in batch_loader(features, labels, batch_size):
+            preds = []
+            for name, m in (('fp32', model), ('int8', qmodel)):
+                start = time.perf_counter()
+                pred = m(x).argmax(1)
+                stats[name][1].append(time.perf_counter() - start)
+                stats[name][0] += (pred == y).sum().item()
+                preds.append(pred)
+            agree += (preds[0] == preds[1]).sum().item()
+
+    result = {name: {'accuracy': correct / len(labels), 'batch_ms': 1000 * float(np.median(times))}
+              for name, (correct, times) in stats.items()}
+    result['agreement'] = agree / len(labels)
+    print('%d traces, batches of %d' % (len(labels), batch_size))
+    for name in ('fp32', 'int8'):
+        print('%s: accuracy %.4f, %.1f ms per batch (median)' % (name, result[name]['accuracy'], result[name]['batch_ms']))
+    print('accuracy delta %+.4f, same prediction for %.2f%% of the traces, %.2fx faster'
+          % (result['int8']['accuracy'] - result['fp32']['accuracy'], 100 * result['agreement'],
+             result['fp32']['batch_ms'] / result['int8']['batch_ms']))
+    return result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Quantize a trained RF model to int8 and compare it with the float one.')
+    parser.add_argument('model', help='Trained model, without .pth (e.g. pretrained/Undefence).')
+    parser.add_argument('dataset', help='Dataset folder the calibration TAMs are sampled from.')
+    parser.add_argument('out', help='int8 model to save, without .pth (e.g. pretrained/Undefence-int8).')
+    parser.add_argument('--test', help='Dataset folder of the report (default: the calibration dataset).')
+    parser.add_argument('--classes', type=int, default=const.num_classes, help='Classes of the model.')
+    parser.add_argument('-n', '--calibration', type=int, default=CALIBRATION_TRACES, help='Calibration traces.')
+    parser.add_argument('-b', '--batch-size', type=int, default=BATCH_SIZE, help='Traces per batch.')
+    parser.add_argument('--engine', default=QENGINE, choices=torch.backends.quantized.supported_engines,
+                        help='Quantized engine of the target CPU.')
+    args = parser.parse_args()
+
+    model = getRF(args.classes)
+    model.load_state_dict(torch.load(args.model + '.pth', map_location='cpu', weights_only=True))
+    model.eval()
+    features, labels = load_dataset(args.dataset)
+    qmodel = quantize(model, calibration_loader(features, labels, args.calibration, args.batch_size), args.engine)
+    torch.save(qmodel.state_dict(), args.out + '.pth')
+    print('saved', args.out + '.pth')
+
+    if args.test:
+        features, labels = load_dataset(args.test)
+    report(model, load_quantized(args.classes, args.out, args.engine), features, labels, args.batch_size)
@@ -1,25 +1,36 @@
 # encoding: utf8
 
-import numpy as np
 import torch
 import torch.nn as nn
-from torch.autograd import Variable
-import torch.utils.data as Data
 import os
+import time
+import itertools
 from models.RF import getRF
 import const_rf as const
+from rf_dataset import load_dataset
+from rf_loader import batch_loader, store_loader
 
 EPOCH = 30
 BATCH_SIZE = 200
 LR = 0.0005
-if_use_gpu = 0
+NUM_WORKERS = 4  # DataLoader processes computing the TAMs when training from a trace store
 num_classes = const.num_classes
+LOG_STEPS = 100             # steps between two logs; the metrics are accumulated on the device in between
+
+# CPU training mode, off by default: bf16 autocast, NUM_WORKERS processes also
+# reading extracted datasets, and the thread count and batch size giving the
+# most samples/s, timed on the training loader before training
+CPU_MODE = False
+TUNE_BATCH_SIZES = (BATCH_SIZE, 2 * BATCH_SIZE, 4 * BATCH_SIZE)
+TUNE_STEPS = 20             # timed steps per setting, after one warm-up step; more than the workers prefetch
+COMPILE = False             # torch.compile the model (PyTorch 2)
+
+device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-device = torch.device("mps") if if_use_gpu else torch.device("cpu")
 
 def load_data(fpath):
-    train = np.load(fpath, allow_pickle=True).item()
-    train_X, train_y = train['dataset'], train['label']
+    # Memory-mapped uint16 TAMs: the loaders convert them to float per batch
+    train_X, train_y = load_dataset(fpath)
 
     return train_X, train_y
 
@@ -30,76 +41,102 @@ def adjust_learning_rate(optimizer, echo):
         para_group['lr'] = lr
 
 
-def val(cnn, test_x, test_y, result_file, test_file):
-    cnn.eval()
-    test_result = open(test_file, 'w+')
-    test_data = Data.TensorDataset(test_x, test_y)
-    test_loader = Data.DataLoader(dataset=test_data, batch_size=BATCH_SIZE, shuffle=True)
-    for step, (tr_x, tr_y) in enumerate(test_loader):
-        test_output = cnn(tr_x)
-        if if_use_gpu:
-            test_output = test_output.cpu()
-        pred_y, accuracy = get_result(test_output, tr_y)
-        resultfile = open(result_file, 'w+')
-        for i in range(len(tr_y)):
-            resultfile.write(str(tr_y[i].numpy()) + ',' + str(pred_y[i]) + '\n')
-        resultfile.close()
-        test_result.write(str(accuracy) + '\n')
-        print(accuracy)
-    test_result.close()
-
-
-def get_result(output, true_y):
-    pred_y = torch.max(output, 1)[1].data.numpy().squeeze()
-    accuracy = (pred_y == true_y.numpy()).sum().item() * 1.0 / float(true_y.size(0))
-    return pred_y, accuracy
+def train_step(cnn, optimizer, loss_func, batch_x, batch_y, bf16=False):
+    with torch.autocast(device_type='cpu', dtype=torch.bfloat16, enabled=bf16):
+        output = cnn(batch_x)
+        loss = loss_func(output, batch_y)
+    optimizer.zero_grad(set_to_none=True)
+    loss.backward()
+    optimizer.step()
+    return output, loss
+
+
+def tune(make_loader, threads=None):
+    """
+    (threads, batch size) giving the most training samples per second, timed
+    with a throwaway model on the batches of make_loader(batch size), loading
+    included; sets the torch thread count.
+    """
+    cores = os.cpu_count()
+    if threads is None:
+        threads = sorted({max(1, cores - NUM_WORKERS), max(1, cores // 2), cores})
+    loss_func = nn.CrossEntropyLoss()
+    best = None
+    for n_threads in threads:
+        torch.set_num_threads(n_threads)
+        for batch_size in TUNE_BATCH_SIZES:
+            cnn = getRF(num_classes).to(device)
+            optimizer = torch.optim.Adam(cnn.parameters(), lr=LR)
+            seen, start = 0, None
+            for tr_x, tr_y in itertools.islice(make_loader(batch_size), TUNE_STEPS + 1):
+                train_step(cnn, optimizer, loss_func, tr_x.to(device), tr_y.to(device), bf16=True)
+                if start is None:
+                    start = time.perf_counter()  # after the warm-up step and the start of the workers
+                else:
+                    seen += tr_y.size(0)
+            if not seen:
+                continue  # not two batches of this size in the dataset
+            rate = seen / (time.perf_counter() - start)
+            print('%d threads, batch size %d: %.0f samples/s' % (n_threads, batch_size, rate))
+            if best is None or rate > best[0]:
+                best = (rate, n_threads, batch_size)
+    if best is None:
+        return torch.get_num_threads(), BATCH_SIZE
+    torch.set_num_threads(best[1])
+    return best[1], best[2]
 
 
 def control(feature_file):
-    x, y = load_data(feature_file)
-    cnn = getRF(num_classes)
-
-    if if_use_gpu:
-        cnn = cnn.cuda()
+    cpu_mode = CPU_MODE and device.type == 'cpu'
+    pin_memory = device.type == 'cuda'
+    if traces_path:
+        def make_loader(batch_size):
+            # TAMs computed per batch by the workers, no extraction step
+            return store_loader(traces_path, batch_size, shuffle=True, num_workers=NUM_WORKERS,
+                                pin_memory=pin_memory, cache_dir=tam_cache)
     else:
-        cnn = getRF(num_classes).to(device)
+        x, y = load_data(feature_file)
+
+        def make_loader(batch_size):
+            return batch_loader(x, y, batch_size, shuffle=True, num_workers=NUM_WORKERS if cpu_mode else 0,
+                                pin_memory=pin_memory)
 
+    batch_size = BATCH_SIZE
+    if cpu_mode:
+        threads, batch_size = tune(make_loader)
+        print('training with %d threads, batch size %d' % (threads, batch_size))
+
+    cnn = getRF(num_classes).to(device)
     optimizer = torch.optim.Adam(cnn.parameters(), lr=LR, weight_decay=0.001)
     loss_func = nn.CrossEntropyLoss()
-    train_x = torch.unsqueeze(torch.from_numpy(x), dim=1).type(torch.FloatTensor)
-    train_x = train_x.view(train_x.size(0), 1, 2, -1)
-    train_y = torch.from_numpy(y).type(torch.LongTensor)
-
-    train_data = Data.TensorDataset(train_x, train_y)
-    train_loader = Data.DataLoader(dataset=train_data, batch_size=BATCH_SIZE, shuffle=True)
+    model = torch.compile(cnn) if COMPILE else cnn
+    train_loader = make_loader(batch_size)
 
     cnn.train()
 
+    # Running metrics, only copied to the host when logged
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    loss_sum = torch.zeros((), device=device)
+    seen, steps, start = 0, 0, time.perf_counter()
     for epoch in range(EPOCH):
 
         adjust_learning_rate(optimizer, epoch)
         for step, (tr_x, tr_y) in enumerate(train_loader):
-            if if_use_gpu:
-                batch_x = Variable(tr_x.device)
-                batch_y = Variable(tr_y.device)
-            else:
-                batch_x = tr_x.to(device)
-                batch_y = tr_y.to(device)
-            
-            output = cnn(batch_x)
-            _, accuracy = get_result(output.cpu(), tr_y.cpu())
-
-            del batch_x
-            loss = loss_func(output, batch_y)
-            del batch_y
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
-
-            del output
-
-            if step % 100 == 0:
-                print(epoch, step, accuracy, loss.item())
+            batch_x = tr_x.to(device, non_blocking=True)
+            batch_y = tr_y.to(device, non_blocking=True)
+            output, loss = train_step(model, optimizer, loss_func, batch_x, batch_y, bf16=cpu_mode)
+
+            correct += (output.argmax(1) == batch_y).sum()
+            loss_sum += loss.detach()
+            seen += batch_y.size(0)
+            steps += 1
+
+            if step % LOG_STEPS == 0:
+                elapsed = time.perf_counter() - start
+                print(epoch, step, correct.item() / seen, loss_sum.item() / steps, '%.0f samples/s' % (seen / elapsed))
+                correct.zero_()
+                loss_sum.zero_()
+                seen, steps, start = 0, 0, time.perf_counter()
 
     torch.save(cnn.state_dict(), os.path.join(const.model_path, method + '.pth'))
 
@@ -107,6 +144,8 @@ def control(feature_file):
 if __name__ == '__main__':
     # TODO: change the data file path
     defense = 'Undefence'
-    feature_file = 'dataset/' + defense + '-packets_per_slot.npy'
+    feature_file = 'dataset/' + defense + '-packets_per_slot'
+    traces_path = None  # or a trace store, e.g. './../../../data/traces.store', to train on it without extract-all.py
+    tam_cache = None  # or a folder keeping the TAMs computed from traces_path for the next runs
     method = defense
     control(feature_file)
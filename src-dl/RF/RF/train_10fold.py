@@ -4,34 +4,43 @@ from datetime import datetime
 import numpy as np
 import torch
 import torch.nn as nn
-import torch.utils.data as Data
 import pre_recall
 from sklearn.model_selection import StratifiedShuffleSplit
 from models.RF import getRF
 import csv
 import const_rf as const
 import os
+import json
+import shutil
+import hashlib
+import multiprocessing as mp
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rf_dataset import load_dataset, is_dataset, read_header, load_traces
+from rf_loader import batch_loader
 
 EPOCH = 30
 BATCH_SIZE = 200
 LR = 0.0005
-if_use_gpu = 1
 num_classes = const.num_classes
 num_folds = 10
 
+# Folds run as independent processes, each one on its share of the cores
+FOLD_JOBS = 2               # folds trained at once
+NUM_WORKERS = 1             # DataLoader processes of each fold
+BF16 = False                # bf16 autocast of the forward pass (train.py CPU_MODE)
+LOG_STEPS = 100
+
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
 
 def load_data(fpath):        
-    train = np.load(fpath, allow_pickle=True).item()
-    train_X, train_y = train['dataset'], train['label']
-    labels = train_y.flatten()
-    unique, counts = np.unique(labels, return_counts=True)
+    # Memory-mapped uint16 TAMs: the loaders convert them to float per batch
+    train_X, train_y = load_dataset(fpath)
+    unique, counts = np.unique(train_y, return_counts=True)
     for u, c in zip(unique, counts):
         if c == 1:
             print(u, c)
         
-    train_y = train_y[:, np.newaxis]
     print(train_X.shape, train_y.shape)
     return train_X, train_y
 
@@ -48,21 +57,23 @@ def get_result(output, true_y):
     return pred_y, accuracy
 
 
-def val(cnn, test_x, test_y, result_file, test_file):
+def val(cnn, test_loader, result_file, test_file):
+    """Writes the (label, prediction) rows and the fold accuracy, each file replaced at once"""
     cnn.eval()
-    test_data = Data.TensorDataset(test_x, test_y)
-    test_loader = Data.DataLoader(dataset=test_data, batch_size=BATCH_SIZE, shuffle=True)
-    for step, (tr_x, tr_y) in enumerate(test_loader):
-        tr_x = tr_x.to(device)
-        test_output = cnn(tr_x)
-        if if_use_gpu:
-            test_output = test_output.cpu()
-        pred_y, accuracy = get_result(test_output, tr_y)
-        resultfile = open(result_file, 'a+')
-        for i in range(len(tr_y)):
-            resultfile.write(str(tr_y[i].numpy()) + ',' + str(pred_y[i]) + '\n')
-        resultfile.close()
-        print(accuracy)
+    correct, total = 0, 0
+    with torch.no_grad(), open(result_file + '.tmp', 'w') as resultfile:
+        for step, (tr_x, tr_y) in enumerate(test_loader):
+            test_output = cnn(tr_x.to(device)).cpu()
+            pred_y, accuracy = get_result(test_output, tr_y)
+            for i in range(len(tr_y)):
+                resultfile.write(str(tr_y[i].numpy()) + ',' + str(pred_y[i]) + '\n')
+            correct += accuracy * len(tr_y)
+            total += len(tr_y)
+    with open(test_file + '.tmp', 'w') as test_result:
+        test_result.write(str(correct / total) + '\n')
+    os.replace(result_file + '.tmp', result_file)
+    os.replace(test_file + '.tmp', test_file)
+    return correct / total
 
 
 def test_train_data(cnn, train_loader, train_file):
@@ -71,10 +82,7 @@ def test_train_data(cnn, train_loader, train_file):
     train_csv_wirter = csv.writer(train_result)
     acc = []
     for step, (tr_x, tr_y) in enumerate(train_loader):
-        test_output = cnn(tr_x)
-        if if_use_gpu:
-            test_output = test_output.cpu()
-            tr_y = tr_y.cpu()
+        test_output = cnn(tr_x.to(device)).cpu()
         pred_y, accuracy = get_result(test_output, tr_y)
         acc.append(accuracy)
         print(accuracy)
@@ -82,77 +90,132 @@ def test_train_data(cnn, train_loader, train_file):
     train_result.close()
 
 
-def control(feature_file, result_file, test_file, method):
-    x, y = load_data(feature_file)
+def fold_model(method, fold):
+    return os.path.join(const.model_path, method + '-trained10fold-{}.pth'.format(fold))
 
-    sss = StratifiedShuffleSplit(n_splits=10, test_size=0.1, random_state=0)
-    fold = 1
 
-    for train_index, test_index in sss.split(X=x, y=y):
-        cnn = getRF(num_classes)
-        if if_use_gpu:
-            cnn = cnn.cuda()
+def dataset_manifest(feature_file):
+    """Extraction header and hash of the trace table of a dataset (size and mtime of an older pickled one)"""
+    path = feature_file[:-len('.npy')] if feature_file.endswith('.npy') else feature_file
+    if is_dataset(path):
+        return {'header': read_header(path),
+                'traces': hashlib.sha1(np.ascontiguousarray(load_traces(path)).tobytes()).hexdigest()}
+    stat = os.stat(path + '.npy')
+    return {'size': stat.st_size, 'mtime': stat.st_mtime_ns}
 
-        optimizer = torch.optim.Adam(cnn.parameters(), lr=LR, weight_decay=0.001)
-        loss_func = nn.CrossEntropyLoss()
 
-        train_x = torch.unsqueeze(torch.from_numpy(x[train_index]), dim=1).type(torch.FloatTensor)
-        train_x = train_x.view(train_x.size(0), 1, 2, -1)
-        train_y = torch.squeeze(torch.from_numpy(y[train_index])).type(torch.LongTensor)
-        test_x = torch.unsqueeze(torch.from_numpy(x[test_index]), dim=1).type(torch.FloatTensor)
-        test_x = test_x.view(test_x.size(0), 1, 2, -1)
-        test_y = torch.squeeze(torch.from_numpy(y[test_index])).type(torch.LongTensor)
+def fold_manifest(feature_file, dataset, y, train_index, test_index):
+    """What a fold model is trained on and with, saved next to it"""
+    split = hashlib.sha1(np.asarray(train_index, dtype=np.int64).tobytes())
+    split.update(np.asarray(test_index, dtype=np.int64).tobytes())
+    return {'feature_file': feature_file, 'dataset': dataset, 'traces': len(y),
+            'labels': hashlib.sha1(np.asarray(y, dtype=np.int64).tobytes()).hexdigest(),
+            'split': split.hexdigest(), 'epochs': EPOCH, 'lr': LR, 'batch_size': BATCH_SIZE, 'bf16': BF16}
 
-        train_data = Data.TensorDataset(train_x, train_y)
-        train_loader = Data.DataLoader(dataset=train_data, batch_size=BATCH_SIZE, shuffle=True)
 
-        cnn.train()
+def manifest_path(method, fold):
+    return fold_model(method, fold)[:-len('.pth')] + '.json'
 
-        for epoch in range(EPOCH):
 
-            adjust_learning_rate(optimizer, epoch)
-            for step, (tr_x, tr_y) in enumerate(train_loader):
-                batch_x = tr_x.to(device)
-                batch_y = tr_y.to(device)
-                output = cnn(batch_x)
-                _, accuracy = get_result(output.cpu(), tr_y.cpu())
+def fold_done(method, fold, manifest):
+    """Whether the saved model of a fold was trained as this run would train it"""
+    path = manifest_path(method, fold)
+    if not (os.path.isfile(fold_model(method, fold)) and os.path.isfile(path)):
+        return False
+    with open(path) as f:
+        return json.load(f) == manifest
+
+
+def train_fold(fold, feature_file, train_index, test_index, result_file, test_file, method, threads, manifest):
+    """
+    Trains and evaluates one fold in its own process, on the rows of the shared
+    memory-mapped dataset given by the indices. The model is saved once the
+    results are written, then its manifest: that marks the fold as done.
+    """
+    torch.set_num_threads(threads)
+    x, y = load_dataset(feature_file)
+
+    cnn = getRF(num_classes).to(device)
+    optimizer = torch.optim.Adam(cnn.parameters(), lr=LR, weight_decay=0.001)
+    loss_func = nn.CrossEntropyLoss()
 
-                del batch_x
+    train_loader = batch_loader(x, y, BATCH_SIZE, shuffle=True, indices=train_index, num_workers=NUM_WORKERS)
+    test_loader = batch_loader(x, y, BATCH_SIZE, indices=test_index)
+
+    cnn.train()
+
+    # Running metrics, only copied to the host when logged
+    correct = torch.zeros((), dtype=torch.long, device=device)
+    loss_sum = torch.zeros((), device=device)
+    seen, steps = 0, 0
+    for epoch in range(EPOCH):
+
+        adjust_learning_rate(optimizer, epoch)
+        for step, (tr_x, tr_y) in enumerate(train_loader):
+            batch_x = tr_x.to(device)
+            batch_y = tr_y.to(device)
+            with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=BF16):
+                output = cnn(batch_x)
                 loss = loss_func(output, batch_y)
-                if step % 100 == 0:
-                    print(epoch, step, accuracy, loss.item())
-
-                del batch_y
-
-                optimizer.zero_grad()
-                loss.backward()
-                optimizer.step()
-                del output
-
-        val(cnn, test_x, test_y, result_file.format(fold), test_file.format(fold))
-
-        del train_x
-        del train_y
-        del train_data
-        del train_loader
-        del optimizer
-        del test_x
-        del test_y
-        del cnn
-        torch.cuda.empty_cache()
-        print('*' * 5 + str(fold) + '*' * 5)
-        fold += 1
-
-        if fold > num_folds:
-            break
-        
-    torch.save(cnn.state_dict(), os.path.join(const.model_path, method + '-trained10fold.pth'))
+            optimizer.zero_grad(set_to_none=True)
+            loss.backward()
+            optimizer.step()
+
+            correct += (output.argmax(1) == batch_y).sum()
+            loss_sum += loss.detach()
+            seen += batch_y.size(0)
+            steps += 1
+            if step % LOG_STEPS == 0:
+                print('fold', fold, epoch, step, correct.item() / seen, loss_sum.item() / steps)
+                correct.zero_()
+                loss_sum.zero_()
+                seen, steps = 0, 0
+
+    accuracy = val(cnn, test_loader, result_file.format(fold), test_file.format(fold))
+    path = fold_model(method, fold)
+    torch.save(cnn.state_dict(), path + '.tmp')
+    os.replace(path + '.tmp', path)
+    with open(manifest_path(method, fold) + '.tmp', 'w') as f:
+        json.dump(manifest, f)
+    os.replace(manifest_path(method, fold) + '.tmp', manifest_path(method, fold))
+    print('*' * 5 + str(fold) + '*' * 5, accuracy)
+    return fold
+
+
+def control(feature_file, result_file, test_file, method):
+    x, y = load_data(feature_file)
+    os.makedirs(const.model_path, exist_ok=True)
+    for path in (result_file, test_file):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+
+    # The split only needs the labels, and is the same from one run to the next
+    sss = StratifiedShuffleSplit(n_splits=num_folds, test_size=0.1, random_state=0)
+    dataset = dataset_manifest(feature_file)
+    folds = [(fold, train_index, test_index, fold_manifest(feature_file, dataset, y, train_index, test_index))
+             for fold, (train_index, test_index) in enumerate(sss.split(X=np.zeros(len(y)), y=y), 1)]
+    # Folds saved by an earlier, interrupted run on the same data and settings are not trained again
+    todo = [f for f in folds if not fold_done(method, f[0], f[3])]
+    if len(todo) < len(folds):
+        print('folds already trained:', sorted(set(f[0] for f in folds) - set(f[0] for f in todo)))
+
+    jobs = max(1, min(FOLD_JOBS, len(todo)))
+    threads = max(1, os.cpu_count() // jobs)
+    # spawn: every fold starts with fresh torch threads (and CUDA) state
+    with ProcessPoolExecutor(jobs, mp_context=mp.get_context('spawn')) as ex:
+        running = [ex.submit(train_fold, fold, feature_file, train_index, test_index,
+                             result_file, test_file, method, threads, manifest)
+                   for fold, train_index, test_index, manifest in todo]
+        for future in as_completed(running):
+            print('fold', future.result(), 'saved')
+
+    # Model of the last fold, under the name earlier versions saved it to
+    shutil.copyfile(fold_model(method, num_folds), os.path.join(const.model_path, method + '-trained10fold.pth'))
 
 
 def main():
     # TODO: change the data file path
     defense = 'Undefence'
-    feature_file = 'dataset/' + defense + '-packets_per_slot.npy'
+    feature_file = 'dataset/' + defense + '-packets_per_slot'
     result_file = 'result/' + defense + '-{}.csv'
     res_anaFile = result_file[:-4] + '_ana.csv'
     test_file = result_file[:-4] + '_test.txt'
@@ -131,6 +131,11 @@ def parse_arguments():
                         default=5,
                         metavar='<num_folds>',
                         help='Number of folds to use for cross-validation.')
+    parser.add_argument('-i', '--index',
+                        type=str,
+                        default=None,
+                        metavar='<path/to/index>',
+                        help='Trace index (one x-y name per line, e.g. from trace_dedup.py) selecting the traces to use.')
     return parser.parse_args()
 
 
@@ -209,7 +214,7 @@ def main():
     # # # # # # # # 
     print("Loading dataset as type {}...".format(args.attack))
 
-    X, y = load_data(args.traces, typ=args.attack)
+    X, y = load_data(args.traces, typ=args.attack, index=args.index)
 
     res = []
 
@@ -1,84 +1,107 @@
-import os
-import numpy as np
-import re
-import json
-
-
-def load_data(directory, delimiter='\t', file_split="-", length=5000, typ=2, unmon=False):
-    """
-    Load data from ascii files
-    """
-    X, y = [], []
-    class_counter = 0
-    for root, dirs, files in os.walk(directory):
-        if not unmon:
-            files = [fname for fname in files if len(fname.split(file_split)) == 2]
-        for fname in files:
-            try:
-                trace_class = None
-                if unmon:
-                    trace_class = -1
-                else:
-                    cls, inst  = fname.split(file_split)
-                    trace_class = int(cls)
-
-                # build direction sequence
-                sequence = load_trace(os.path.join(root, fname), seperator=delimiter)
-
-                # use time direction
-                if typ==1:
-                    sequence = [sequence[0][i]*sequence[1][i] for i in range(len(sequence[0]))] 
-
-                # use time only
-                elif typ==2:
-                    sequence = sequence[0]  
-
-                # use direction only
-                else:
-                    sequence = sequence[1]  
-
-                # add sequence and label
-                sequence = np.array(sequence)
-                if len(sequence) < length:
-                    sequence = np.hstack((sequence, np.zeros(((length-len(sequence),)))))
-                sequence.resize((length, 1))
-                X.append(sequence)
-                y.append(trace_class)
-            except Exception as e:
-                print(e)
-                pass
-
-    # wrap as numpy array
-    X, Y = np.array(X), np.array(y)
-
-    # shuffle
-    s = np.arange(Y.shape[0])
-    np.random.seed(0)
-    np.random.shuffle(s)
-    X, Y = X[s], Y[s]
-    return X, Y
-
-
-def load_trace(path, seperator="\t"):
-    """
-    loads data to be used for predictions
-    """
-    file = open(path, 'r')
-    sequence = [[], []]
-    for line in file:
-        try:
-            pieces = line.strip("\n").split(seperator)
-            if int(pieces[1]) == 0:
-                break
-            timestamp = float(pieces[0])
-            length = abs(int(pieces[1]))
-            direction = int(pieces[1]) // length
-            sequence[0].append(timestamp)
-            sequence[1].append(direction)
-        except Exception as e:
-            print(e)
-            print("Error when trying to read packet sequence from %s!" % path)
-            return None
-    return sequence
-
-
+import os
+import sys
+import numpy as np
+import re
+import json
+
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+from trace_store import TraceStore, is_trace_store, UNMONITORED_SAMPLE
+from wang14 import read_trace, drop_empty
+from trace_catalog import TraceCatalog, index_mask
+
+
+def load_data(directory, file_split="-", length=5000, typ=2, unmon=False, index=None):
+    """
+    Load data from ascii files (or from a packed trace store), optionally only
+    the traces listed in a trace index file
+    """
+    if is_trace_store(directory):
+        return load_store_data(directory, length=length, typ=typ, unmon=unmon, index=index)
+
+    # one scan of the folder (and its subfolders), see src-dl/trace_catalog.py
+    catalog = TraceCatalog.open(directory, separator=file_split)
+    selected = index_mask(catalog.sites, catalog.samples, index) if index else np.ones(len(catalog), dtype=bool)
+    X, y = [], []
+    for i in np.flatnonzero(selected):
+        if not unmon and catalog.samples[i] == UNMONITORED_SAMPLE:
+            continue
+        try:
+            trace_class = -1 if unmon else int(catalog.sites[i])
+
+            # build direction sequence
+            sequence = load_trace(catalog.path(i), length=length)
+
+            # add sequence and label
+            X.append(build_sequence(sequence, typ, length))
+            y.append(trace_class)
+        except Exception as e:
+            print(e)
+            pass
+
+    # wrap as numpy array
+    X, Y = np.array(X), np.array(y)
+
+    # shuffle
+    s = np.arange(Y.shape[0])
+    np.random.seed(0)
+    np.random.shuffle(s)
+    X, Y = X[s], Y[s]
+    return X, Y
+
+
+def load_store_data(path, length=5000, typ=2, unmon=False, index=None):
+    """
+    Same as load_data, with the traces read from a trace store
+    """
+    store = TraceStore(path)
+    selected = index_mask(store.sites, store.samples, index) if index else np.ones(len(store), dtype=bool)
+    X, y = [], []
+    for i in np.flatnonzero(selected):
+        site, sample = store.labels[i]
+        if not unmon and sample == UNMONITORED_SAMPLE:
+            continue
+        times, sizes = drop_empty(*store.trace(i, length))
+        X.append(build_sequence([times, np.sign(sizes)], typ, length))
+        y.append(-1 if unmon else int(site))
+
+    # wrap as numpy array
+    X, Y = np.array(X), np.array(y)
+
+    # shuffle
+    s = np.arange(Y.shape[0])
+    np.random.seed(0)
+    np.random.shuffle(s)
+    X, Y = X[s], Y[s]
+    return X, Y
+
+
+def build_sequence(sequence, typ, length):
+    """
+    (length, 1) input of one trace: time * direction, time only or direction only
+    """
+    # use time direction
+    if typ==1:
+        sequence = sequence[0] * sequence[1]
+
+    # use time only
+    elif typ==2:
+        sequence = sequence[0]
+
+    # use direction only
+    else:
+        sequence = sequence[1]
+
+    sequence = np.array(sequence[:length], dtype=np.float64)
+    if len(sequence) < length:
+        sequence = np.hstack((sequence, np.zeros(((length-len(sequence),)))))
+    return sequence.reshape((length, 1))
+
+
+def load_trace(path, length=None):
+    """
+    loads data to be used for predictions (any whitespace separates the columns)
+    """
+    times, sizes = read_trace(path, max_length=length)
+    return [times, np.sign(sizes)]
+
+
@@ -136,6 +136,11 @@ def parse_arguments():
                         default='trained_model_ow.h5',
                         metavar='<output>',
                         help='Location to store the file.')
+    parser.add_argument('-i', '--index',
+                        type=str,
+                        default=None,
+                        metavar='<path/to/index>',
+                        help='Trace index (one x-y name per line, e.g. from trace_dedup.py) selecting the traces to use.')
     return parser.parse_args()
 
 
@@ -218,7 +223,7 @@ def main():
 
     # Load the dataset
     print("Loading dataset as type {}...".format(args.attack))
-    X_mon, y_mon = load_data(args.mon, typ=args.attack, unmon=False)
+    X_mon, y_mon = load_data(args.mon, typ=args.attack, unmon=False, index=args.index)
     X_unmon, _ = load_data(args.unmon, typ=args.attack, unmon=True)
     unmon_label = np.amax(y_mon) + 1
     y_unmon = np.ones((X_unmon.shape[0],)) * unmon_label
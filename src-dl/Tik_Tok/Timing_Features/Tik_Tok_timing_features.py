@@ -34,6 +34,7 @@ print(f"Processing dataset: {dataset}")
 print(f"Number of classes: {num_classes}")
 
 data_root = '../../../data/features/'
+index_path = None  # or a trace index (one x-y per line, e.g. from trace_dedup.py) selecting the traces to use
 save_path = os.getcwd() + '/' + 'save_data/' + str(dataset) + '/'
 
 try:
@@ -60,7 +61,7 @@ if count_m_files == 6:
 else:
     print("Processing raw data (this may take a while)...")
     try:
-        X_train, y_train, X_valid, y_valid, X_test, y_test = final_process(dataset, data_root, save_path)
+        X_train, y_train, X_valid, y_valid, X_test, y_test = final_process(dataset, data_root, save_path, index_path)
     except Exception as e:
         print(f"Error processing data: {e}")
         print("Make sure your data is in the correct directory structure at:", data_root)
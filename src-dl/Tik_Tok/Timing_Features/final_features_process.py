@@ -5,45 +5,34 @@ from sklearn.utils import shuffle
 from common import *
 from features import *
 import os
+import sys
 import time
-import glob
 import random
 random.seed(583004949)
 
+sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..')))  # src-dl
+from trace_store import TraceStore, is_trace_store
+from wang14 import read_trace, drop_empty
+from trace_catalog import TraceCatalog, samples_by_site, index_mask
+
 ################################################################################
 # Constants - TODO: Adjust these based on your dataset
 num_sites = 1000
 bin_size = 20
 
-################################################################################
-# Function to get all available samples for a given site by checking existing files
-def get_available_samples(data_path, site):
-    """
-    Get all available sample numbers for a given site by checking existing files
-    """
-    available_samples = []
-    pattern = f"{site}-*"
-    
-    # Use glob to find all matching files
-    file_pattern = os.path.join(data_path, pattern)
-    matching_files = glob.glob(file_pattern)
-    
-    for file_path in matching_files:
-        filename = os.path.basename(file_path)
-        # Extract sample number
-        parts = filename.split('-')
-        if len(parts) >= 2:
-            try:
-                sample_num = int(parts[1])
-                available_samples.append(sample_num)
-            except ValueError:
-                continue
-    
-    return sorted(available_samples)
-
 ################################################################################
 # Function to generate and save features for training, validation, and testing datasets
-def gen_save_feats(dataset, data_path, save_path):
+def gen_save_feats(dataset, data_path, save_path, index_path=None):
+    # data_path is either a directory of Wang14 files or a packed trace store
+    store = TraceStore(data_path) if is_trace_store(data_path) else None
+    catalog = TraceCatalog.open(data_path) if store is None else None
+    source = store if store is not None else catalog
+    sites, samples = source.sites, source.samples
+    if index_path:
+        # Only the traces listed in the index (e.g. from trace_dedup.py)
+        selected = index_mask(sites, samples, index_path)
+        sites, samples = sites[selected], samples[selected]
+    available = samples_by_site(sites, samples)
 
     for i in range(3):
         print('Iteration: ', i)
@@ -69,7 +58,7 @@ def gen_save_feats(dataset, data_path, save_path):
         
         for site in range(1, num_sites+1):
             # Get all available samples for this site
-            available_samples = get_available_samples(data_path, site)
+            available_samples = available.get(site, [])
             
             if len(available_samples) == 0:
                 # Debugging line to check if no samples are found
@@ -95,31 +84,25 @@ def gen_save_feats(dataset, data_path, save_path):
                 final_fname = str(site) + "-" + str(sample_num)
                 file_path = os.path.join(data_path, final_fname)
                 
-                # Check if file exists before trying to open it
-                if not os.path.exists(file_path):
-                    print(f"Warning: File {file_path} not found, skipping...")
-                    continue
-                
                 try:
-                    # Directory of the raw data
-                    with open(file_path, "r") as file_pt:
-                        traces = []
-                        for line in file_pt:
-                            x = line.strip().split('\t')
-                            x[0] = float(x[0])
-                            x[1] = 1 if float(x[1]) > 0 else -1
-                            traces.append(x)
-                        
-                        bursts, direction_counts = extract_bursts(traces)
-                        features["MED"][final_fname] = MED(bursts)
-                        features["IBD_FF"][final_fname] = IBD_FF(bursts)
-                        features["IBD_IFF"][final_fname] = IBD_IFF(bursts)
-                        features["IBD_LF"][final_fname] = IBD_LF(bursts)
-                        features["IBD_OFF"][final_fname] = IBD_OFF(bursts)
-                        features["Burst_Length"][final_fname] = Burst_Length(bursts)
-                        features["IMD"][final_fname] = IMD(bursts)
-                        features["Variance"][final_fname] = Variance(bursts)
-                        labels_instances.append(final_fname)
+                    if store is not None:
+                        times, sizes = drop_empty(*store.trace(store.index(site, sample_num)))
+                    else:
+                        # Directory of the raw data
+                        file_path = catalog.path(catalog.index(site, sample_num))
+                        times, sizes = read_trace(file_path)
+                    traces = [[t, 1 if s > 0 else -1] for t, s in zip(times.tolist(), sizes.tolist())]
+
+                    bursts, direction_counts = extract_bursts(traces)
+                    features["MED"][final_fname] = MED(bursts)
+                    features["IBD_FF"][final_fname] = IBD_FF(bursts)
+                    features["IBD_IFF"][final_fname] = IBD_IFF(bursts)
+                    features["IBD_LF"][final_fname] = IBD_LF(bursts)
+                    features["IBD_OFF"][final_fname] = IBD_OFF(bursts)
+                    features["Burst_Length"][final_fname] = Burst_Length(bursts)
+                    features["IMD"][final_fname] = IMD(bursts)
+                    features["Variance"][final_fname] = Variance(bursts)
+                    labels_instances.append(final_fname)
                         
                 except Exception as e:
                     print(f"Error processing file {file_path}: {e}")
@@ -216,11 +199,11 @@ def making_matrx(X, Y, f_name, f_dir):
 
 ################################################################################
 # Main function to process data and return training, validation, and testing sets
-def final_process(dataset, data_root, save_path):
+def final_process(dataset, data_root, save_path, index_path=None):
     st_time = time.time()
     print('Processing ', dataset,' data.')
     
-    gen_save_feats(dataset, data_root, save_path)
+    gen_save_feats(dataset, data_root, save_path, index_path)
     print('Features Processing Completed in ', (time.time() - st_time)/60, ' mins.')
     
     train_file = 'training'
@@ -0,0 +1,216 @@
+import socket
+import struct
+import numpy as np
+
+################################################################################
+# In-process pcap decoder.
+#
+# Reads a classic libpcap capture straight into NumPy arrays with the same
+# semantics as the tshark fields used by 2_extract_features.py:
+#   frame.time_epoch, ip.src, ip.dst, tcp.len, udp.length - 8
+# and the display filter "(ip or ipv6) and (tcp or udp)". Only the record
+# headers are walked in Python (their offsets are sequential); every header
+# field is then gathered for all packets at once.
+#
+# As with the tshark path, only IPv4 packets carry an ip.src/ip.dst and are
+# kept. Fragmented datagrams and ICMP-encapsulated headers are skipped.
+################################################################################
+
+# Magic number -> (byte order, timestamp fraction digits)
+PCAP_MAGIC = {
+    b'\xd4\xc3\xb2\xa1': ('<', 6),
+    b'\xa1\xb2\xc3\xd4': ('>', 6),
+    b'\x4d\x3c\xb2\xa1': ('<', 9),
+    b'\xa1\xb2\x3c\x4d': ('>', 9),
+}
+
+# Link types
+DLT_NULL = 0
+DLT_EN10MB = 1
+DLT_RAW = (12, 14, 101)
+DLT_LOOP = 108
+DLT_LINUX_SLL = 113
+DLT_IPV4 = 228
+DLT_LINUX_SLL2 = 276
+
+ETH_TYPE_IP = 0x0800
+ETH_TYPE_8021Q = 0x8100
+IP_PROTO_TCP = 6
+IP_PROTO_UDP = 17
+
+PCAP_HEADER_LEN = 24
+RECORD_HEADER_LEN = 16
+UDP_HEADER_LEN = 8
+
+
+class UnsupportedCapture(ValueError):
+    """The capture is not a classic pcap file with a supported link type"""
+
+
+################################################################################
+# Byte gathering helpers over a uint8 buffer (big-endian network fields)
+def _u8(buf, idx):
+    return buf[idx].astype(np.int64)
+
+
+def _u16(buf, idx):
+    return (_u8(buf, idx) << 8) | _u8(buf, idx + 1)
+
+
+def _u32(buf, idx):
+    return (_u16(buf, idx) << 16) | _u16(buf, idx + 2)
+
+
+def _record_offsets(raw, byte_order):
+    """Walk the record headers; a truncated last record is dropped like tcpdump does"""
+    offsets = []
+    incl_len = struct.Struct(byte_order + 'I')
+    off = PCAP_HEADER_LEN
+    end = len(raw)
+    while off + RECORD_HEADER_LEN <= end:
+        size = incl_len.unpack_from(raw, off + 8)[0]
+        if off + RECORD_HEADER_LEN + size > end:
+            break
+        offsets.append(off)
+        off += RECORD_HEADER_LEN + size
+    return np.array(offsets, dtype=np.int64)
+
+
+def _epoch_times(seconds, fraction, digits):
+    """
+    Timestamps as the float tshark prints and Python parses for frame.time_epoch.
+    With microseconds sec * 10^6 + usec is exact in a float64, so one division
+    gives the correctly rounded value; nanoseconds go through the decimal string.
+    """
+    if digits == 6:
+        return (seconds * 1_000_000 + fraction).astype(np.float64) / 1e6
+    text = np.char.add(np.char.add(seconds.astype(str), '.'), np.char.zfill(fraction.astype(str), digits))
+    return text.astype(np.float64)
+
+
+def _network_offsets(buf, start, length, linktype):
+    """Offset of the IPv4 header of each record and a mask of the records that carry one"""
+    if linktype == DLT_EN10MB:
+        ok = length >= 14
+        ethertype = np.where(ok, _u16(buf, np.where(ok, start + 12, 0)), 0)
+        tagged = ok & (ethertype == ETH_TYPE_8021Q) & (length >= 18)
+        ethertype = np.where(tagged, _u16(buf, np.where(tagged, start + 16, 0)), ethertype)
+        return start + np.where(tagged, 18, 14), ok & (ethertype == ETH_TYPE_IP)
+    if linktype == DLT_LINUX_SLL:
+        ok = length >= 16
+        return start + 16, ok & (np.where(ok, _u16(buf, np.where(ok, start + 14, 0)), 0) == ETH_TYPE_IP)
+    if linktype == DLT_LINUX_SLL2:
+        ok = length >= 20
+        return start + 20, ok & (np.where(ok, _u16(buf, start), 0) == ETH_TYPE_IP)
+    if linktype in (DLT_NULL, DLT_LOOP):
+        ok = length >= 4
+        family = np.where(ok, _u32(buf, np.where(ok, start, 0)), 0)
+        # DLT_NULL stores the family in host byte order: accept AF_INET both ways
+        return start + 4, ok & ((family == socket.AF_INET) | (family == socket.AF_INET << 24))
+    if linktype in DLT_RAW or linktype == DLT_IPV4:
+        return start, length >= 1
+    raise UnsupportedCapture(f"unsupported link type {linktype}")
+
+
+################################################################################
+def read_pcap(path):
+    """
+    Decode a pcap file into arrays, one entry per IPv4 TCP/UDP packet:
+      times   -> float64 epoch timestamps (frame.time_epoch)
+      src/dst -> uint32 IPv4 addresses
+      payload -> int64 TCP payload length, or UDP length minus its header
+    """
+    with open(path, 'rb') as f:
+        raw = f.read()
+    magic = raw[:4]
+    if len(raw) < PCAP_HEADER_LEN or magic not in PCAP_MAGIC:
+        raise UnsupportedCapture("not a classic pcap file")
+    byte_order, digits = PCAP_MAGIC[magic]
+    linktype = struct.unpack_from(byte_order + 'I', raw, 20)[0] & 0x0fffffff
+
+    records = _record_offsets(raw, byte_order)
+    empty = np.zeros(0, dtype=np.int64)
+    if records.size == 0:
+        return np.zeros(0, dtype=np.float64), empty.astype(np.uint32), empty.astype(np.uint32), empty
+
+    # Record headers (ts_sec, ts_frac, incl_len), in the capture's byte order
+    words = np.frombuffer(raw, dtype=np.uint8)
+    header_dtype = np.dtype(byte_order + 'u4')
+    header = words[records[:, None] + np.arange(12)].view(header_dtype).astype(np.int64)
+    ts_sec, ts_frac, incl_len = header[:, 0], header[:, 1], header[:, 2]
+    start = records + RECORD_HEADER_LEN
+    end = start + incl_len
+
+    # Pad the buffer so that gathers past a short packet stay in bounds; they
+    # are masked out below.
+    buf = np.concatenate((words, np.zeros(64, dtype=np.uint8)))
+
+    # Link layer -> IPv4 header
+    net, is_ip = _network_offsets(buf, start, incl_len, linktype)
+    is_ip &= net + 20 <= end
+    net = np.where(is_ip, net, 0)
+    version_ihl = _u8(buf, net)
+    ihl = (version_ihl & 0x0f) * 4
+    is_ip &= ((version_ihl >> 4) == 4) & (ihl >= 20)
+    total_len = _u16(buf, net + 2)
+    unfragmented = (_u16(buf, net + 6) & 0x3fff) == 0
+    proto = _u8(buf, net + 9)
+    is_tcp = is_ip & unfragmented & (proto == IP_PROTO_TCP)
+    is_udp = is_ip & unfragmented & (proto == IP_PROTO_UDP)
+
+    # Transport layer
+    l4 = net + ihl
+    is_tcp &= l4 + 20 <= end
+    is_udp &= l4 + UDP_HEADER_LEN <= end
+    keep = is_tcp | is_udp
+    l4 = np.where(keep, l4, 0)
+    tcp_len = total_len - ihl - (_u8(buf, l4 + 12) >> 4) * 4
+    udp_len = _u16(buf, l4 + 4) - UDP_HEADER_LEN
+    payload = np.maximum(np.where(is_tcp, tcp_len, udp_len), 0)
+
+    times = _epoch_times(ts_sec[keep], ts_frac[keep], digits)
+    src = _u32(buf, net[keep] + 12).astype(np.uint32)
+    dst = _u32(buf, net[keep] + 16).astype(np.uint32)
+    return times, src, dst, payload[keep]
+
+
+def detect_client_ip(src, dst):
+    """
+    Same heuristic as the tshark path: the address seen most often among
+    src/dst, ties going to the one that appears first.
+    """
+    if src.size == 0:
+        return None
+    seen = np.empty(src.size * 2, dtype=np.uint32)
+    seen[0::2] = src
+    seen[1::2] = dst
+    addresses, first, counts = np.unique(seen, return_index=True, return_counts=True)
+    candidates = np.flatnonzero(counts == counts.max())
+    return int(addresses[candidates[np.argmin(first[candidates])]])
+
+
+def decode_trace(path, client_ip=None, drop_zero_payload=True):
+    """
+    Decode a capture straight into a trace: (rel_times, signed_lens, client_ip)
+    with + for the packets sent by the client, as in the Wang14 files. The
+    client is detected when client_ip is not given; it is None for a capture
+    without packets.
+    """
+    times, src, dst, payload = read_pcap(path)
+    if drop_zero_payload:
+        keep = payload != 0
+        times, src, dst, payload = times[keep], src[keep], dst[keep], payload[keep]
+
+    if times.size == 0:
+        return times, payload, None
+
+    local_ip = ip_to_int(client_ip) if client_ip else detect_client_ip(src, dst)
+    return times - times[0], np.where(src == local_ip, payload, -payload), local_ip
+
+
+def ip_to_int(address):
+    return struct.unpack('!I', socket.inet_aton(address))[0]
+
+
+def int_to_ip(address):
+    return socket.inet_ntoa(struct.pack('!I', address))
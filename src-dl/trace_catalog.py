@@ -0,0 +1,284 @@
+import os
+import argparse
+import numpy as np
+from trace_store import TraceStore, is_trace_store, trace_name, parse_trace_name, UNMONITORED_SAMPLE
+from wang14 import read_traces
+
+################################################################################
+# Catalog of a folder of Wang14 trace files.
+#
+# One scan of the folder records, for every file named x-y (or x for
+# unmonitored traces), or x_y.pcap when cataloguing captures:
+#
+#   sites, samples   int32     parsed from the name (sample -1 for x)
+#   paths            str       path relative to the folder
+#   sizes            int64     file size in bytes
+#   mtimes           int64     modification time in nanoseconds
+#
+# The catalog is saved next to the folder (<folder>.catalog.npz) and refreshed
+# incrementally when opened: folders whose mtime did not change are not listed
+# again, and only files that are new to the catalog are stat'ed. A file
+# rewritten in place keeps the folder mtime, so use refresh(full=True) (or
+# --full) to pick up new sizes/mtimes of existing files.
+#
+# Entries are sorted by (site, sample), and expose the same sites/samples
+# columns as a TraceStore so loaders can select traces the same way for both.
+#
+# Trace index files (one trace name x-y or x per line, like RF's
+# list/Index_*.txt) select a subset of either: see write_index/index_mask.
+################################################################################
+
+CATALOG_VERSION = 2
+CATALOG_SUFFIX = ".catalog.npz"
+
+
+def _mtime(path):
+    try:
+        return os.stat(path).st_mtime_ns
+    except FileNotFoundError:
+        return None
+
+
+def samples_by_site(sites, samples):
+    """{site: sorted monitored samples} from the sites/samples columns of a catalog or store, in one pass"""
+    monitored = np.flatnonzero(np.asarray(samples) != UNMONITORED_SAMPLE)
+    sites, samples = np.asarray(sites)[monitored], np.asarray(samples)[monitored]
+    order = np.lexsort((samples, sites))
+    sites, samples = sites[order], samples[order]
+    keys, starts = np.unique(sites, return_index=True)
+    return {int(s): g.tolist() for s, g in zip(keys, np.split(samples, starts[1:]))}
+
+
+def catalog_path(directory, suffix=""):
+    return os.path.normpath(directory) + suffix + CATALOG_SUFFIX
+
+
+class TraceCatalog:
+    """Index of the trace files of a folder"""
+
+    def __init__(self, directory, separator="-", suffix=""):
+        self.directory = directory
+        self.separator = separator
+        self.suffix = suffix
+        self.sites = np.zeros(0, dtype=np.int32)
+        self.samples = np.zeros(0, dtype=np.int32)
+        self.paths = np.zeros(0, dtype=str)
+        self.sizes = np.zeros(0, dtype=np.int64)
+        self.mtimes = np.zeros(0, dtype=np.int64)
+        self._folders = {}
+        self._index = None
+
+    @classmethod
+    def open(cls, directory, separator="-", suffix="", refresh=True):
+        """
+        Load the saved catalog of a folder, bring it up to date and save it
+        back. Only files named <site><separator><sample><suffix> are listed.
+        """
+        catalog = cls(directory, separator, suffix)
+        catalog._load()
+        if refresh and catalog.refresh():
+            catalog.save()
+        return catalog
+
+    def __len__(self):
+        return self.sites.shape[0]
+
+    def path(self, i):
+        return os.path.join(self.directory, self.paths[i])
+
+    def index(self, site, sample=UNMONITORED_SAMPLE):
+        """Position of a (site, sample) trace, or None if the folder does not have it"""
+        if self._index is None:
+            self._index = {(s, n): i for i, (s, n) in enumerate(zip(self.sites.tolist(), self.samples.tolist()))}
+        return self._index.get((site, sample))
+
+    ############################################################################
+    def _load(self):
+        path = catalog_path(self.directory, self.suffix)
+        if not os.path.isfile(path):
+            return
+        with np.load(path) as data:
+            if int(data["version"]) != CATALOG_VERSION or str(data["separator"]) != self.separator \
+                    or str(data["suffix"]) != self.suffix:
+                return
+            self.sites, self.samples = data["sites"], data["samples"]
+            self.paths, self.sizes, self.mtimes = data["paths"], data["sizes"], data["mtimes"]
+            self._folders = dict(zip(data["folders"].tolist(), data["folder_mtimes"].tolist()))
+
+    def save(self):
+        """Write the catalog next to the folder; a read-only location is not an error"""
+        path = catalog_path(self.directory, self.suffix)
+        tmp = path + ".tmp.npz"
+        try:
+            np.savez(tmp, version=CATALOG_VERSION, separator=self.separator, suffix=self.suffix,
+                     sites=self.sites, samples=self.samples, paths=self.paths,
+                     sizes=self.sizes, mtimes=self.mtimes,
+                     folders=np.array(list(self._folders), dtype=str),
+                     folder_mtimes=np.array(list(self._folders.values()), dtype=np.int64))
+            os.replace(tmp, path)
+        except OSError as e:
+            print(f"[WARN] Could not save the trace catalog {path}: {e}")
+
+    def refresh(self, full=False):
+        """
+        Rescan the folders that changed since the last scan (all of them, and
+        stat every file again, with full=True). Returns True if the catalog changed.
+        """
+        if not os.path.isdir(self.directory):
+            raise FileNotFoundError(f"Trace folder not found: {self.directory}")
+        if not full and self._folders and all(_mtime(os.path.join(self.directory, f)) == m
+                                              for f, m in self._folders.items()):
+            return False
+
+        known, by_folder = {}, {}
+        if not full:
+            for p, size, mtime in zip(self.paths.tolist(), self.sizes.tolist(), self.mtimes.tolist()):
+                known[p] = (size, mtime)
+                by_folder.setdefault(os.path.dirname(p), []).append(p)
+        old_folders = {} if full else self._folders
+        subfolders = {}
+        for f in old_folders:
+            if f:
+                subfolders.setdefault(os.path.dirname(f), []).append(f)
+
+        folders, entries = {}, []
+        pending = [""]
+        while pending:
+            folder = pending.pop()
+            mtime = _mtime(os.path.join(self.directory, folder))
+            if mtime is None:
+                continue
+            folders[folder] = mtime
+
+            if old_folders.get(folder) == mtime:
+                # Unchanged listing: keep its files and subfolders from the catalog
+                pending.extend(subfolders.get(folder, []))
+                entries.extend(by_folder.get(folder, []))
+                continue
+
+            with os.scandir(os.path.join(self.directory, folder)) as it:
+                for entry in it:
+                    rel = os.path.join(folder, entry.name)
+                    if entry.is_dir():
+                        pending.append(rel)
+                    elif self._parse(entry.name) is not None and entry.is_file():
+                        if rel not in known:
+                            st = entry.stat()
+                            known[rel] = (st.st_size, st.st_mtime_ns)
+                        entries.append(rel)
+
+        self._set(entries, known, folders)
+        return True
+
+    def _parse(self, name):
+        if not name.endswith(self.suffix):
+            return None
+        return parse_trace_name(name[:len(name) - len(self.suffix)], self.separator)
+
+    def _set(self, entries, known, folders):
+        labels = np.array([self._parse(os.path.basename(p)) for p in entries],
+                          dtype=np.int32).reshape(-1, 2)
+        order = np.lexsort((labels[:, 1], labels[:, 0]))
+        stats = np.array([known[p] for p in entries], dtype=np.int64).reshape(-1, 2)
+        self.sites, self.samples = labels[order, 0], labels[order, 1]
+        self.paths = np.array(entries, dtype=str)[order] if entries else np.zeros(0, dtype=str)
+        self.sizes, self.mtimes = stats[order, 0], stats[order, 1]
+        self._folders = folders
+        self._index = None
+
+
+################################################################################
+def open_traces(path):
+    """Label source of a trace store or of a folder of Wang14 files (its catalog)"""
+    return TraceStore(path) if is_trace_store(path) else TraceCatalog.open(path)
+
+
+def iter_trace_batches(path, batch_size):
+    """
+    Traces of a store or Wang14 folder as (labels int32[n, 2], times, sizes,
+    offsets) per batch of batch_size traces, zero-size rows dropped
+    """
+    source = open_traces(path)
+    if isinstance(source, TraceStore):
+        labels = source.labels
+        read = source.traces
+    else:
+        labels = np.stack((source.sites, source.samples), axis=1)
+        read = lambda start, end: read_traces([source.path(i) for i in range(start, min(end, len(source)))])
+
+    for start in range(0, len(source), batch_size):
+        times, sizes, offsets = read(start, start + batch_size)
+        keep = sizes != 0
+        if not keep.all():
+            owner = np.repeat(np.arange(offsets.size - 1), np.diff(offsets))
+            offsets = np.concatenate(([0], np.cumsum(np.bincount(owner[keep], minlength=offsets.size - 1))))
+            times, sizes = times[keep], sizes[keep]
+        yield np.asarray(labels[start:start + batch_size]), times, sizes, offsets
+
+
+def write_index(path, sites, samples):
+    """Write a trace index: one trace name per line, in the given order"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(path, "w") as f:
+        f.writelines(trace_name(s, n) + "\n" for s, n in zip(np.asarray(sites).tolist(), np.asarray(samples).tolist()))
+
+
+def read_index(path):
+    """(site, sample) int32[n, 2] of the traces listed in an index file"""
+    with open(path) as f:
+        labels = [parse_trace_name(line.strip()) for line in f if line.strip()]
+    return np.array([l for l in labels if l is not None], dtype=np.int32).reshape(-1, 2)
+
+
+def _label_keys(sites, samples):
+    return (np.asarray(sites, dtype=np.int64) << 32) | (np.asarray(samples, dtype=np.int64) & 0xffffffff)
+
+
+def label_mask(sites, samples, labels):
+    """Mask of the traces (given by their sites/samples columns) whose (site, sample) is in labels int32[n, 2]"""
+    labels = np.asarray(labels).reshape(-1, 2)
+    return np.isin(_label_keys(sites, samples), _label_keys(labels[:, 0], labels[:, 1]))
+
+
+def index_mask(sites, samples, index_path):
+    """Mask of the traces (given by their sites/samples columns) listed in an index file"""
+    return label_mask(sites, samples, read_index(index_path))
+
+
+def class_selection(sites, samples, monitored_sites, monitored_samples, unmonitored_sites=0, indices=None,
+                    index_path=None):
+    """
+    (indices, labels int64) of the traces a classifier works on: the given
+    indices, or samples 0..monitored_samples-1 of the first monitored_sites
+    sites, plus the unmonitored traces (sample -1) of the first
+    unmonitored_sites sites, within an index file if index_path. Unmonitored
+    traces get label monitored_sites.
+    """
+    sites, samples = np.asarray(sites), np.asarray(samples)
+    if indices is None:
+        selected = (sites < monitored_sites) & (samples >= 0) & (samples < monitored_samples)
+        selected |= (samples == UNMONITORED_SAMPLE) & (sites < unmonitored_sites)
+        if index_path:
+            selected &= index_mask(sites, samples, index_path)
+        indices = np.flatnonzero(selected)
+    indices = np.asarray(indices)
+    labels = np.where(samples == UNMONITORED_SAMPLE, monitored_sites, sites)[indices]
+    return indices, labels.astype(np.int64)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Build or refresh the catalog of a folder of Wang14 trace files.')
+    parser.add_argument('traces', help='Directory with the Wang14 trace files (x-y).')
+    parser.add_argument('--pcap', action='store_true', help='Catalog x_y.pcap captures instead.')
+    parser.add_argument('--full', action='store_true', help='Stat every file again, not only new ones.')
+    args = parser.parse_args()
+
+    separator, suffix = ("_", ".pcap") if args.pcap else ("-", "")
+    catalog = TraceCatalog.open(args.traces, separator, suffix, refresh=not args.full)
+    if args.full:
+        catalog.refresh(full=True)
+        catalog.save()
+    print(f"[OK] {len(catalog)} traces from {len(np.unique(catalog.sites))} sites in {args.traces}, "
+          f"catalog saved to {catalog_path(args.traces, suffix)}")
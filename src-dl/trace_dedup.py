@@ -0,0 +1,180 @@
+import os
+import json
+import argparse
+import numpy as np
+from trace_catalog import iter_trace_batches, write_index
+
+################################################################################
+# Constants
+BATCH_TRACES = 2000         # traces signed at once
+MAX_PACKETS = 5000          # packets of each trace that are signed (RF max_trace_length)
+SIZE_QUANTUM = 200          # bytes per size level of a packet token
+SIZE_LEVELS = 8             # size levels per direction (larger packets share the last one)
+NGRAM = 4                   # packets per shingle
+NUM_HASHES = 64             # MinHash signature length (a power of two)
+BANDS = 16                  # LSH bands (NUM_HASHES / BANDS rows each)
+THRESHOLD = 0.9             # estimated Jaccard similarity of near-duplicates
+SEED = 0
+
+EMPTY = 0xffffffff          # signature entry of a bin without shingles
+DENSIFY_STEP = 0x9e3779b1   # offset added per bin borrowed during densification
+
+################################################################################
+# Near-duplicate trace detection.
+#
+# Every trace is turned into the set of its NGRAM-packet shingles, a packet
+# being its direction and quantized size. A (one-permutation) MinHash
+# signature of that set estimates the Jaccard similarity of two traces by the
+# fraction of equal entries. Within each class, traces whose signatures agree on a whole LSH band
+# land in the same bucket; only bucket members are compared (to the first one
+# of their bucket), never all pairs. Pairs above THRESHOLD are merged into
+# groups and one trace per group (the lowest sample) is kept.
+#
+# The kept traces are written as a trace index (one x-y name per line, like
+# RF's list/Index_*.txt) that the extract scripts, Tik-Tok and DL_Experiments
+# take to restrict their input.
+################################################################################
+
+def _hash_params(seed=SEED):
+    rng = np.random.default_rng(seed)
+    a = rng.integers(1, 2 ** 63, dtype=np.uint64) | np.uint64(1)
+    b = rng.integers(0, 2 ** 63, dtype=np.uint64)
+    return a, b
+
+
+def minhash_signatures(sizes, offsets, a, b):
+    """
+    One-permutation MinHash signatures (uint32[n, NUM_HASHES]) of the shingle
+    sets of a batch of traces: every shingle is hashed once, the top bits pick
+    one of NUM_HASHES bins and each bin keeps its minimum. Empty bins borrow
+    the next non-empty bin (rotation densification). Traces with fewer than
+    NGRAM packets get no shingle and a signature of all EMPTY.
+    """
+    n = offsets.size - 1
+    lengths = np.minimum(np.diff(offsets), MAX_PACKETS)
+    # First MAX_PACKETS packets of each trace
+    owner = np.repeat(np.arange(n), lengths)
+    position = np.arange(owner.size) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    sizes = np.asarray(sizes)[offsets[:-1][owner] + position].astype(np.int64)
+
+    # Packet tokens in [0, 2 * SIZE_LEVELS): direction and size level
+    level = np.minimum(np.abs(sizes) // SIZE_QUANTUM, SIZE_LEVELS - 1)
+    token = np.where(sizes > 0, level, level + SIZE_LEVELS)
+
+    # Shingles that do not cross a trace boundary
+    count = max(token.size - NGRAM + 1, 0)
+    valid = position[:count] + NGRAM <= lengths[owner[:count]]
+    shingle = np.zeros(count, dtype=np.uint64)
+    for j in range(NGRAM):
+        shingle = shingle * np.uint64(2 * SIZE_LEVELS) + token[j:j + count].astype(np.uint64)
+    shingle_owner, shingle = owner[:count][valid].astype(np.uint64), shingle[valid]
+
+    # Multiply-shift hash: the top bits give the bin, the next 32 bits the value
+    hashed = a * shingle + b
+    bin_bits = np.uint64(NUM_HASHES.bit_length() - 1)
+    keys = (shingle_owner << (bin_bits + np.uint64(32))) | (hashed >> (np.uint64(64 - 32) - bin_bits))
+    keys.sort()
+    first = np.r_[True, (keys[1:] >> np.uint64(32)) != (keys[:-1] >> np.uint64(32))] if keys.size else keys
+    keys = keys[first]
+
+    signatures = np.full((n, NUM_HASHES), EMPTY, dtype=np.uint32)
+    signatures[(keys >> (bin_bits + np.uint64(32))).astype(np.int64),
+               ((keys >> np.uint64(32)) & np.uint64(NUM_HASHES - 1)).astype(np.int64)] = keys.astype(np.uint32)
+
+    # Densification: an empty bin takes the next non-empty bin to its right
+    # (cyclically), shifted by its distance so that borrowed values stay distinct
+    filled = signatures != EMPTY
+    partial = filled.any(axis=1) & ~filled.all(axis=1)
+    if partial.any():
+        rows = signatures[partial]
+        doubled = np.concatenate((rows, rows), axis=1)
+        columns = np.where(np.concatenate((filled[partial], filled[partial]), axis=1),
+                           np.arange(2 * NUM_HASHES), 2 * NUM_HASHES)
+        following = np.minimum.accumulate(columns[:, ::-1], axis=1)[:, ::-1][:, :NUM_HASHES]
+        distance = (following - np.arange(NUM_HASHES)).astype(np.uint32)
+        borrowed = np.take_along_axis(doubled, following, axis=1) + distance * np.uint32(DENSIFY_STEP)
+        signatures[partial] = np.where(filled[partial], rows, borrowed)
+    return signatures
+
+
+def near_duplicate_groups(sites, signatures, bands=BANDS, threshold=THRESHOLD):
+    """
+    Group id of every trace: traces of the same site whose signatures share an
+    LSH bucket and agree on at least `threshold` of their entries are merged.
+    """
+    n = signatures.shape[0]
+    group = np.arange(n)
+    signed = np.flatnonzero((signatures != EMPTY).any(axis=1))
+    rows = signatures.shape[1] // bands
+    edges = []
+    for band in range(bands):
+        # Bucket key: site and the band of the signature
+        key = np.concatenate((sites[signed, None].astype(np.uint32),
+                              signatures[signed, band * rows:(band + 1) * rows]), axis=1)
+        key = np.ascontiguousarray(key).view(np.dtype((np.void, key.dtype.itemsize * key.shape[1]))).ravel()
+        _, first, bucket = np.unique(key, return_index=True, return_inverse=True)
+        representative = signed[first[bucket]]
+        member = signed[representative != signed]
+        representative = representative[representative != signed]
+        if member.size == 0:
+            continue
+        similarity = (signatures[member] == signatures[representative]).mean(axis=1)
+        close = similarity >= threshold
+        edges.append(np.stack((member[close], representative[close]), axis=1))
+
+    # Connected components of the near-duplicate pairs
+    edges = np.concatenate(edges) if edges else np.zeros((0, 2), dtype=np.int64)
+    while edges.size:
+        low = np.minimum(group[edges[:, 0]], group[edges[:, 1]])
+        updated = group.copy()
+        np.minimum.at(updated, edges[:, 0], low)
+        np.minimum.at(updated, edges[:, 1], low)
+        updated = updated[updated]
+        if np.array_equal(updated, group):
+            break
+        group = updated
+    return group
+
+
+def deduplicate(path, index_path, batch_size=BATCH_TRACES, threshold=THRESHOLD, seed=SEED):
+    """Write the index of the traces left after dropping near-duplicates; returns a summary"""
+    a, b = _hash_params(seed)
+    labels, signatures = [], []
+    for batch_labels, _times, sizes, offsets in iter_trace_batches(path, batch_size):
+        labels.append(batch_labels)
+        signatures.append(minhash_signatures(sizes, offsets, a, b))
+    labels = np.concatenate(labels) if labels else np.zeros((0, 2), dtype=np.int32)
+    signatures = np.concatenate(signatures) if signatures else np.zeros((0, NUM_HASHES), dtype=np.uint32)
+
+    # Lowest sample first so that it is the one kept in its group
+    order = np.lexsort((labels[:, 1], labels[:, 0]))
+    labels, signatures = labels[order], signatures[order]
+    group = near_duplicate_groups(labels[:, 0], signatures, threshold=threshold)
+    kept = group == np.arange(group.size)
+
+    write_index(index_path, labels[kept, 0], labels[kept, 1])
+    removed_per_site = np.bincount(labels[~kept, 0]) if (~kept).any() else np.zeros(0, dtype=np.int64)
+    return {
+        'source': os.path.abspath(path),
+        'index': os.path.abspath(index_path),
+        'traces': int(labels.shape[0]),
+        'kept': int(kept.sum()),
+        'removed': int((~kept).sum()),
+        'groups_with_duplicates': int(np.unique(group[~kept]).size),
+        'sites_with_duplicates': int(np.count_nonzero(removed_per_site)),
+        'threshold': threshold,
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Drop near-duplicate traces within each class and write the index of the rest.')
+    parser.add_argument('traces', help='Trace store or directory with the Wang14 trace files (x-y).')
+    parser.add_argument('index', help='Output trace index (one x-y name per line).')
+    parser.add_argument('-t', '--threshold', type=float, default=THRESHOLD,
+                        help='Estimated Jaccard similarity above which two traces are duplicates.')
+    parser.add_argument('--seed', type=int, default=SEED, help='Seed of the MinHash functions.')
+    args = parser.parse_args()
+
+    summary = deduplicate(args.traces, args.index, threshold=args.threshold, seed=args.seed)
+    print(json.dumps(summary, indent=2))
+    print(f"[OK] Kept {summary['kept']} of {summary['traces']} traces, index written to {args.index}")
@@ -0,0 +1,277 @@
+import os
+import json
+import argparse
+import multiprocessing as mp
+import numpy as np
+from trace_store import TraceStore, TraceStoreWriter, COMPRESSIONS
+
+################################################################################
+# Constants
+BATCH_TRACES = 500          # traces simulated at once by a worker
+PROCESSES = os.cpu_count()
+PACKET_SIZE = 1448          # bytes of a padding packet (TCP payload of a full segment)
+SEED = 0
+
+# Constant rate (BuFLO): one PACKET_SIZE packet per direction every INTERVAL
+# seconds, for at least MIN_DURATION seconds and until the data is sent
+CR_INTERVAL = 0.02
+CR_MIN_DURATION = 10
+
+# WTF-PAD style adaptive padding: timers drawn from the trace's own
+# inter-arrival times, or never firing with probability WTFPAD_NO_PADDING
+WTFPAD_NO_PADDING = 0.5
+WTFPAD_MAX_DUMMIES = 32     # dummies sent at most in one gap
+
+# FRONT: up to *_BUDGET dummies per direction, Rayleigh distributed over a
+# window drawn in [FRONT_MIN_WINDOW, FRONT_MAX_WINDOW] seconds
+FRONT_CLIENT_BUDGET = 1700
+FRONT_SERVER_BUDGET = 1700
+FRONT_MIN_WINDOW = 1
+FRONT_MAX_WINDOW = 14
+
+OVERHEAD_FILE = "overhead.csv"
+DEFENSE_FILE = "defense.json"
+
+################################################################################
+# Defense simulator.
+#
+# Reads a trace store in batches of concatenated arrays and writes a defended
+# copy of it, for RF (defence) / Tik-Tok / DL_Experiments to train and test on
+# as any other store. Each defense works on a whole batch at once, every trace
+# being split into an outgoing and an incoming stream:
+#
+#   constant_rate   BuFLO: fixed-size packets at a fixed rate. The bytes sent
+#                   by slot k are min_j<=k (arrived(j) + (k - j) * size), a
+#                   running minimum, so queueing delays come out without a loop
+#                   over packets
+#   wtfpad          WTF-PAD style: after every packet a timer is drawn from the
+#                   stream's own inter-arrival times; when it expires before
+#                   the next real packet a dummy is sent and a new timer drawn
+#   front           FRONT: a random number of dummies per direction at
+#                   Rayleigh distributed times (random window), up to the end
+#                   of the trace
+#
+# Padding only adds packets (zero delay) except for constant_rate. Next to the
+# defended traces, overhead.csv holds the per-trace bandwidth overhead (extra
+# bytes / original bytes) and latency overhead (extra time until the last real
+# byte is delivered / original duration), and defense.json the parameters.
+#
+# Batches are simulated by a pool of processes, each with its own generator
+# seeded from (seed, first trace of the batch): the output does not depend on
+# the number of processes.
+################################################################################
+
+def _owner(offsets):
+    return np.repeat(np.arange(offsets.size - 1), np.diff(offsets))
+
+
+def _streams(times, sizes, offsets):
+    """Packets ordered by stream (trace * 2, + 1 if incoming) and time, with per-stream counts/starts"""
+    stream = _owner(offsets) * 2 + (sizes < 0)
+    order = np.lexsort((times, stream))
+    counts = np.bincount(stream, minlength=2 * (offsets.size - 1))
+    return order, stream[order], counts, np.cumsum(counts) - counts
+
+
+def _pack(owner, times, sizes, n):
+    """Concatenated arrays of the packets of n traces, sorted by time (ties keep their order)"""
+    order = np.lexsort((times, owner))
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(owner, minlength=n))))
+    return times[order], sizes[order], offsets
+
+
+def _trace_end(times, offsets):
+    end = np.zeros(offsets.size - 1)
+    nonempty = np.diff(offsets) > 0
+    end[nonempty] = np.maximum.reduceat(times, offsets[:-1][nonempty]) if times.size else 0
+    return end
+
+
+################################################################################
+def constant_rate(times, sizes, offsets, rng, interval=CR_INTERVAL, min_duration=CR_MIN_DURATION,
+                  packet_size=PACKET_SIZE):
+    n = offsets.size - 1
+    order, stream, counts, first = _streams(times, sizes, offsets)
+    t, b = times[order], np.abs(sizes[order]).astype(np.int64)
+    total = np.bincount(stream, weights=b, minlength=2 * n).astype(np.int64)
+    last = np.zeros(2 * n)
+    last[counts > 0] = t[(first + counts - 1)[counts > 0]]
+
+    # Slots k * interval of each stream, enough to drain it after its last arrival
+    min_slots = int(np.ceil(min_duration / interval))
+    slots = np.maximum(np.ceil(last / interval).astype(np.int64) + -(-total // packet_size) + 1, min_slots)
+    slot_stream = np.repeat(np.arange(2 * n), slots)
+    k = np.arange(slot_stream.size) - np.repeat(np.cumsum(slots) - slots, slots)
+    slot_time = k * interval
+
+    # Bytes arrived by each slot (time keys shifted per stream to search all streams at once)
+    span = float(slot_time.max(initial=0) + t.max(initial=0) + 1)
+    cumulative = np.concatenate(([0], np.cumsum(b)))
+    arrived = cumulative[np.searchsorted(stream * span + t, slot_stream * span + slot_time, side='right')] \
+        - cumulative[first[slot_stream]]
+
+    # Bytes sent by the end of slot k, min over j <= k of arrived(j) + (k - j) * size and
+    # (k + 1) * size; the per-stream shift makes the running minimum restart at every stream
+    relative = arrived - k * packet_size
+    shift = slot_stream * (2 * (np.abs(relative).max(initial=0) + 1))
+    sent = np.minimum(np.minimum.accumulate(relative - shift) + shift + k * packet_size, (k + 1) * packet_size)
+
+    # Keep sending until the stream is drained and min_duration has passed
+    drained_at = np.bincount(slot_stream, weights=sent < total[slot_stream], minlength=2 * n).astype(np.int64)
+    kept = k <= np.maximum(drained_at, min_slots - 1)[slot_stream]
+
+    # Delivery of the last real byte of each stream
+    scale = total.max(initial=0) + 1
+    delivered = np.zeros(2 * n)
+    nonempty = counts > 0
+    done = np.searchsorted(sent + slot_stream * scale, total[nonempty] + np.flatnonzero(nonempty) * scale)
+    delivered[nonempty] = slot_time[done]
+
+    slot_stream, slot_time = slot_stream[kept], slot_time[kept]
+    out_sizes = np.where(slot_stream % 2 == 0, packet_size, -packet_size).astype(np.int32)
+    return _pack(slot_stream // 2, slot_time, out_sizes, n) + (delivered.reshape(n, 2).max(axis=1),)
+
+
+def wtfpad(times, sizes, offsets, rng, no_padding=WTFPAD_NO_PADDING, max_dummies=WTFPAD_MAX_DUMMIES,
+           packet_size=PACKET_SIZE):
+    n = offsets.size - 1
+    order, stream, counts, first = _streams(times, sizes, offsets)
+    t = times[order]
+    end = _trace_end(times, offsets)
+
+    # Gap after each packet of a stream: to its next packet, or to the end of the trace
+    is_last = np.arange(t.size) == (first + counts - 1)[stream]
+    gap = np.where(is_last, end[stream // 2] - t, np.r_[t[1:], 0] - t)
+
+    # Timer histogram of a stream: its own (non-zero) inter-arrival times
+    usable = ~is_last & (gap > 0)
+    iat, iat_stream = gap[usable], stream[usable]
+    iat_count = np.bincount(iat_stream, minlength=2 * n)
+    iat_first = np.cumsum(iat_count) - iat_count
+
+    pad = iat_count[stream] > 0
+    current, remaining, owner = t[pad], gap[pad], stream[pad]
+    dummy_times, dummy_streams = [], []
+    for _ in range(max_dummies):
+        draw = iat_first[owner] + (rng.random(owner.size) * iat_count[owner]).astype(np.int64)
+        delay = np.where(rng.random(owner.size) < no_padding, np.inf, iat[draw])
+        fired = delay < remaining
+        current, remaining, owner = current[fired] + delay[fired], remaining[fired] - delay[fired], owner[fired]
+        if owner.size == 0:
+            break
+        dummy_times.append(current)
+        dummy_streams.append(owner)
+
+    dummy_streams = np.concatenate(dummy_streams) if dummy_streams else np.zeros(0, dtype=np.int64)
+    dummy_sizes = np.where(dummy_streams % 2 == 0, packet_size, -packet_size).astype(np.int32)
+    owner = np.concatenate((_owner(offsets), dummy_streams // 2))
+    all_times = np.concatenate([times] + dummy_times)
+    return _pack(owner, all_times, np.concatenate((sizes, dummy_sizes)), n) + (end,)
+
+
+def front(times, sizes, offsets, rng, client_budget=FRONT_CLIENT_BUDGET, server_budget=FRONT_SERVER_BUDGET,
+          min_window=FRONT_MIN_WINDOW, max_window=FRONT_MAX_WINDOW, packet_size=PACKET_SIZE):
+    n = offsets.size - 1
+    end = _trace_end(times, offsets)
+    owners, dummy_times, dummy_sizes = [_owner(offsets)], [times], [sizes]
+    for direction, budget in ((1, client_budget), (-1, server_budget)):
+        count = rng.integers(1, budget + 1, size=n)
+        window = rng.uniform(min_window, max_window, size=n)
+        owner = np.repeat(np.arange(n), count)
+        dummy = rng.rayleigh(window[owner])
+        kept = dummy <= end[owner]
+        owners.append(owner[kept])
+        dummy_times.append(dummy[kept])
+        dummy_sizes.append(np.full(np.count_nonzero(kept), direction * packet_size, dtype=np.int32))
+    return _pack(np.concatenate(owners), np.concatenate(dummy_times), np.concatenate(dummy_sizes), n) + (end,)
+
+
+DEFENSES = {'constant_rate': constant_rate, 'wtfpad': wtfpad, 'front': front}
+
+
+################################################################################
+def overheads(sizes, offsets, defended_sizes, defended_offsets, duration, completion):
+    """Per-trace bandwidth overhead (extra bytes / bytes) and latency overhead (extra time / duration)"""
+    owner, defended_owner = _owner(offsets), _owner(defended_offsets)
+    n = offsets.size - 1
+    original = np.bincount(owner, weights=np.abs(sizes), minlength=n)
+    defended = np.bincount(defended_owner, weights=np.abs(defended_sizes), minlength=n)
+    bandwidth = np.divide(defended - original, original, out=np.zeros(n), where=original > 0)
+    latency = np.divide(completion - duration, duration, out=np.zeros(n), where=duration > 0)
+    return bandwidth, latency
+
+
+def _simulate_batch(para):
+    store_path, start, end, defense, params, seed = para
+    times, sizes, offsets = TraceStore.open(store_path).traces(start, end)
+    keep = sizes != 0
+    if not keep.all():
+        offsets = np.concatenate(([0], np.cumsum(np.bincount(_owner(offsets)[keep], minlength=offsets.size - 1))))
+        times, sizes = times[keep], sizes[keep]
+
+    rng = np.random.default_rng([seed, start])
+    defended_times, defended_sizes, defended_offsets, completion = DEFENSES[defense](times, sizes, offsets, rng, **params)
+    bandwidth, latency = overheads(sizes, offsets, defended_sizes, defended_offsets,
+                                   _trace_end(times, offsets), completion)
+    return start, defended_times, defended_sizes, defended_offsets, bandwidth, latency
+
+
+def simulate(store_path, out_path, defense, params=None, seed=SEED, batch_size=BATCH_TRACES,
+             processes=PROCESSES, compression="none"):
+    """Write the defended copy of a store to out_path; returns a summary of the overheads"""
+    if defense not in DEFENSES:
+        raise ValueError(f"Unknown defense '{defense}', expected one of {list(DEFENSES)}")
+    params = params or {}
+    store = TraceStore(store_path)
+    labels = np.asarray(store.labels)
+    para_list = [(store_path, start, start + batch_size, defense, params, seed)
+                 for start in range(0, len(store), batch_size)]
+
+    bandwidth, latency = [], []
+    with TraceStoreWriter(out_path, mode="w", compression=compression) as writer, mp.Pool(processes) as pool:
+        for start, times, sizes, offsets, b, l in pool.imap(_simulate_batch, para_list):
+            writer.add_batch(labels[start:start + batch_size], times, sizes, offsets)
+            bandwidth.append(b)
+            latency.append(l)
+    bandwidth = np.concatenate(bandwidth) if bandwidth else np.zeros(0)
+    latency = np.concatenate(latency) if latency else np.zeros(0)
+
+    np.savetxt(os.path.join(out_path, OVERHEAD_FILE), np.column_stack((labels, bandwidth, latency)),
+               fmt=['%d', '%d', '%.6f', '%.6f'], delimiter=',', header='site,sample,bandwidth,latency', comments='')
+    summary = {
+        'source': os.path.abspath(store_path),
+        'output': os.path.abspath(out_path),
+        'defense': defense,
+        'params': params,
+        'seed': seed,
+        'traces': int(labels.shape[0]),
+        'bandwidth_overhead': {'mean': float(bandwidth.mean()), 'median': float(np.median(bandwidth))} if bandwidth.size else {},
+        'latency_overhead': {'mean': float(latency.mean()), 'median': float(np.median(latency))} if latency.size else {},
+    }
+    with open(os.path.join(out_path, DEFENSE_FILE), 'w') as f:
+        json.dump(summary, f, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Apply a padding/shaping defense to every trace of a trace store.')
+    parser.add_argument('store', help='Input trace store.')
+    parser.add_argument('output', help='Output trace store of the defended traces.')
+    parser.add_argument('-d', '--defense', choices=list(DEFENSES), required=True, help='Defense to simulate.')
+    parser.add_argument('-p', '--param', action='append', default=[], metavar='NAME=VALUE',
+                        help='Defense parameter, e.g. interval=0.01 (see the defense functions).')
+    parser.add_argument('-c', '--compression', choices=COMPRESSIONS, default='none', help='Compression of the output store.')
+    parser.add_argument('--seed', type=int, default=SEED, help='Seed of the simulation.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_TRACES, help='Traces simulated at once.')
+    parser.add_argument('--processes', type=int, default=PROCESSES, help='Worker processes.')
+    args = parser.parse_args()
+
+    params = {}
+    for p in args.param:
+        name, _, value = p.partition('=')
+        params[name] = float(value) if '.' in value or 'e' in value else int(value)
+
+    summary = simulate(args.store, args.output, args.defense, params, args.seed, args.batch_size,
+                       args.processes, args.compression)
+    print(json.dumps(summary, indent=2))
+    print(f"[OK] Defended {summary['traces']} traces with {args.defense}, store written to {args.output}")
@@ -0,0 +1,191 @@
+import os
+import json
+import html
+import argparse
+import numpy as np
+from trace_store import UNMONITORED_SAMPLE
+from trace_catalog import iter_trace_batches
+
+################################################################################
+# Constants
+BATCH_TRACES = 2000         # traces read and reduced at once
+
+# Candidate values of the truncation/binning parameters
+PACKET_CUTOFFS = [500, 1000, 2000, 3000, 5000, 7500, 10000]     # RF max_trace_length, DL length
+TIME_CUTOFFS = [10, 20, 30, 40, 60, 80, 120]                    # RF maximum_load_time (s)
+MATRIX_LENGTHS = [200, 450, 900, 1800, 3600]                    # RF max_matrix_len
+MAXIMUM_LOAD_TIME = 80                                          # time range binned by the TAM
+KEEP_TARGET = 0.99          # fraction of packets a recommended cutoff has to keep
+
+PERCENTILES = [1, 5, 10, 25, 50, 75, 90, 95, 99]
+
+################################################################################
+# Corpus profiler.
+#
+# Reads a trace store or a folder of Wang14 files in batches of concatenated
+# arrays (see iter_trace_batches in trace_catalog.py) and reduces each batch with NumPy only:
+# per-trace length, duration, bytes and bursts, per-class sample counts, and
+# how much of the corpus survives the candidate cutoffs above. The report
+# (JSON, optionally HTML) shows the padding each packet cutoff costs next to
+# the packets it keeps, and the smallest cutoffs keeping KEEP_TARGET of them.
+################################################################################
+
+def _summary(values):
+    values = np.asarray(values, dtype=np.float64)
+    if values.size == 0:
+        return {}
+    summary = {'mean': float(values.mean()), 'min': float(values.min()), 'max': float(values.max())}
+    summary.update({f'p{p}': float(v) for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES))})
+    return summary
+
+
+def _smallest(rows, key):
+    """Smallest candidate whose `key` reaches KEEP_TARGET (None if none does)"""
+    for row in rows:
+        if row[key] >= KEEP_TARGET:
+            return row['cutoff']
+    return None
+
+
+################################################################################
+def profile(path, batch_size=BATCH_TRACES):
+    per_trace = {'length': [], 'duration': [], 'bytes_in': [], 'bytes_out': [], 'bursts': []}
+    labels_seen = []
+    in_time = np.zeros(len(TIME_CUTOFFS), dtype=np.int64)
+    occupied = np.zeros(len(MATRIX_LENGTHS), dtype=np.int64)
+    time_limits = np.array(TIME_CUTOFFS, dtype=np.float64)
+
+    for labels, times, sizes, offsets in iter_trace_batches(path, batch_size):
+        n = offsets.size - 1
+        lengths = np.diff(offsets)
+        owner = np.repeat(np.arange(n), lengths)
+        nonempty = lengths > 0
+        starts = np.zeros(n)
+        starts[nonempty] = times[offsets[:-1][nonempty]]
+        rel = times - starts[owner]
+
+        duration = np.zeros(n)
+        duration[nonempty] = rel[offsets[1:][nonempty] - 1]
+        outgoing = sizes > 0
+        direction_change = np.concatenate(([True], (outgoing[1:] != outgoing[:-1]) | (owner[1:] != owner[:-1])))
+
+        per_trace['length'].append(lengths)
+        per_trace['duration'].append(duration)
+        per_trace['bytes_in'].append(np.bincount(owner, weights=np.where(outgoing, 0, -sizes), minlength=n))
+        per_trace['bytes_out'].append(np.bincount(owner, weights=np.where(outgoing, sizes, 0), minlength=n))
+        per_trace['bursts'].append(np.bincount(owner[direction_change], minlength=n) if sizes.size else np.zeros(n))
+        labels_seen.append(labels)
+
+        # Packets before each time cutoff
+        in_time += np.searchsorted(np.sort(rel), time_limits, side='left')
+
+        # Occupied TAM cells for each matrix length (same slot rule as packets_per_slot)
+        for k, matrix_len in enumerate(MATRIX_LENGTHS):
+            slot = np.minimum((rel * (matrix_len - 1) / MAXIMUM_LOAD_TIME).astype(np.int64), matrix_len - 1)
+            cell = (owner * 2 + outgoing) * matrix_len + slot
+            occupied[k] += np.unique(cell).size
+
+    per_trace = {k: np.concatenate(v) if v else np.zeros(0) for k, v in per_trace.items()}
+    labels = np.concatenate(labels_seen) if labels_seen else np.zeros((0, 2), dtype=np.int32)
+    lengths, durations = per_trace['length'], per_trace['duration']
+    n_traces, n_packets = int(lengths.size), int(lengths.sum())
+
+    monitored = labels[:, 1] != UNMONITORED_SAMPLE
+    _, per_class = np.unique(labels[monitored, 0], return_counts=True)
+
+    packet_cutoffs = []
+    for cutoff in PACKET_CUTOFFS:
+        kept = np.minimum(lengths, cutoff)
+        packet_cutoffs.append({
+            'cutoff': cutoff,
+            'packets_kept': float(kept.sum() / n_packets) if n_packets else 1.0,
+            'traces_complete': float(np.mean(lengths <= cutoff)) if n_traces else 1.0,
+            'padding': float(1 - kept.sum() / (cutoff * n_traces)) if n_traces else 0.0,
+        })
+
+    time_cutoffs = []
+    for cutoff, kept in zip(TIME_CUTOFFS, in_time):
+        time_cutoffs.append({
+            'cutoff': cutoff,
+            'packets_kept': float(kept / n_packets) if n_packets else 1.0,
+            'traces_complete': float(np.mean(durations < cutoff)) if n_traces else 1.0,
+        })
+
+    matrix_lengths = []
+    for matrix_len, cells in zip(MATRIX_LENGTHS, occupied):
+        matrix_lengths.append({
+            'max_matrix_len': matrix_len,
+            'slot_ms': 1000.0 * MAXIMUM_LOAD_TIME / (matrix_len - 1),
+            'occupied_cells': float(cells / (2 * matrix_len * n_traces)) if n_traces else 0.0,
+            'packets_per_occupied_cell': float(n_packets / cells) if cells else 0.0,
+        })
+
+    return {
+        'source': os.path.abspath(path),
+        'traces': n_traces,
+        'packets': n_packets,
+        'classes': int(per_class.size),
+        'unmonitored_traces': int(np.count_nonzero(~monitored)),
+        'length': _summary(lengths),
+        'duration': _summary(durations),
+        'bytes_in': _summary(per_trace['bytes_in']),
+        'bytes_out': _summary(per_trace['bytes_out']),
+        'bursts': _summary(per_trace['bursts']),
+        'samples_per_class': _summary(per_class),
+        'packet_cutoffs': packet_cutoffs,
+        'time_cutoffs': time_cutoffs,
+        'matrix_lengths': matrix_lengths,
+        'recommended': {
+            'keep_target': KEEP_TARGET,
+            'max_trace_length': _smallest(packet_cutoffs, 'packets_kept'),
+            'maximum_load_time': _smallest(time_cutoffs, 'packets_kept'),
+        },
+    }
+
+
+################################################################################
+def _table(rows):
+    if not rows:
+        return '<p>-</p>'
+    head = ''.join(f'<th>{html.escape(str(k))}</th>' for k in rows[0])
+    body = ''.join('<tr>' + ''.join(f'<td>{v:.4g}</td>' if isinstance(v, float) else f'<td>{v}</td>'
+                                    for v in row.values()) + '</tr>' for row in rows)
+    return f'<table><tr>{head}</tr>{body}</table>'
+
+
+def write_html(report, out_path):
+    distributions = [dict(name=name, **report[name]) for name in
+                     ('length', 'duration', 'bytes_in', 'bytes_out', 'bursts', 'samples_per_class') if report[name]]
+    sections = [
+        ('Corpus', _table([{k: report[k] for k in ('traces', 'packets', 'classes', 'unmonitored_traces')}])),
+        ('Distributions', _table(distributions)),
+        ('Packet cutoffs (max_trace_length, DL length)', _table(report['packet_cutoffs'])),
+        ('Time cutoffs (maximum_load_time)', _table(report['time_cutoffs'])),
+        (f'TAM lengths over {MAXIMUM_LOAD_TIME} s (max_matrix_len)', _table(report['matrix_lengths'])),
+        ('Recommended', _table([report['recommended']])),
+    ]
+    body = ''.join(f'<h2>{html.escape(title)}</h2>{table}' for title, table in sections)
+    with open(out_path, 'w') as f:
+        f.write('<!DOCTYPE html><html><head><meta charset="utf-8"><title>Trace corpus profile</title>'
+                '<style>body{font-family:sans-serif}table{border-collapse:collapse}'
+                'td,th{border:1px solid #ccc;padding:2px 8px;text-align:right}</style></head>'
+                f'<body><h1>{html.escape(report["source"])}</h1>{body}</body></html>')
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Profile a trace corpus to choose truncation and binning parameters.')
+    parser.add_argument('traces', help='Trace store or directory with the Wang14 trace files (x-y).')
+    parser.add_argument('-o', '--output', default='trace_profile.json', help='JSON report.')
+    parser.add_argument('--html', default=None, help='Also write an HTML report.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_TRACES, help='Traces reduced at once.')
+    args = parser.parse_args()
+
+    report = profile(args.traces, args.batch_size)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.html:
+        write_html(report, args.html)
+    print(f"[OK] Profiled {report['traces']} traces ({report['packets']} packets), report written to {args.output}")
+    print(f"[INFO] Smallest cutoffs keeping {KEEP_TARGET:.0%} of the packets: "
+          f"max_trace_length={report['recommended']['max_trace_length']}, "
+          f"maximum_load_time={report['recommended']['maximum_load_time']}")
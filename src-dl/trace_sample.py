@@ -0,0 +1,171 @@
+import os
+import json
+import argparse
+import numpy as np
+from trace_store import is_trace_store, UNMONITORED_SAMPLE
+from trace_catalog import TraceCatalog, open_traces, iter_trace_batches, write_index
+
+################################################################################
+# Constants
+BATCH_TRACES = 2000         # traces read at once for the diversity vectors
+TIME_BINS = 10              # packets-per-time-bin entries of the diversity vectors
+TIME_RANGE = 80             # seconds covered by the time bins (RF maximum_load_time)
+SEED = 0
+
+################################################################################
+# Stratified coreset sampler.
+#
+# Picks a small, class-balanced subset of a corpus for quick iteration runs:
+# either k sites x m samples, or a fraction of the samples of every site. The
+# samples of a site are drawn at random, or, with --diverse, by greedy
+# k-center (farthest point first) on cheap per-trace vectors: log length,
+# duration, bytes in/out, outgoing fraction, bursts and a coarse packets-over-
+# time histogram, standardized over the corpus. Everything is driven by one
+# seeded generator, so the same arguments give the same subset.
+#
+# The subset is written as trace indexes (one x-y name per line), optionally
+# split into _train/_test files in the format of RF's list/Index_*.txt. They
+# are read by RF extract-all/extract-list (index_path or the list files),
+# Tik-Tok (index_path), DL_Experiments (--index) and src-ml/3_wf_attack.py
+# (SAMPLE_INDEX), without copying any trace file.
+#
+# The source is a trace store, a folder of Wang14 files or, for labels only,
+# a folder of x_y.pcap captures.
+################################################################################
+
+def open_labels(path):
+    """(site, sample) int32[n, 2] of the traces of a store, Wang14 folder or capture folder"""
+    if is_trace_store(path):
+        source = open_traces(path)
+    else:
+        source = TraceCatalog.open(path)
+        if len(source) == 0:
+            source = TraceCatalog.open(path, separator='_', suffix='.pcap')
+    return np.stack((np.asarray(source.sites), np.asarray(source.samples)), axis=1)
+
+
+def diversity_vectors(path, batch_size=BATCH_TRACES):
+    """Standardized cheap per-trace vectors, in the order of open_labels"""
+    vectors = []
+    for _labels, times, sizes, offsets in iter_trace_batches(path, batch_size):
+        n = offsets.size - 1
+        lengths = np.diff(offsets)
+        owner = np.repeat(np.arange(n), lengths)
+        nonempty = lengths > 0
+        starts = np.zeros(n)
+        starts[nonempty] = times[offsets[:-1][nonempty]]
+        rel = times - starts[owner]
+        duration = np.zeros(n)
+        duration[nonempty] = rel[offsets[1:][nonempty] - 1]
+        outgoing = sizes > 0
+        change = np.concatenate(([True], (outgoing[1:] != outgoing[:-1]) | (owner[1:] != owner[:-1])))
+        time_bin = np.minimum((rel * TIME_BINS / TIME_RANGE).astype(np.int64), TIME_BINS - 1)
+        histogram = np.bincount(owner * TIME_BINS + time_bin, minlength=n * TIME_BINS).reshape(n, TIME_BINS)
+        safe = np.maximum(lengths, 1)[:, None]
+
+        vectors.append(np.column_stack((
+            np.log1p(lengths),
+            duration,
+            np.log1p(np.bincount(owner, weights=np.where(outgoing, 0, -sizes), minlength=n)),
+            np.log1p(np.bincount(owner, weights=np.where(outgoing, sizes, 0), minlength=n)),
+            np.bincount(owner, weights=outgoing, minlength=n) / safe[:, 0],
+            np.log1p(np.bincount(owner[change], minlength=n) if sizes.size else np.zeros(n)),
+            histogram / safe,
+        )))
+    vectors = np.concatenate(vectors) if vectors else np.zeros((0, 6 + TIME_BINS))
+    std = vectors.std(axis=0)
+    return (vectors - vectors.mean(axis=0)) / np.where(std > 0, std, 1)
+
+
+def k_center(vectors, m, rng):
+    """Greedy k-center: m row indices, each the farthest from the ones already picked"""
+    picked = [int(rng.integers(vectors.shape[0]))]
+    distance = np.linalg.norm(vectors - vectors[picked[0]], axis=1)
+    while len(picked) < min(m, vectors.shape[0]):
+        picked.append(int(np.argmax(distance)))
+        distance = np.minimum(distance, np.linalg.norm(vectors - vectors[picked[-1]], axis=1))
+    return np.array(picked)
+
+
+def sample(labels, sites=None, samples=None, fraction=None, unmonitored=0, vectors=None, seed=SEED):
+    """
+    Positions (into labels) of the subset: `sites` random sites (all if None)
+    and, per site, `samples` samples or `fraction` of them (at least one).
+    `unmonitored` random unmonitored traces are added. With `vectors` the
+    samples of a site are chosen by k-center instead of at random.
+    """
+    rng = np.random.default_rng(seed)
+    monitored = np.flatnonzero(labels[:, 1] != UNMONITORED_SAMPLE)
+    order = monitored[np.lexsort((labels[monitored, 1], labels[monitored, 0]))]
+    site_ids, starts = np.unique(labels[order, 0], return_index=True)
+
+    chosen_sites = np.arange(site_ids.size)
+    if sites is not None and sites < site_ids.size:
+        chosen_sites = np.sort(rng.choice(site_ids.size, size=sites, replace=False))
+
+    picked = []
+    bounds = np.r_[starts, order.size]
+    for s in chosen_sites:
+        members = order[bounds[s]:bounds[s + 1]]
+        if fraction is not None:
+            m = max(1, int(round(fraction * members.size)))
+        else:
+            m = members.size if samples is None else min(samples, members.size)
+        if vectors is not None:
+            selected = k_center(vectors[members], m, rng)
+        else:
+            selected = rng.choice(members.size, size=m, replace=False)
+        picked.append(members[np.sort(selected)])
+
+    if unmonitored:
+        pool = np.flatnonzero(labels[:, 1] == UNMONITORED_SAMPLE)
+        pool = pool[np.argsort(labels[pool, 0], kind='stable')]
+        picked.append(pool[np.sort(rng.choice(pool.size, size=min(unmonitored, pool.size), replace=False))])
+    return np.concatenate(picked) if picked else np.zeros(0, dtype=np.int64)
+
+
+def split(labels, positions, test_fraction, seed=SEED):
+    """Per-site train/test split of the subset (at least one train sample per site)"""
+    rng = np.random.default_rng(seed + 1)
+    train, test = [], []
+    for site in np.unique(labels[positions, 0]):
+        members = positions[labels[positions, 0] == site]
+        shuffled = rng.permutation(members.size)
+        n_test = min(int(round(test_fraction * members.size)), members.size - 1)
+        test.append(members[np.sort(shuffled[:n_test])])
+        train.append(members[np.sort(shuffled[n_test:])])
+    return np.concatenate(train), np.concatenate(test)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Write a stratified subset of a trace corpus as trace indexes.')
+    parser.add_argument('traces', help='Trace store, directory with the Wang14 trace files (x-y), or with x_y.pcap captures.')
+    parser.add_argument('index', help='Output trace index, e.g. RF/RF/list/Index_coreset.txt.')
+    parser.add_argument('-k', '--sites', type=int, default=None, help='Number of sites (all by default).')
+    parser.add_argument('-m', '--samples', type=int, default=None, help='Samples per site (all by default).')
+    parser.add_argument('-f', '--fraction', type=float, default=None, help='Fraction of the samples of each site instead of -m.')
+    parser.add_argument('-u', '--unmonitored', type=int, default=0, help='Unmonitored traces to add.')
+    parser.add_argument('--diverse', action='store_true', help='Choose the samples of a site by k-center instead of at random.')
+    parser.add_argument('--test-fraction', type=float, default=None,
+                        help='Also write <index>_train.txt and <index>_test.txt with this test share per site.')
+    parser.add_argument('--seed', type=int, default=SEED, help='Seed of the sampler.')
+    args = parser.parse_args()
+
+    labels = open_labels(args.traces)
+    vectors = None
+    if args.diverse:
+        if not (is_trace_store(args.traces) or len(TraceCatalog.open(args.traces))):
+            parser.error('--diverse needs a trace store or a folder of Wang14 files')
+        vectors = diversity_vectors(args.traces)
+    positions = sample(labels, args.sites, args.samples, args.fraction, args.unmonitored, vectors, args.seed)
+    write_index(args.index, labels[positions, 0], labels[positions, 1])
+
+    summary = {'source': os.path.abspath(args.traces), 'index': os.path.abspath(args.index),
+               'traces': int(positions.size), 'sites': int(np.unique(labels[positions, 0]).size), 'seed': args.seed}
+    if args.test_fraction is not None:
+        stem = os.path.splitext(args.index)[0]
+        train, test = split(labels, positions, args.test_fraction, args.seed)
+        write_index(stem + '_train.txt', labels[train, 0], labels[train, 1])
+        write_index(stem + '_test.txt', labels[test, 0], labels[test, 1])
+        summary.update(train=int(train.size), test=int(test.size))
+    print(json.dumps(summary, indent=2))
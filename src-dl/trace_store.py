@@ -0,0 +1,356 @@
+import os
+import json
+import argparse
+import numpy as np
+from wang14 import read_trace
+
+################################################################################
+# Packed, memory-mappable trace store.
+#
+# Replaces the one-text-file-per-visit Wang14 output with a directory of flat
+# arrays that every consumer can mmap:
+#
+#   header.json   format version, compression, number of traces and packets
+#   offsets.bin   int64[N + 1]    packet offsets of each trace
+#   labels.bin    int32[N, 2]     (site, sample); sample is -1 for traces named
+#                                 only by their index (unmonitored "x" files)
+#   times.bin     float64[P]      relative timestamps, all traces concatenated
+#   sizes.bin     int32[P]        signed sizes (+ outgoing, - incoming)
+#
+# With compression "varint", times.bin holds the zigzag varint of the per-trace
+# delta of the timestamps in microseconds (the Wang14 text precision), sizes.bin
+# the zigzag varint of the sizes, and byte_offsets.bin (int64[N + 1, 2]) the
+# start of every trace in both byte streams. Either way trace i is found in O(1)
+# from offsets[i:i + 2].
+#
+# The header is only rewritten when a writer is closed, so readers never see a
+# partially appended trace.
+################################################################################
+
+STORE_VERSION = 1
+COMPRESSIONS = ("none", "varint")
+UNMONITORED_SAMPLE = -1
+
+HEADER_FILE = "header.json"
+OFFSETS_FILE = "offsets.bin"
+BYTE_OFFSETS_FILE = "byte_offsets.bin"
+LABELS_FILE = "labels.bin"
+TIMES_FILE = "times.bin"
+SIZES_FILE = "sizes.bin"
+
+
+def is_trace_store(path):
+    return os.path.isfile(os.path.join(path, HEADER_FILE))
+
+
+def trace_name(site, sample):
+    """Wang14 file name of a trace: x-y, or just x for unmonitored traces"""
+    return str(site) if sample == UNMONITORED_SAMPLE else f"{site}-{sample}"
+
+
+def parse_trace_name(name, separator="-"):
+    """Inverse of trace_name; returns None for names that are not x-y or x"""
+    parts = name.split(separator)
+    if len(parts) > 2 or not all(p.isdigit() for p in parts):
+        return None
+    return int(parts[0]), int(parts[1]) if len(parts) == 2 else UNMONITORED_SAMPLE
+
+
+################################################################################
+# Vectorized zigzag varint codec
+def varint_encode(values):
+    """Encode an int64 array as a zigzag LEB128 byte stream"""
+    values = np.asarray(values, dtype=np.int64)
+    zigzag = ((values << 1) ^ (values >> 63)).view(np.uint64)
+    n_bytes = np.ones(zigzag.size, dtype=np.int64)
+    for shift in range(7, 64, 7):
+        n_bytes += zigzag >= (np.uint64(1) << np.uint64(shift))
+    owner = np.repeat(np.arange(zigzag.size), n_bytes)
+    position = np.arange(owner.size) - np.repeat(np.cumsum(n_bytes) - n_bytes, n_bytes)
+    chunks = (zigzag[owner] >> (np.uint64(7) * position.astype(np.uint64))) & np.uint64(0x7f)
+    more = position < n_bytes[owner] - 1
+    return (chunks | (more.astype(np.uint64) << np.uint64(7))).astype(np.uint8)
+
+
+def varint_decode(stream):
+    """Decode a zigzag LEB128 byte stream back to an int64 array"""
+    stream = np.asarray(stream, dtype=np.uint8)
+    if stream.size == 0:
+        return np.zeros(0, dtype=np.int64)
+    ends = np.flatnonzero(stream < 0x80)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    position = np.arange(stream.size) - np.repeat(starts, ends - starts + 1)
+    chunks = (stream & 0x7f).astype(np.uint64) << (np.uint64(7) * position.astype(np.uint64))
+    zigzag = np.add.reduceat(chunks, starts)
+    return (zigzag >> np.uint64(1)).astype(np.int64) ^ -(zigzag & np.uint64(1)).astype(np.int64)
+
+
+def _encode_times(times):
+    micros = np.rint(np.asarray(times, dtype=np.float64) * 1e6).astype(np.int64)
+    return varint_encode(np.diff(micros, prepend=0))
+
+
+def _decode_times(stream):
+    return np.cumsum(varint_decode(stream)).astype(np.float64) / 1e6
+
+
+################################################################################
+def _read_header(path):
+    with open(os.path.join(path, HEADER_FILE)) as f:
+        return json.load(f)
+
+
+def _write_header(path, header):
+    tmp = os.path.join(path, HEADER_FILE + ".tmp")
+    with open(tmp, "w") as f:
+        json.dump(header, f)
+    os.replace(tmp, os.path.join(path, HEADER_FILE))
+
+
+def _map(path, name, dtype, shape):
+    """Read-only memmap of a store file; empty arrays cannot be mapped"""
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(os.path.join(path, name), dtype=dtype, mode="r", shape=shape)
+
+
+class TraceStore:
+    """Read-only, memory-mapped view of a trace store"""
+
+    _open = {}
+
+    def __init__(self, path):
+        self.path = path
+        header = _read_header(path)
+        if header["version"] != STORE_VERSION:
+            raise ValueError(f"Unsupported trace store version {header['version']} in {path}")
+        self.compression = header["compression"]
+        n_traces, n_packets = header["traces"], header["packets"]
+
+        self.offsets = _map(path, OFFSETS_FILE, np.int64, (n_traces + 1,))
+        self.labels = _map(path, LABELS_FILE, np.int32, (n_traces, 2))
+        if self.compression == "varint":
+            self.byte_offsets = _map(path, BYTE_OFFSETS_FILE, np.int64, (n_traces + 1, 2))
+            self.times = _map(path, TIMES_FILE, np.uint8, (header["time_bytes"],))
+            self.sizes = _map(path, SIZES_FILE, np.uint8, (header["size_bytes"],))
+        else:
+            self.times = _map(path, TIMES_FILE, np.float64, (n_packets,))
+            self.sizes = _map(path, SIZES_FILE, np.int32, (n_packets,))
+        self._index = None
+
+    @classmethod
+    def open(cls, path):
+        """Per-process cached instance, for worker functions called once per trace"""
+        store = cls._open.get(path)
+        if store is None:
+            store = cls._open[path] = cls(path)
+        return store
+
+    def __len__(self):
+        return self.labels.shape[0]
+
+    def __getitem__(self, i):
+        return self.trace(i)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.trace(i)
+
+    @property
+    def sites(self):
+        return self.labels[:, 0]
+
+    @property
+    def samples(self):
+        return self.labels[:, 1]
+
+    @property
+    def lengths(self):
+        return np.diff(self.offsets)
+
+    def name(self, i):
+        return trace_name(int(self.labels[i, 0]), int(self.labels[i, 1]))
+
+    def index(self, site, sample=UNMONITORED_SAMPLE):
+        """Position of a (site, sample) trace, or None if the store does not have it"""
+        if self._index is None:
+            self._index = {(int(s), int(n)): i for i, (s, n) in enumerate(np.asarray(self.labels).tolist())}
+        return self._index.get((site, sample))
+
+    def trace(self, i, max_length=None):
+        """(times float64, sizes int32) of trace i, at most max_length packets"""
+        start, end = int(self.offsets[i]), int(self.offsets[i + 1])
+        if max_length is not None:
+            end = min(end, start + max_length)
+        if self.compression != "varint":
+            return self.times[start:end], self.sizes[start:end]
+        (time_start, size_start), (time_end, size_end) = self.byte_offsets[i], self.byte_offsets[i + 1]
+        times = _decode_times(self.times[time_start:time_end])
+        sizes = varint_decode(self.sizes[size_start:size_end]).astype(np.int32)
+        return times[:end - start], sizes[:end - start]
+
+    def traces(self, start=0, end=None):
+        """
+        Traces start..end-1 as concatenated arrays, laid out like
+        wang14.read_traces: (times float64, sizes int32, offsets int64[n + 1])
+        """
+        end = len(self) if end is None else min(end, len(self))
+        offsets = np.asarray(self.offsets[start:end + 1]) - self.offsets[start]
+        first, last = int(self.offsets[start]), int(self.offsets[end])
+        if self.compression != "varint":
+            return np.asarray(self.times[first:last]), np.asarray(self.sizes[first:last]), offsets
+
+        (time_start, size_start), (time_end, size_end) = self.byte_offsets[start], self.byte_offsets[end]
+        sizes = varint_decode(self.sizes[size_start:size_end]).astype(np.int32)
+        # Time deltas restart at every trace: undo the running sum per trace
+        micros = np.concatenate(([0], np.cumsum(varint_decode(self.times[time_start:time_end]))))
+        micros = micros[1:] - np.repeat(micros[offsets[:-1]], np.diff(offsets))
+        return micros.astype(np.float64) / 1e6, sizes, offsets
+
+
+################################################################################
+class TraceStoreWriter:
+    """
+    Appends traces to a store. mode "w" starts a new store, mode "a" appends to
+    an existing one (or creates it).
+    """
+
+    def __init__(self, path, mode="a", compression="none"):
+        if compression not in COMPRESSIONS:
+            raise ValueError(f"Unknown compression '{compression}', expected one of {COMPRESSIONS}")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+
+        if mode == "a" and is_trace_store(path):
+            header = _read_header(path)
+            compression = header["compression"]
+        else:
+            header = {"version": STORE_VERSION, "compression": compression,
+                      "traces": 0, "packets": 0, "time_bytes": 0, "size_bytes": 0}
+            # Empty store first: an interrupted writer leaves no header pointing past the files
+            _write_header(path, header)
+            for name in (OFFSETS_FILE, BYTE_OFFSETS_FILE, LABELS_FILE, TIMES_FILE, SIZES_FILE):
+                open(os.path.join(path, name), "wb").close()
+            np.zeros(1, dtype=np.int64).tofile(os.path.join(path, OFFSETS_FILE))
+            if compression == "varint":
+                np.zeros((1, 2), dtype=np.int64).tofile(os.path.join(path, BYTE_OFFSETS_FILE))
+        self.header = header
+        self.compression = compression
+
+        # Drop whatever an interrupted writer appended after the last header
+        n = header["traces"]
+        self._truncate(OFFSETS_FILE, (n + 1) * 8)
+        self._truncate(LABELS_FILE, n * 8)
+        if compression == "varint":
+            self._truncate(BYTE_OFFSETS_FILE, (n + 1) * 16)
+            self._truncate(TIMES_FILE, header["time_bytes"])
+            self._truncate(SIZES_FILE, header["size_bytes"])
+        else:
+            self._truncate(TIMES_FILE, header["packets"] * 8)
+            self._truncate(SIZES_FILE, header["packets"] * 4)
+
+        self._files = {name: open(os.path.join(path, name), "ab")
+                       for name in (OFFSETS_FILE, BYTE_OFFSETS_FILE, LABELS_FILE, TIMES_FILE, SIZES_FILE)}
+
+    def _truncate(self, name, size):
+        path = os.path.join(self.path, name)
+        if os.path.getsize(path) < size:
+            raise ValueError(f"{path} is shorter than the store header says ({os.path.getsize(path)} < {size} bytes)")
+        with open(path, "ab") as f:
+            f.truncate(size)
+
+    def add(self, site, sample, times, sizes):
+        times = np.asarray(times, dtype=np.float64)
+        sizes = np.asarray(sizes, dtype=np.int32)
+        if times.shape != sizes.shape:
+            raise ValueError("times and sizes must have the same length")
+        header = self.header
+
+        if self.compression == "varint":
+            time_stream = _encode_times(times)
+            size_stream = varint_encode(sizes)
+            self._files[TIMES_FILE].write(time_stream.tobytes())
+            self._files[SIZES_FILE].write(size_stream.tobytes())
+            header["time_bytes"] += time_stream.size
+            header["size_bytes"] += size_stream.size
+            self._files[BYTE_OFFSETS_FILE].write(
+                np.array([header["time_bytes"], header["size_bytes"]], dtype=np.int64).tobytes())
+        else:
+            self._files[TIMES_FILE].write(times.tobytes())
+            self._files[SIZES_FILE].write(sizes.tobytes())
+
+        header["packets"] += times.size
+        header["traces"] += 1
+        self._files[OFFSETS_FILE].write(np.array([header["packets"]], dtype=np.int64).tobytes())
+        self._files[LABELS_FILE].write(np.array([site, sample], dtype=np.int32).tobytes())
+
+    def add_batch(self, labels, times, sizes, offsets):
+        """Append traces given as concatenated arrays, laid out like TraceStore.traces"""
+        labels = np.asarray(labels, dtype=np.int32).reshape(-1, 2)
+        offsets = np.asarray(offsets, dtype=np.int64)
+        if self.compression == "varint":
+            # Deltas restart at every trace: encode them one by one
+            for (site, sample), start, end in zip(labels.tolist(), offsets[:-1].tolist(), offsets[1:].tolist()):
+                self.add(site, sample, times[start:end], sizes[start:end])
+            return
+        header = self.header
+        self._files[TIMES_FILE].write(np.asarray(times, dtype=np.float64).tobytes())
+        self._files[SIZES_FILE].write(np.asarray(sizes, dtype=np.int32).tobytes())
+        self._files[OFFSETS_FILE].write((header["packets"] + offsets[1:]).tobytes())
+        self._files[LABELS_FILE].write(labels.tobytes())
+        header["packets"] += int(offsets[-1])
+        header["traces"] += labels.shape[0]
+
+    def close(self):
+        for f in self._files.values():
+            f.close()
+        _write_header(self.path, self.header)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def rollback_store(path, n_traces):
+    """
+    Drop the traces appended after the first n_traces. Only the header is
+    rewritten; the next writer opened on the store truncates the files.
+    """
+    header = _read_header(path)
+    if n_traces >= header["traces"]:
+        return
+    store = TraceStore(path)
+    header["traces"], header["packets"] = n_traces, int(store.offsets[n_traces])
+    if store.compression == "varint":
+        header["time_bytes"], header["size_bytes"] = (int(v) for v in store.byte_offsets[n_traces])
+    del store
+    _write_header(path, header)
+
+
+################################################################################
+def convert_directory(traces_dir, store_path, compression="none"):
+    """Pack an existing directory of Wang14 files (x-y, or x) into a new store"""
+    entries = []
+    for name in os.listdir(traces_dir):
+        label = parse_trace_name(name)
+        if label is not None:
+            entries.append((label, name))
+    entries.sort()
+
+    with TraceStoreWriter(store_path, mode="w", compression=compression) as writer:
+        for (site, sample), name in entries:
+            times, sizes = read_trace(os.path.join(traces_dir, name))
+            writer.add(site, sample, times, sizes)
+    print(f"[OK] Packed {len(entries)} traces from {traces_dir} into {store_path}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Pack a directory of Wang14 trace files into a trace store.')
+    parser.add_argument('traces', help='Directory with the Wang14 trace files (x-y).')
+    parser.add_argument('store', help='Output trace store directory.')
+    parser.add_argument('-c', '--compression', choices=COMPRESSIONS, default='none',
+                        help='Store the arrays raw or delta/varint compressed.')
+    args = parser.parse_args()
+    convert_directory(args.traces, args.store, args.compression)
@@ -0,0 +1,100 @@
+from itertools import chain
+import numpy as np
+
+################################################################################
+# Shared reader for Wang14 text traces (rel_time \t signed_size per line).
+#
+# Used by RF, Tik-Tok and DL_Experiments so that all of them see the same
+# packets. A whole file (or a batch of files) is split into tokens once and
+# converted to float64 in a single NumPy call instead of line by line.
+#
+# Rows with a 0 size carry no direction and are dropped. This covers the
+# closing 0\t0 sentinel written by 2_extract_features.py, and zero-payload
+# packets when DROP_ZERO_PAYLOAD is off.
+################################################################################
+
+READ_CHUNK = 1 << 16
+NEWLINE = ord('\n')
+
+
+def _read_prefix(path, max_length):
+    """Raw bytes of the first max_length lines of a file (all of it if None)"""
+    with open(path, 'rb') as f:
+        if max_length is None:
+            return f.read()
+        chunks = []
+        lines = 0
+        while lines < max_length:
+            chunk = f.read(READ_CHUNK)
+            if not chunk:
+                break
+            newlines = np.flatnonzero(np.frombuffer(chunk, dtype=np.uint8) == NEWLINE)
+            if lines + newlines.size >= max_length:
+                chunk = chunk[:newlines[max_length - lines - 1] + 1]
+            chunks.append(chunk)
+            lines += newlines.size
+        return b''.join(chunks)
+
+
+def _parse_rows(data):
+    """(n, 2) float64 array of the rows of a Wang14 text buffer"""
+    try:
+        values = np.array(data.split(), dtype=np.float64)
+        if values.size % 2 == 0:
+            return values.reshape(-1, 2)
+    except ValueError:
+        pass
+    # Malformed content: keep the rows that parse, like the previous readers did
+    rows = []
+    for line in data.splitlines():
+        fields = line.split()
+        if len(fields) < 2:
+            continue
+        try:
+            rows.append((float(fields[0]), float(fields[1])))
+        except ValueError:
+            continue
+    return np.array(rows, dtype=np.float64).reshape(-1, 2)
+
+
+def drop_empty(times, sizes):
+    """Apply the 0-size rule to arrays that were not read by this module (e.g. from a trace store)"""
+    keep = sizes != 0
+    if keep.all():
+        return times, sizes
+    return times[keep], sizes[keep]
+
+
+def read_trace(path, max_length=None):
+    """
+    Read one trace as (times float64, sizes int32). With max_length only the
+    first max_length lines of the file are read.
+    """
+    rows = _parse_rows(_read_prefix(path, max_length))
+    return drop_empty(rows[:, 0], rows[:, 1].astype(np.int32))
+
+
+def read_traces(paths, max_length=None):
+    """
+    Read a batch of traces into concatenated arrays, laid out like the trace
+    store: (times float64, sizes int32, offsets int64[len(paths) + 1]).
+    """
+    buffers = [_read_prefix(path, max_length) for path in paths]
+    tokens = [data.split() for data in buffers]
+    counts = np.array([len(t) for t in tokens], dtype=np.int64)
+    try:
+        if (counts % 2).any():
+            raise ValueError
+        rows = np.array(list(chain.from_iterable(tokens)), dtype=np.float64).reshape(-1, 2)
+        counts //= 2
+    except ValueError:
+        # Some file is malformed: parse them one by one
+        parsed = [_parse_rows(data) for data in buffers]
+        counts = np.array([r.shape[0] for r in parsed], dtype=np.int64)
+        rows = np.concatenate(parsed) if parsed else np.zeros((0, 2))
+
+    keep = rows[:, 1] != 0
+    owner = np.repeat(np.arange(len(paths)), counts)
+    offsets = np.zeros(len(paths) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(owner[keep], minlength=len(paths)), out=offsets[1:])
+    return rows[keep, 0], rows[keep, 1].astype(np.int32), offsets
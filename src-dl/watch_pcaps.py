@@ -0,0 +1,256 @@
+import os
+import sys
+import json
+import time
+import shutil
+import signal
+import argparse
+import importlib
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+ROOT = os.path.dirname(os.path.abspath(__file__))
+sys.path.append(os.path.join(ROOT, '..', 'src-ml'))  # trace_features, used by the ML extractor
+sys.path.append(os.path.join(ROOT, 'RF'))  # RF.const_rf and RF.FeatureExtraction
+
+from trace_store import TraceStore, TraceStoreWriter, is_trace_store, rollback_store, parse_trace_name, UNMONITORED_SAMPLE
+from trace_catalog import TraceCatalog
+from wang14 import drop_empty
+from RF import const_rf
+from RF.rf_dataset import DatasetWriter, is_dataset, read_header, rollback_dataset
+
+validate_pcaps = importlib.import_module('1_validate_pcaps')
+dl_extract = importlib.import_module('2_extract_features')
+
+# Same module name as src-dl/2_extract_features.py: load it from its path
+_spec = importlib.util.spec_from_file_location(
+    'ml_extract_features', os.path.join(ROOT, '..', 'src-ml', '2_extract_features.py'))
+ml_extract = importlib.util.module_from_spec(_spec)
+_spec.loader.exec_module(ml_extract)
+
+
+################################################################################
+# Constants
+PCAPS_FOLDER = validate_pcaps.DATA_ORIGIN_FOLDER        # ./../data/pcaps/, watched for new x_y.pcap
+OUTPUT_FOLDER = validate_pcaps.DATA_OUTPUT_FOLDER       # ./../data/output/, validated captures
+STATE_PATH = "./../data/watch_state.json"
+
+POLL_INTERVAL = 10          # seconds between two scans of PCAPS_FOLDER
+BATCH_CAPTURES = 64         # captures pushed through the stages at once
+MAX_DELAY = 60              # seconds a settled capture waits for its batch to fill
+
+# Stages
+VALIDATE = True             # tcpdump check/fix (1_validate_pcaps.py); False copies the capture as is
+ML_FEATURES = True          # rows appended to the ML CSV (src-ml/2_extract_features.py)
+DL_TRACES = True            # Wang14 file and/or trace store (OUTPUT_FORMAT of src-dl/2_extract_features.py)
+RF_DATASET = const_rf.output_dir + 'Undefence-packets_per_slot'  # or None
+RF_FEATURE = 'packets_per_slot'
+
+################################################################################
+# Watch-folder daemon.
+#
+# Polls PCAPS_FOLDER (through its pcap catalog, so an unchanged folder is not
+# listed again) and pushes every new x_y.pcap through the pipeline of
+# main.sh, one batch at a time:
+#
+#   1. validation into OUTPUT_FOLDER                (1_validate_pcaps.py)
+#   2. Wang14 file and trace store append           (src-dl/2_extract_features.py)
+#   3. RF TAM appended to RF_DATASET                (RF extract scripts)
+#   4. ML feature rows appended to the CSV          (src-ml/2_extract_features.py)
+#
+# A capture is only picked up once its size and mtime stayed the same for a
+# whole poll (the capture is complete). Settled captures are batched: a batch
+# runs as soon as BATCH_CAPTURES are waiting, or when the oldest has waited
+# MAX_DELAY seconds.
+#
+# Progress is saved to STATE_PATH after every batch: the captures done, and the
+# size of every output at that point. On restart, outputs are rolled back to
+# those sizes before anything else, so a batch interrupted halfway is redone
+# without duplicated rows or traces. SIGINT/SIGTERM finish the current batch.
+#
+# Unlike 2_extract_features.py, classes with fewer than two samples are kept:
+# their next samples may still arrive.
+################################################################################
+
+def load_state(path=STATE_PATH):
+    if not os.path.isfile(path):
+        return {'done': {}, 'outputs': {}}
+    with open(path) as f:
+        return json.load(f)
+
+
+def save_state(state, path=STATE_PATH):
+    tmp = path + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(state, f)
+    os.replace(tmp, path)
+
+
+class Pipeline:
+    """The stages of main.sh for a list of captures, appending to the existing outputs"""
+
+    def __init__(self, state):
+        self.state = state
+        self.csv_path = ml_extract.FEATURES_RESULT_PATH + '_dataset.csv' if ML_FEATURES else None
+        store_format = dl_extract.OUTPUT_FORMAT in ('store', 'both')
+        self.store_path = dl_extract.TRACE_STORE_PATH if DL_TRACES and store_format else None
+        self.write_text = DL_TRACES and dl_extract.OUTPUT_FORMAT in ('wang14', 'both')
+        self.feature = importlib.import_module('RF.FeatureExtraction.' + RF_FEATURE) if RF_DATASET else None
+
+    ############################################################################
+    def sizes(self):
+        """Current size of every output: CSV bytes, store traces, RF dataset rows"""
+        sizes = {}
+        if self.csv_path:
+            sizes['csv'] = os.path.getsize(self.csv_path) if os.path.isfile(self.csv_path) else 0
+        if self.store_path:
+            sizes['store'] = len(TraceStore(self.store_path)) if is_trace_store(self.store_path) else 0
+        if RF_DATASET:
+            sizes['rf'] = read_header(RF_DATASET)['traces'] if is_dataset(RF_DATASET) else 0
+        return sizes
+
+    def rollback(self):
+        """Bring the outputs back to their sizes of the last saved state"""
+        saved = self.state['outputs']
+        grown = {k: v for k, v in self.sizes().items() if k in saved and v > saved[k]}
+        if 'csv' in grown:
+            with open(self.csv_path, 'r+b') as f:
+                f.truncate(saved['csv'])
+        if 'store' in grown:
+            rollback_store(self.store_path, saved['store'])
+        if 'rf' in grown:
+            rollback_dataset(RF_DATASET, saved['rf'])
+        if grown:
+            print(f"[INFO] Interrupted batch rolled back: {grown} -> {saved}")
+
+    ############################################################################
+    def _tam(self, site, sample, rel_times, signed_lens):
+        """RF feature of a decoded capture, as extract_feature_from_pcap computes it; None if RF skips it"""
+        if sample == UNMONITORED_SAMPLE:
+            if not const_rf.OPEN_WORLD or site >= const_rf.UNMONITORED_SITE_NUM:
+                return None
+            label = const_rf.MONITORED_SITE_NUM
+        elif site < const_rf.MONITORED_SITE_NUM and 0 <= sample < const_rf.MONITORED_INST_NUM:
+            label = site
+        else:
+            return None
+        times = np.rint(rel_times[:const_rf.max_trace_length] * 1e6) / 1e6
+        times, sizes = drop_empty(times, signed_lens[:const_rf.max_trace_length])
+        return self.feature.fun(times, sizes), label
+
+    ############################################################################
+    def _validate(self, name):
+        source, target = os.path.join(PCAPS_FOLDER, name), os.path.join(OUTPUT_FOLDER, name)
+        if VALIDATE:
+            validate_pcaps.check_and_fix_pcap(source)
+        else:
+            shutil.copyfile(source, target)
+        return os.path.isfile(target)
+
+    def run(self, names):
+        """Push a batch of captures (file names in PCAPS_FOLDER) through every stage; returns the failed ones"""
+        os.makedirs(OUTPUT_FOLDER, exist_ok=True)
+        with ThreadPoolExecutor(max_workers=dl_extract.MAX_WORKERS) as ex:
+            valid = [name for name, ok in zip(names, ex.map(self._validate, names)) if ok]
+        failed = sorted(set(names) - set(valid))
+
+        if DL_TRACES or RF_DATASET:
+            os.makedirs(dl_extract.FEATURES_RESULT_PATH, exist_ok=True)
+            convert = lambda name: dl_extract.convert_pcap_to_wang14(
+                os.path.join(OUTPUT_FOLDER, name), dl_extract.FEATURES_RESULT_PATH, dl_extract.CLIENT_IP,
+                dl_extract.DROP_ZERO_PAYLOAD, write_text=self.write_text)
+            writer = TraceStoreWriter(self.store_path, mode="a", compression=dl_extract.STORE_COMPRESSION) \
+                if self.store_path else None
+            tams, rf_traces = [], []
+            with ThreadPoolExecutor(max_workers=dl_extract.MAX_WORKERS) as ex:
+                for name, result in zip(valid, ex.map(convert, valid)):
+                    label = parse_trace_name(name[:-len('.pcap')], '_')
+                    if result is None or label is None:
+                        failed.append(name)
+                        continue
+                    _, _, rel_times, signed_lens = result
+                    if writer is not None:
+                        writer.add(*label, rel_times, signed_lens)
+                    if self.feature is not None:
+                        tam = self._tam(*label, rel_times, signed_lens)
+                        if tam is not None:
+                            tams.append(tam)
+                            rf_traces.append(label)
+            if writer is not None:
+                writer.close()
+
+            if tams:
+                features, labels = zip(*tams)
+                with DatasetWriter(RF_DATASET, mode="a", feature=RF_FEATURE, defence='Undefence',
+                                   max_matrix_len=const_rf.max_matrix_len,
+                                   maximum_load_time=const_rf.maximum_load_time,
+                                   max_trace_length=const_rf.max_trace_length) as rf_writer:
+                    rf_writer.add(np.array(features), np.array(labels), np.array(rf_traces))
+
+        if ML_FEATURES:
+            ml_extract.extract_features(OUTPUT_FOLDER, ml_extract.FEATURES_RESULT_PATH,
+                                        samples=[n for n in valid if n not in failed], append=True)
+        return failed
+
+
+################################################################################
+def watch(once=False, poll_interval=POLL_INTERVAL, batch_size=BATCH_CAPTURES, max_delay=MAX_DELAY):
+    state = load_state()
+    pipeline = Pipeline(state)
+    pipeline.rollback()
+
+    stopping = []
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(sig, lambda *_: stopping.append(True))
+
+    seen = {}       # capture -> (size, mtime) at the previous poll
+    settled = {}    # capture -> time it was found complete
+    while not stopping:
+        catalog = TraceCatalog.open(PCAPS_FOLDER, separator='_', suffix='.pcap')
+        now = time.time()
+        for name in set(catalog.paths.tolist()) - state['done'].keys() - settled.keys():
+            try:
+                st = os.stat(os.path.join(PCAPS_FOLDER, name))
+            except FileNotFoundError:
+                continue
+            stat = (st.st_size, st.st_mtime_ns)
+            if once or seen.get(name) == stat:
+                settled[name] = now
+                seen.pop(name, None)
+            else:
+                seen[name] = stat
+
+        while settled and (once or len(settled) >= batch_size or now - min(settled.values()) >= max_delay):
+            batch = sorted(settled, key=lambda name: (settled[name], name))[:batch_size]
+            failed = pipeline.run(batch)
+            for name in batch:
+                state['done'][name] = 'failed' if name in failed else 'ok'
+                del settled[name]
+            state['outputs'] = pipeline.sizes()
+            save_state(state)
+            print(f"[OK] Batch of {len(batch)} captures done ({len(failed)} failed), "
+                  f"{len(state['done'])} in total, {len(settled)} waiting")
+            if stopping:
+                break
+
+        if once:
+            break
+        time.sleep(poll_interval)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Watch the capture folder and push new captures through every stage.')
+    parser.add_argument('--once', action='store_true', help='Process the captures present now and exit.')
+    parser.add_argument('--poll-interval', type=float, default=POLL_INTERVAL, help='Seconds between two scans.')
+    parser.add_argument('--batch-size', type=int, default=BATCH_CAPTURES, help='Captures processed at once.')
+    parser.add_argument('--max-delay', type=float, default=MAX_DELAY, help='Seconds a capture waits for its batch.')
+    args = parser.parse_args()
+
+    if not os.path.isdir(PCAPS_FOLDER):
+        print(f"[ERROR] Capture folder not found: {PCAPS_FOLDER}")
+        sys.exit(1)
+    if VALIDATE and shutil.which('tcpdump') is None:
+        print("[ERROR] tcpdump not found, install it or set VALIDATE = False")
+        sys.exit(1)
+    watch(args.once, args.poll_interval, args.batch_size, args.max_delay)
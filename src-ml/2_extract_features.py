@@ -4,12 +4,16 @@ import numpy as np
 from itertools import product
 from scipy.stats import kurtosis, skew
 import shutil
+from trace_features import FEATURE_GROUPS
 
 ################################################################################
 # Constants
 DATASET_FOLDER = "./../data/output"
 FEATURES_RESULT_PATH = "./../data/features"
 
+# Extra feature groups appended after the summary statistics (see trace_features.py)
+EXTRA_FEATURE_GROUPS = ['cumul', 'kfp']
+
 ################################################################################
 
 def safe_stats(data):
@@ -1040,11 +1044,14 @@ def get_website_from_sample_name(sample_name):
 ################################################################################
 
 # Adapted from: https://github.com/dmbb/MPTAnalysis/blob/master/CovertCastAnalysis/extractFeatures.py
-def extract_features(sampleFolder, outputFolder):
-    arff = open(outputFolder + '_dataset.csv', 'w')
-    written_header = False
-
-    for sample in os.listdir(sampleFolder):
+def extract_features(sampleFolder, outputFolder, samples=None, append=False):
+    # samples: captures of sampleFolder to parse (all by default)
+    # append:  add their rows to an existing CSV instead of rewriting it
+    csv_path = outputFolder + '_dataset.csv'
+    written_header = append and os.path.isfile(csv_path) and os.path.getsize(csv_path) > 0
+    arff = open(csv_path, 'a' if append else 'w')
+
+    for sample in (os.listdir(sampleFolder) if samples is None else samples):
         f = open(sampleFolder + "/" + sample, 'rb' )
         print(sampleFolder + "/" + sample)
         pcap = dpkt.pcap.Reader(f)
@@ -1080,6 +1087,10 @@ def extract_features(sampleFolder, outputFolder):
         prev_ts = 0
         absTimesOut = []
 
+        #Signed trace (+ outgoing, - incoming) for the extra feature groups
+        traceTimes = []
+        traceSizes = []
+
         for ts, buf in pcap:
             eth = dpkt.ethernet.Ethernet(buf)
             ip_hdr = eth.data
@@ -1136,6 +1147,8 @@ def extract_features(sampleFolder, outputFolder):
 
                     # Packet Size statistics
                     packetSizes.append(len(buf))
+                    traceTimes.append(ts)
+                    traceSizes.append(-len(buf) if ip_hdr.data.sport == 443 else len(buf))
 
                     # Packet Times statistics
                     if prev_ts != 0:
@@ -1188,6 +1201,8 @@ def extract_features(sampleFolder, outputFolder):
 
         f_names.append('website')
         f_values.append(get_website_from_sample_name(sample))
+        f_names.append('trace')
+        f_values.append(os.path.splitext(sample)[0].replace('_', '-', 1))
 
         ########################################################################
         #Global Packet Features
@@ -1331,6 +1346,17 @@ def extract_features(sampleFolder, outputFolder):
                          safe_percentile(burst_sizes, 70), safe_percentile(burst_sizes, 80), safe_percentile(burst_sizes, 90)])
 
 
+        ########################################################################
+        #Extra feature groups (CUMUL, k-FP)
+
+        trace_times = np.array(traceTimes, dtype=np.float64)
+        trace_sizes = np.array(traceSizes, dtype=np.int64)
+        for group in EXTRA_FEATURE_GROUPS:
+            names, values = FEATURE_GROUPS[group](trace_times, trace_sizes)
+            f_names.extend(names)
+            f_values.extend(values)
+
+
         if(not written_header):
             arff.write(','.join(f_names))
             arff.write('\n')
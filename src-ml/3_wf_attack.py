@@ -30,6 +30,15 @@ MODELS_FOLDER = "./../data/models/"
 RESULTS_FOLDER = "./../data/results/"
 DATA_PATH = "./../data/features_dataset.csv"
 
+# Feature groups to train on: 'stats' (summary statistics) and the extra
+# groups written by 2_extract_features.py ('cumul', 'kfp')
+FEATURE_GROUPS = ['stats']
+EXTRA_FEATURE_PREFIXES = ['cumul_', 'kfp_']
+
+# Train/test only on the traces of an index file (one x-y per line, e.g. from
+# src-dl/trace_sample.py or src-dl/trace_dedup.py), or None for all of them
+SAMPLE_INDEX = None
+
 # Create necessary directories
 for folder in [MODELS_FOLDER, RESULTS_FOLDER]:
     if not os.path.exists(folder):
@@ -175,16 +184,37 @@ def save_model(model, model_name, models_directory):
     joblib.dump(model, model_filename)
 
 ################################################################################
-def load_and_prepare_data(file_path, test_size=0.2, random_state=42):
+def select_feature_groups(X, feature_groups):
+    """Keep only the columns of the selected feature groups"""
+    columns = []
+    for column in X.columns:
+        prefix = next((p for p in EXTRA_FEATURE_PREFIXES if column.startswith(p)), None)
+        group = 'stats' if prefix is None else prefix[:-1]
+        if group in feature_groups:
+            columns.append(column)
+    if not columns:
+        raise ValueError(f"No columns found for feature groups {feature_groups}")
+    return X[columns]
+
+################################################################################
+def load_and_prepare_data(file_path, test_size=0.2, random_state=42, feature_groups=FEATURE_GROUPS,
+                          sample_index=SAMPLE_INDEX):
     """Load and prepare the training data with proper per-website train/test split"""
     df = pd.read_csv(file_path)
+    if sample_index is not None:
+        if 'trace' not in df.columns:
+            raise ValueError(f"{file_path} has no 'trace' column, extract the features again to use an index")
+        with open(sample_index) as f:
+            names = {line.strip() for line in f if line.strip()}
+        df = df[df['trace'].isin(names)].reset_index(drop=True)
+        print(f"Traces kept by {sample_index}: {len(df)}")
     
     # Separate features and labels
-    X = df.drop(columns=['website'])
+    X = select_feature_groups(df.drop(columns=['website', 'trace'], errors='ignore'), feature_groups)
     y = df['website']
     
     print(f"Total data shape: {df.shape}")
-    print(f"Features: {X.shape[1]}")
+    print(f"Features: {X.shape[1]} (groups: {', '.join(feature_groups)})")
     print(f"Unique websites: {len(y.unique())}")
     print(f"Samples per website:\n{Counter(y)}")
     
@@ -483,6 +513,10 @@ def main():
     
     # Define models to test
     models_directory = "wf_models"
+    if FEATURE_GROUPS != ['stats']:
+        models_directory += "_" + "_".join(FEATURE_GROUPS)
+    if SAMPLE_INDEX is not None:
+        models_directory += "_" + os.path.splitext(os.path.basename(SAMPLE_INDEX))[0]
     model_names = [
         'GradientBoosting', 'DecisionTree', 'RandomForest', 'XGBoost', 'ExtraTrees', 'LogisticRegression', 'NaiveBayes', 'KNN', 'SVM'
     ]
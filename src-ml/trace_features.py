@@ -0,0 +1,173 @@
+import numpy as np
+
+################################################################################
+# Constants
+CUMUL_POINTS = 100          # interpolation points of the cumulative trace (CUMUL)
+KFP_CHUNK = 20              # packets per chunk for the outgoing-concentration features
+KFP_EDGE = 30               # packets looked at in the first/last packets features
+KFP_SECONDS = 20            # leading packets-per-second values kept as features
+KFP_ALT_BINS = 20           # bins of the alternative concentration/per-second features
+
+################################################################################
+# Feature engine for the CUMUL and k-FP representations.
+#
+# Every function takes the decoded trace of one capture as two NumPy arrays:
+#   times -> absolute or relative timestamps (seconds)
+#   sizes -> signed packet sizes (+ outgoing from the client, - incoming)
+# and returns (names, values) lists ready to be appended to f_names/f_values.
+# Only vectorized NumPy (cumsum/interp/bincount/...) is used, never a loop
+# over packets.
+################################################################################
+
+def _stats(data, prefix):
+    """max/mean/std/p75 of an array, NaN when it is empty"""
+    names = [prefix + '_max', prefix + '_mean', prefix + '_std', prefix + '_p75']
+    if data.size == 0:
+        return names, [np.nan] * 4
+    return names, [float(np.max(data)), float(np.mean(data)), float(np.std(data)), float(np.percentile(data, 75))]
+
+
+def _summary(data, prefix):
+    """mean/std/median/min/max of an array, NaN when it is empty"""
+    names = [prefix + '_mean', prefix + '_std', prefix + '_median', prefix + '_min', prefix + '_max']
+    if data.size == 0:
+        return names, [np.nan] * 5
+    return names, [float(np.mean(data)), float(np.std(data)), float(np.median(data)),
+                   float(np.min(data)), float(np.max(data))]
+
+
+def _fixed_bins(data, n_bins):
+    """Sum a variable-length array into n_bins contiguous bins of (almost) equal size"""
+    if data.size == 0:
+        return np.zeros(n_bins)
+    bins = np.arange(data.size) * n_bins // data.size
+    return np.bincount(bins, weights=data, minlength=n_bins)
+
+
+def _run_lengths(mask):
+    """Lengths of the runs of True values in a boolean array"""
+    padded = np.concatenate(([False], mask, [False])).astype(np.int8)
+    edges = np.flatnonzero(np.diff(padded))
+    return edges[1::2] - edges[::2]
+
+
+################################################################################
+# CUMUL: Panchenko et al., "Website Fingerprinting at Internet Scale", NDSS 2016
+def cumul_features(times, sizes, n_points=CUMUL_POINTS):
+    """Packet/byte counts plus the cumulative size curve interpolated at n_points"""
+    sizes = np.asarray(sizes, dtype=np.float64)
+    incoming = sizes < 0
+    outgoing = sizes > 0
+
+    names = ['cumul_packets_in', 'cumul_packets_out', 'cumul_bytes_in', 'cumul_bytes_out']
+    values = [int(np.count_nonzero(incoming)), int(np.count_nonzero(outgoing)),
+              float(-sizes[incoming].sum()), float(sizes[outgoing].sum())]
+
+    names.extend(f'cumul_{i:03d}' for i in range(n_points))
+    if sizes.size == 0:
+        values.extend([np.nan] * n_points)
+        return names, values
+
+    # x axis: cumulative absolute size, y axis: cumulative signed size
+    cum_abs = np.cumsum(np.abs(sizes))
+    cum_signed = np.cumsum(sizes)
+    points = np.linspace(cum_abs[0], cum_abs[-1], n_points + 1)[1:]
+    values.extend(np.interp(points, cum_abs, cum_signed).tolist())
+
+    return names, values
+
+
+################################################################################
+# k-FP: Hayes and Danezis, "k-fingerprinting: a Robust Scalable Website
+# Fingerprinting Technique", USENIX Security 2016 (size-aware subset)
+def kfp_features(times, sizes):
+    """Counts, timing, ordering, concentration, per-second and burst features"""
+    times = np.asarray(times, dtype=np.float64)
+    sizes = np.asarray(sizes, dtype=np.float64)
+    if times.size:
+        times = times - times[0]
+    incoming = sizes < 0
+    outgoing = sizes > 0
+    n_total = sizes.size
+    n_in = int(np.count_nonzero(incoming))
+    n_out = int(np.count_nonzero(outgoing))
+
+    names, values = [], []
+
+    def add(new_names, new_values):
+        names.extend('kfp_' + n for n in new_names)
+        values.extend(new_values)
+
+    # Packet and byte counts
+    add(['packets_total', 'packets_in', 'packets_out', 'frac_in', 'frac_out',
+         'bytes_in', 'bytes_out', 'mean_size_in', 'mean_size_out'],
+        [n_total, n_in, n_out,
+         n_in / n_total if n_total else np.nan,
+         n_out / n_total if n_total else np.nan,
+         float(-sizes[incoming].sum()), float(sizes[outgoing].sum()),
+         float(-sizes[incoming].mean()) if n_in else np.nan,
+         float(sizes[outgoing].mean()) if n_out else np.nan])
+
+    # Inter-arrival times (total, in, out)
+    for label, mask in (('iat', None), ('iat_in', incoming), ('iat_out', outgoing)):
+        selected = times if mask is None else times[mask]
+        add(*_stats(np.diff(selected), label))
+
+    # Transmission time quartiles (total, in, out)
+    for label, mask in (('time', None), ('time_in', incoming), ('time_out', outgoing)):
+        selected = times if mask is None else times[mask]
+        quartile_names = [label + q for q in ('_p25', '_p50', '_p75', '_p100')]
+        if selected.size == 0:
+            add(quartile_names, [np.nan] * 4)
+        else:
+            add(quartile_names, np.percentile(selected, [25, 50, 75, 100]).tolist())
+
+    # Packet ordering: position of each packet in the whole trace
+    positions = np.arange(n_total, dtype=np.float64)
+    add(['order_in_mean', 'order_in_std', 'order_out_mean', 'order_out_std'],
+        [float(positions[incoming].mean()) if n_in else np.nan,
+         float(positions[incoming].std()) if n_in else np.nan,
+         float(positions[outgoing].mean()) if n_out else np.nan,
+         float(positions[outgoing].std()) if n_out else np.nan])
+
+    # Concentration of outgoing packets in chunks of KFP_CHUNK packets
+    chunks = np.bincount(np.arange(n_total) // KFP_CHUNK, weights=outgoing, minlength=1) if n_total \
+        else np.zeros(0)
+    add(*_summary(chunks, 'conc_out'))
+    add([f'conc_out_alt_{i:02d}' for i in range(KFP_ALT_BINS)], _fixed_bins(chunks, KFP_ALT_BINS).tolist())
+
+    # Incoming/outgoing packets among the first and last KFP_EDGE packets
+    add(['first_in', 'first_out', 'last_in', 'last_out'],
+        [int(np.count_nonzero(incoming[:KFP_EDGE])), int(np.count_nonzero(outgoing[:KFP_EDGE])),
+         int(np.count_nonzero(incoming[-KFP_EDGE:])) if n_total else 0,
+         int(np.count_nonzero(outgoing[-KFP_EDGE:])) if n_total else 0])
+
+    # Packets per second
+    per_second = np.bincount(np.maximum(times, 0).astype(np.int64)) if n_total else np.zeros(0)
+    add(*_summary(per_second, 'pps'))
+    leading = np.zeros(KFP_SECONDS)
+    leading[:min(KFP_SECONDS, per_second.size)] = per_second[:KFP_SECONDS]
+    add([f'pps_{i:02d}' for i in range(KFP_SECONDS)], leading.tolist())
+    add([f'pps_alt_{i:02d}' for i in range(KFP_ALT_BINS)], _fixed_bins(per_second, KFP_ALT_BINS).tolist())
+
+    # Bursts: runs of consecutive outgoing packets
+    bursts = _run_lengths(outgoing)
+    add(['bursts', 'burst_max', 'burst_mean', 'bursts_gt5', 'bursts_gt10', 'bursts_gt20'],
+        [int(bursts.size),
+         int(bursts.max()) if bursts.size else 0,
+         float(bursts.mean()) if bursts.size else np.nan,
+         int(np.count_nonzero(bursts > 5)),
+         int(np.count_nonzero(bursts > 10)),
+         int(np.count_nonzero(bursts > 20))])
+
+    return names, values
+
+
+################################################################################
+# Selectable feature groups written next to the summary statistics. The
+# column prefix of each group is its key, which lets 3_wf_attack.py pick
+# the groups it trains on.
+FEATURE_GROUPS = {
+    'cumul': cumul_features,
+    'kfp': kfp_features,
+}